@@ -0,0 +1,54 @@
+'''
+Compares matching required fields of every blueprint on every file
+with matching only blueprints selected by BlueprintIndex.
+Run from repository root:
+    PYTHONPATH=src python3 benchmarks/bench_dispatch.py [number of filenames] [number of blueprints]
+'''
+import random
+import sys
+import time
+from dataclasses import make_dataclass
+
+from files_kraken.blueprint import DataBlueprint
+from files_kraken.data_organizer import BlueprintInfo, BlueprintIndex, match_blueprints
+
+
+def synthetic_blueprints(n):
+    '''Blueprints of different file types: by extension, by prefix and by contained literal'''
+    blueprints = []
+    for i in range(n):
+        required_fields = [
+            {'sample': (rf'(sample_\d+)\.type_{i}', 1), 'file': rf'.+\.ext{i}'},
+            {'run': rf'run{i}_\d+.*'},
+            {'lane': (rf'lane{i}_(\d+)', 1)},
+        ][i % 3]
+        blueprints.append(make_dataclass(
+            f'Blueprint{i}', [(field, str) for field in required_fields],
+            bases=(DataBlueprint,), namespace={'required_fields': required_fields}))
+    return blueprints
+
+
+def synthetic_filenames(n, blueprints):
+    random.seed(0)
+    templates = [
+        'sample_{a}.type_{i}.ext{i}', 'run{i}_{a}.txt', 'data.lane{i}_{a}.csv', 'IMG_{a}.jpg']
+    return [
+        random.choice(templates).format(a=random.randint(1, 10**5), i=random.randrange(blueprints))
+        for _ in range(n)]
+
+
+if __name__ == '__main__':
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    n_blueprints = int(sys.argv[2]) if len(sys.argv) > 2 else 60
+    blueprints = {bp: BlueprintInfo(bp) for bp in synthetic_blueprints(n_blueprints)}
+    index = BlueprintIndex(blueprints)
+    names = synthetic_filenames(n, n_blueprints)
+    print(f'{n:,} synthetic filenames, {n_blueprints} blueprints')
+    results = []
+    for name, bp_index in (('every blueprint', None), ('dispatch index', index)):
+        start = time.perf_counter()
+        matches = match_blueprints(blueprints, names, bp_index)
+        results.append([(bp, match) for bp, _, match in matches])
+        elapsed = time.perf_counter() - start
+        print(f'{name:<16} {elapsed:8.2f} s  {len(names) / elapsed:12,.0f} files/s')
+    assert sorted(results[0], key=str) == sorted(results[1], key=str)
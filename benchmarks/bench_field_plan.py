@@ -0,0 +1,89 @@
+'''
+Compares per-structure field handling of the builder, which looks up fields
+and behaviors by reflection on each call, with precompiled field plans.
+Run from repository root:
+    PYTHONPATH=src python3 benchmarks/bench_field_plan.py [number of structures]
+'''
+import pathlib
+import sys
+import time
+from dataclasses import dataclass, field, fields
+from typing import ClassVar, List
+
+from files_kraken.blueprint import DataBlueprint
+from files_kraken.data_organizer import BlueprintsDBUpdater, BlueprintBuilder
+from files_kraken.fields import FieldsTransformer, NoUpdate, ParserField, DataParser
+
+
+class SizeParser(DataParser):
+    def parse(file):
+        return len(str(file))
+
+
+@dataclass
+class SampleBlueprint(DataBlueprint):
+    sample: str
+    project: str = None
+    fastqs: List[pathlib.Path] = field(default_factory=list)
+    bams: List[pathlib.Path] = field(default_factory=list)
+    metrics_file: pathlib.Path = None
+    report_file: pathlib.Path = None
+    metric: ParserField = ParserField('metric', SizeParser, dependent_fields=['metrics_file'])
+    report: ParserField = ParserField('report', SizeParser, dependent_fields=['report_file'])
+
+    required_fields: ClassVar = {'sample': (r'sample_(\d+)', 1)}
+    match_template: ClassVar = {}
+
+
+FILE = pathlib.Path('/data/sample_1.fastq.gz')
+MATCH = {'project': 'project_1', 'fastqs': 'sample_1.fastq.gz', 'metrics_file': 'sample_1'}
+
+
+def reflective(structure):
+    '''Field handling as it was done before field plans'''
+    formatted = {
+        f: FieldsTransformer.after_match(
+            structure.get_field_type(f), FILE, value, field_default=getattr(structure, f))
+        for f, value in MATCH.items()}
+    updates = {}
+    for f, value in formatted.items():
+        update = FieldsTransformer.update(
+            structure.get_field_type(f), getattr(structure, f), value, 'created')
+        if not update == NoUpdate:
+            updates[f] = update
+    parser_fields = [
+        getattr(structure, f.name) for f in fields(structure)
+        if structure.get_field_type(f.name).__name__ == 'ParserField']
+    pending = [pf for pf in parser_fields if pf.dependent_fields and not pf.value]
+    entry = {}
+    for f in fields(structure):
+        value = getattr(structure, f.name)
+        if f.type.__name__ == 'ParserField':
+            value = value.value
+        entry[f.name] = FieldsTransformer.to_db(f.type, value)
+    return updates, len(pending), entry
+
+
+def planned(structure):
+    formatted = BlueprintBuilder.format_fields(structure, FILE, MATCH)
+    updates = BlueprintBuilder.get_field_updates(
+        structure, {f: [(value, 'created')] for f, value in formatted.items()})
+    pending = [
+        fp for fp in structure.field_plan().values()
+        if fp.is_parser and fp.dependents and not getattr(structure, fp.name).value]
+    entry = BlueprintsDBUpdater.entry_from_structure(structure, '1')
+    del entry['blueprint'], entry['id']
+    return updates, len(pending), entry
+
+
+if __name__ == '__main__':
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    structures = [SampleBlueprint(str(i)) for i in range(n)]
+    print(f'{n:,} structures of {len(fields(SampleBlueprint))} fields')
+    results = []
+    for name, handle in (('reflective', reflective), ('field plan', planned)):
+        start = time.perf_counter()
+        results.append([handle(structure) for structure in structures])
+        elapsed = time.perf_counter() - start
+        print(f'{name:<12} {elapsed:8.2f} s  {elapsed / n * 1e6:8.2f} us/structure')
+    assert results[0] == results[1]
@@ -0,0 +1,45 @@
+'''
+Compares updating List[pathlib.Path] field by each created file with
+update_many, which applies all changes of a build to one ordered set,
+and conversion of the updated list for DB.
+Run from repository root:
+    PYTHONPATH=src python3 benchmarks/bench_list_fields.py [number of files]
+'''
+import pathlib
+import sys
+import time
+from typing import List
+
+from files_kraken.fields import FieldsTransformer, NoUpdate
+
+FIELD_TYPE = List[pathlib.Path]
+
+
+def update_each(old_value, changes):
+    value = old_value
+    for new_value, mode in changes:
+        update = FieldsTransformer.update(FIELD_TYPE, value, new_value, mode)
+        if update is not NoUpdate:
+            value = update
+    return value
+
+
+def update_many(old_value, changes):
+    return FieldsTransformer.update_many(FIELD_TYPE, old_value, changes)
+
+
+if __name__ == '__main__':
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 5_000
+    db_value = [f'/data/run_1/tile_{i}.bcl' for i in range(n)]
+    changes = [([pathlib.Path(f'/data/run_1/tile_{i}.bcl')], 'created') for i in range(n, 2 * n)]
+    print(f'{n:,} files in DB, {n:,} created files')
+    results = []
+    for name, update in (('update each', update_each), ('update_many', update_many)):
+        old_value = FieldsTransformer.from_db(FIELD_TYPE, db_value)
+        start = time.perf_counter()
+        value = update(old_value, changes)
+        updated = time.perf_counter() - start
+        results.append(FieldsTransformer.to_db(FIELD_TYPE, value))
+        converted = time.perf_counter() - start - updated
+        print(f'{name:<12} update {updated:8.3f} s  to_db {converted:8.3f} s')
+    assert results[0] == results[1]
@@ -0,0 +1,53 @@
+'''
+Measures how fast matchers reject filenames with and without literal prefilter.
+Run from repository root:
+    PYTHONPATH=src python3 benchmarks/bench_prefilter.py [number of filenames]
+'''
+import random
+import sys
+import time
+
+from files_kraken.retools import BoolOutputMultimatcher, SchemeMatcher
+
+
+PATTERNS = [
+    r'run_[0-9]+\.sample_[0-9]+\.results\.txt',
+    r'.+_metrics\.csv',
+    (r'(run_[0-9]+)\.raw_data', 1),
+    r'.+\.R[12]\.fastq\.gz',
+    (r'(\w+)\.qc_report\.html', 1)
+]
+
+
+def rejected_filenames(n):
+    '''Filenames looking like real data, but matching none of the patterns'''
+    random.seed(0)
+    templates = [
+        'IMG_{a}.jpg', 'run_{a}.sample_{b}.results.tsv', 'sample_{b}.bam',
+        'report_{a}_{b}.pdf', 'run_{a}.sample_{b}.lane_1.R3.fastq.gz', 'notes_{a}.txt']
+    return [
+        random.choice(templates).format(a=random.randint(1, 500), b=random.randint(1, 10**5))
+        for _ in range(n)]
+
+
+def bench(name, func, names):
+    start = time.perf_counter()
+    matched = sum(1 for text in names if func(text))
+    elapsed = time.perf_counter() - start
+    print(f'{name:<28} {elapsed:7.2f} s  {len(names) / elapsed:12,.0f} rejections/s')
+    assert not matched
+    return elapsed
+
+
+if __name__ == '__main__':
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    names = rejected_filenames(n)
+    print(f'{n:,} non-matching filenames, {len(PATTERNS)} patterns')
+    for matcher_name, create in (
+            ('BoolOutputMultimatcher', lambda prefilter: BoolOutputMultimatcher(
+                PATTERNS, prefilter=prefilter).match),
+            ('SchemeMatcher', lambda prefilter: SchemeMatcher(
+                {f'field_{i}': p for i, p in enumerate(PATTERNS)}, prefilter=prefilter).match)):
+        plain = bench(f'{matcher_name}', create(False), names)
+        filtered = bench(f'{matcher_name} + prefilter', create(True), names)
+        print(f'{"speedup":<28} {plain / filtered:7.2f}x')
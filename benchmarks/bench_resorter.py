@@ -0,0 +1,43 @@
+'''
+Compares ReSorter with sorting by searching the key inside the sort key function,
+and merging of sorted chunks with sorting them all together.
+Run from repository root:
+    PYTHONPATH=src python3 benchmarks/bench_resorter.py [number of paths]
+'''
+import random
+import sys
+import time
+
+from files_kraken.retools import ReSorter, GroupSearcher
+
+
+def synthetic_paths(n):
+    random.seed(0)
+    return [f'/data/run_{random.randint(1, 999)}/sample_{i}.bam' for i in range(n)]
+
+
+def bench(name, func):
+    start = time.perf_counter()
+    result = func()
+    elapsed = time.perf_counter() - start
+    print(f'{name:<24} {elapsed:8.2f} s')
+    return result
+
+
+if __name__ == '__main__':
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 500_000
+    paths = synthetic_paths(n)
+    searcher = GroupSearcher(r'run_(\d+)', 1)
+    sorter = ReSorter(searcher, func=int)
+    print(f'{n:,} paths')
+    old = bench('search in key function', lambda: sorted(
+        paths, key=lambda path: int(searcher.search(path))))
+    new = bench('ReSorter.sort', lambda: sorter.sort(paths))
+    assert old == new
+    natural = ReSorter(GroupSearcher(r'run_\d+', 0), natural=True)
+    assert bench('ReSorter.sort natural', lambda: natural.sort(paths)) == new
+    # Mostly ordered input: sorted listings of 100 directories
+    chunks = [sorter.sort(paths[i::100]) for i in range(100)]
+    flat = [path for chunk in chunks for path in chunk]
+    assert bench('ReSorter.sort of chunks', lambda: sorter.sort(flat)) == \
+        bench('ReSorter.merge of chunks', lambda: list(sorter.merge(chunks)))
@@ -0,0 +1,81 @@
+'''
+Compares single-pass combined SchemeMatcher with matching each field separately
+and with matching the whole batch by match_many. Also measures construction
+of per-structure matchers, which match only a few files each.
+Run from repository root:
+    PYTHONPATH=src python3 benchmarks/bench_scheme_matcher.py [number of filenames]
+'''
+import random
+import sys
+import time
+
+from files_kraken.retools import SchemeMatcher
+
+
+SCHEME = {
+    'run': (r'^(run_[0-9]+)', 1),
+    'sample': ((r'sample_([^\.]+)', 1), (r'(\w+)_metrics.csv', 1)),
+    'raw_data': r'run_[0-9]+\.sample_[0-9]+\.raw_data\.data',
+    'results': r'run_[0-9]+\.sample_[0-9]+\.results\.txt',
+    'bam': r'.+\.bam',
+    'bai': r'.+\.bai',
+    'fastqs': r'.+\.R[12]\.fastq\.gz',
+    'log': (r'(.+)\.log', 1)
+}
+
+
+def synthetic_filenames(n):
+    random.seed(0)
+    templates = [
+        'run_{run}.sample_{sample}.raw_data.data',
+        'run_{run}.sample_{sample}.results.txt',
+        'sample_{sample}.bam',
+        'sample_{sample}.bam.bai',
+        'run_{run}.sample_{sample}.lane_1.R1.fastq.gz',
+        '{sample}_metrics.csv',
+        'pipeline_{run}.log',
+        'unrelated_file_{run}_{sample}.tmp',
+        'IMG_{run}{sample}.jpg',
+        'notes.txt'
+    ]
+    return [
+        random.choice(templates).format(
+            run=random.randint(1, 500), sample=random.randint(1, 100000))
+        for _ in range(n)]
+
+
+def bench(name, func, names):
+    start = time.perf_counter()
+    for text in names:
+        func(text)
+    elapsed = time.perf_counter() - start
+    print(f'{name:<12} {elapsed:8.2f} s  {len(names) / elapsed:12,.0f} names/s')
+    return elapsed
+
+
+def bench_construction(n):
+    '''StructureInfo creates a matcher with scheme of its own for each structure'''
+    start = time.perf_counter()
+    for i in range(n):
+        matcher = SchemeMatcher({
+            'fastqs': fr'sample_{i}.lane_\d+.R[1-2].fastq.gz',
+            'metrics_file': fr'sample_{i}.metrics.txt'})
+        matcher.match(f'sample_{i}.metrics.txt')
+    elapsed = time.perf_counter() - start
+    print(f'{"construction":<12} {elapsed / n * 1e6:8.1f} us/matcher')
+
+
+if __name__ == '__main__':
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    names = synthetic_filenames(n)
+    matcher = SchemeMatcher(SCHEME)
+    assert all(matcher.match(t) == matcher._match_each(t) for t in names[:10000])
+    print(f'{n:,} synthetic filenames, {len(SCHEME)} fields')
+    separate = bench('separate', matcher._match_each, names)
+    combined = bench('combined', matcher.match_scheme, names)
+    print(f'speedup      {separate / combined:8.2f}x')
+    start = time.perf_counter()
+    matcher.match_many(names)
+    batch = time.perf_counter() - start
+    print(f'{"match_many":<12} {batch:8.2f} s  {len(names) / batch:12,.0f} names/s')
+    bench_construction(min(n, 10_000))
@@ -86,11 +86,9 @@ class SampleRunInfo(DataBlueprint):
         'run': (r'run_[0-9]+', 0)
     }
 
-    def __post_init__(self):
-        self.match_scheme = {
-            'results_file': fr'{self.run}.sample_{self.sample}.results.txt'
-        }
-        return super().__post_init__()
+    match_template = {
+        'results_file': r'{run}.sample_{sample}.results.txt'
+    }
 
 
 # Now suppose that after creating the scheme you realize that you want to
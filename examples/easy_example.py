@@ -57,14 +57,12 @@ class MyScheme(DataBlueprint):
         'project': (r'project_[0-9]+', 0)
     }
 
-    # You have to create __post_init__ in each of your schemes
-    def __post_init__(self):
-        #  You need to provide match_scheme if there are some
-        # non-required fields in your scheme.
-        self.match_scheme = {
-            'results_file': fr'{self.project}_results.txt'
-        }
-        super().__post_init__()  # Also required
+    #  You need to provide match_template if there are some
+    # non-required fields in your scheme. {project} is replaced
+    # with the project field value of each structure.
+    match_template = {
+        'results_file': r'{project}_results.txt'
+    }
 
 
 wf = Workflow(
@@ -1,20 +1,36 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, fields
 from typing import ClassVar
 from copy import deepcopy
 
 # FilesKraken modules
-from fields import FieldsTransformer
+from fields import compile_field_plan
 # It's good idea to create dataclass with constants for blueprints to use it here
 
 
+def _as_template(entry):
+    '''Escapes braces of pattern entry, so it's used in match_template as is'''
+    match entry:
+        case str():
+            return entry.replace('{', '{{').replace('}', '}}')
+        case tuple():
+            return tuple(_as_template(sub_entry) for sub_entry in entry)
+        case _:
+            return entry
+
+
 @dataclass
 class DataBlueprint:
     required_fields: ClassVar
+    # Patterns of optional fields with {field} placeholders, e.g.
+    # {'results_file': r'{run}.sample_{sample}.results.txt'}
+    # It's compiled once for all structures, so match_scheme isn't needed
+    match_template: ClassVar = None
 
     def __post_init__(self):
         '''
         This should be executed after match_scheme declaration in child classes.
         Here patterns are set to match_scheme for each ParserField.
+        Blueprints with match_template don't need match_scheme.
         '''
         self.has_parser_fields = False
         for field, value in self.__dict__.items():
@@ -31,7 +47,7 @@ class DataBlueprint:
                 setattr(self, field, deepcopy(value))
                 pf = getattr(self, field)
                 # There could be set either pattern or dependent_fields in a ParserField, not both
-                if pf.pattern:
+                if pf.pattern and self.match_template is None:
                     # Each child must have match_scheme declared before super().__post_init__
                     # It's very bad and need to be fixed
                     self.match_scheme[field] = pf.pattern
@@ -47,24 +63,52 @@ class DataBlueprint:
         '''
         Factory method for all DataBlueprint subclasses
         '''
-        annotations = cls.__annotations__
+        plan = cls.field_plan()
         required_fields = cls.required_fields.keys()
         required_args = [kwargs[arg] for arg in required_fields]
         # It realy needs some sort of specification...
         optional_args = {}
         for field, value in kwargs.items():
-            if (field not in required_fields) and (field in annotations):
-                f_type = annotations[field]
+            field_plan = plan.get(field)
+            if (field not in required_fields) and field_plan:
                 # Again I need to process ParserField separately...
-                if f_type.__name__ == 'ParserField':
-                    parser_field = deepcopy(getattr(cls, field))
+                if field_plan.is_parser:
+                    parser_field = deepcopy(field_plan.default)
                     # I'm not sure it's okay to change class ParserField like that
                     parser_field.value = value
                     optional_args[field] = parser_field
                     continue
-                optional_args[field] = FieldsTransformer.from_db(f_type, value)
+                optional_args[field] = field_plan.from_db(value)
         return cls(*required_args, **optional_args)
 
+    @classmethod
+    def field_plan(cls) -> dict:
+        '''
+        Returns {field: FieldPlan} with types and behaviors of the fields.
+        It's compiled once for each blueprint class
+        '''
+        # Subclass must not use the plan of its parent
+        plan = cls.__dict__.get('_field_plan')
+        if plan is None:
+            plan = compile_field_plan(cls)
+            cls._field_plan = plan
+        return plan
+
+    @classmethod
+    def scheme_template(cls) -> dict | None:
+        '''
+        Returns match_template with patterns of ParserFields added
+        or None if blueprint declares match_scheme in __post_init__
+        '''
+        if cls.match_template is None:
+            return None
+        template = dict(cls.match_template)
+        for field in fields(cls):
+            pf = field.default
+            if pf.__class__.__name__ == 'ParserField' and pf.pattern:
+                template[field.name] = _as_template(pf.pattern)
+        return template
+
     @classmethod
     def get_field_type(cls, field: str):
         return cls.__annotations__[field]
@@ -101,19 +101,24 @@ class SingleRootCollector(FilesCollector):
         if self.max_depth is not None and cur_depth > self.max_depth:
             return self.output_format()
 
-        for file in root.iterdir():
-            if file.is_dir():
-                if self.matcher:
-                    if self.match_dirs and not self.matcher.match(file.name):
-                        continue
-                contents = self.collect(root=file, cur_depth=cur_depth + 1)
+        # scandir gets file types from directory listing without stat calls
+        with os.scandir(root) as entries:
+            entries = list(entries)
+        # The whole listing is matched at once
+        matched = self.matcher.match_many([entry.name for entry in entries]) \
+            if self.matcher else [True] * len(entries)
+        for entry, is_matched in zip(entries, matched):
+            if entry.is_dir():
+                if self.match_dirs and not is_matched:
+                    continue
+                contents = self.collect(root=pathlib.Path(entry.path), cur_depth=cur_depth + 1)
                 if not self.keep_empty_dirs and not contents:
                     continue
-                collection[file.name] = contents
+                collection[entry.name] = contents
             else:  # file is not a directory
-                if self.matcher and not self.matcher.match(file.name):
+                if not is_matched:
                     continue
-                collection[file.name] = None
+                collection[entry.name] = None
         return collection
 
 
@@ -1,16 +1,22 @@
+import os
 import pathlib
-from dataclasses import dataclass, fields
-from collections import namedtuple
+import threading
+import time
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from dataclasses import dataclass
+from collections import namedtuple, OrderedDict
 
 from typing import Dict, NamedTuple, Any
 
 # FilesKraken modules
 from blueprint import DataBlueprint
-from fields import FieldsTransformer, NoUpdate
-from retools import SchemeMatcher
+from fields import NoUpdate, ParserJob, ParserRunner, LAZY_PENDING, call_parser
+from retools import SchemeMatcher, TemplateMatcher
 from krakens_nest import Kraken
 from database import DatabaseManager
-from info import FileChangesInfo
+from info import FileChangesInfo, BlueprintsUpdatedInfo
 
 
 '''
@@ -33,38 +39,37 @@ class BlueprintsDBUpdater:
         self.db_manager = db_manager
 
     def update(self, builder_data) -> None:
+        # New structures are written with one bulk insert
+        new_entries = []
         for bp, structures in builder_data.items():
             for id, info in structures.items():
                 structure_info = info.structure_info
                 if structure_info.is_new:
-                    entry = self.entry_from_structure(structure_info.structure, id)
-                    self.db_manager.add_blueprint(entry)
+                    new_entries.append(self.entry_from_structure(structure_info.structure, id))
                 else:
                     if info.updates:
                         formatted_updates = self.old_structure_updates_to_db(
                             structure_info.structure, info.updates
                         )
                         self.db_manager.update_blueprint(bp.name, id, formatted_updates)
+        if new_entries:
+            self.db_manager.add_many(new_entries)
 
     @staticmethod
     def entry_from_structure(structure: DataBlueprint, id) -> Dict[str, Any]:
         entry = {'blueprint': structure.name, 'id': id}
-        for field in fields(structure):
-            value = getattr(structure, field.name)
-            if field.type.__name__ == 'ParserField':
+        for field_plan in structure.field_plan().values():
+            value = getattr(structure, field_plan.name)
+            if field_plan.is_parser:
                 value = value.value
-            entry[field.name] = FieldsTransformer.to_db(field.type, value)
+            entry[field_plan.name] = field_plan.to_db(value)
         return entry
 
     @staticmethod
     def old_structure_updates_to_db(structure: DataBlueprint, updates: dict):
         '''Formats old structure updates for db'''
-        formatted_updates = {}
-        for field, value in updates.items():
-            field_type = structure.get_field_type(field)
-            formatted_updates[field] = FieldsTransformer.to_db(
-                field_type, value)
-        return formatted_updates
+        plan = structure.field_plan()
+        return {field: plan[field].to_db(value) for field, value in updates.items()}
 
 
 @dataclass
@@ -72,7 +77,179 @@ class BlueprintInfo:
     blueprint: DataBlueprint
 
     def __post_init__(self):
-        self.scheme_matcher = SchemeMatcher(self.blueprint.required_fields)
+        # Required fields are matched for every file
+        self.scheme_matcher = SchemeMatcher(self.blueprint.required_fields, warmup=0)
+        # Fields are compiled once at registration, builder doesn't inspect them anymore
+        self.field_plan = self.blueprint.field_plan()
+        # ParserFields parsed when their dependent fields are set
+        self.parser_levels = self.sort_parsers(self.blueprint.name, self.field_plan)
+        # ParserFields parsed again when their files grow
+        self.incremental_parsers = tuple(
+            field_plan for field_plan in self.field_plan.values()
+            if field_plan.is_parser and getattr(field_plan.default.parser, 'incremental', False))
+        # Optional fields of all structures are matched by one template matcher
+        template = self.blueprint.scheme_template()
+        self.template_matcher = TemplateMatcher(template) if template else None
+        if self.template_matcher:
+            unknown = set(self.template_matcher.placeholders) - set(self.field_plan)
+            if unknown:
+                raise ValueError(
+                    f'Unknown fields in match_template of {self.blueprint.name}: {unknown}')
+
+    @staticmethod
+    def sort_parsers(name: str, field_plan: dict) -> tuple[tuple]:
+        '''
+        Sorts ParserFields with dependent fields into levels of their dependency graph.
+        Fields of a level depend only on plain fields and ParserFields of previous levels
+        '''
+        remaining = {
+            fp.name: fp for fp in field_plan.values() if fp.is_parser and fp.dependents}
+        for fp in remaining.values():
+            lazy = [
+                f for f in fp.dependents
+                if f in field_plan and field_plan[f].is_parser and field_plan[f].default.lazy]
+            if lazy:
+                raise ValueError(
+                    f'ParserField {fp.name} of {name} depends on lazy ParserFields {lazy}')
+        levels = []
+        while remaining:
+            level = tuple(
+                fp for fp in remaining.values()
+                if not any(f in remaining for f in fp.dependents))
+            if not level:
+                raise ValueError(
+                    f'Cyclic dependencies of ParserFields of {name}: {sorted(remaining)}')
+            levels.append(level)
+            for fp in level:
+                del remaining[fp.name]
+        return tuple(levels)
+
+
+class BlueprintIndex:
+    '''
+    Maps filename to blueprints which can match it. All required fields must be matched,
+    so a blueprint is indexed by literals of one required field patterns: prefixes
+    or suffixes, e.g. '.bam' of r'.+\\.bam', looked up by hash, or literals contained
+    in search patterns, e.g. 'sample_' of (r'sample_(\\d+)', 1), checked by substring.
+    Blueprints which can't be indexed are always candidates.
+    '''
+    def __init__(self, blueprints: Dict[DataBlueprint, BlueprintInfo] | None = None):
+        self._order = {}
+        self._prefixes = {}
+        self._suffixes = {}
+        self._contains = {}
+        self._fallback = []
+        for bp, bp_info in (blueprints or {}).items():
+            self.add(bp, bp_info)
+
+    @staticmethod
+    def _field_keys(alternatives) -> list[tuple[str, str]]:
+        '''Index keys for each alternative of the field: its longest fixed part'''
+        keys = []
+        for prefix, suffix, required in alternatives:
+            if suffix or prefix:
+                keys.append(
+                    ('suffix', suffix) if len(suffix) >= len(prefix) else ('prefix', prefix))
+            elif required:
+                keys.append(('contains', required))
+            else:
+                return []
+        return keys
+
+    def add(self, bp: DataBlueprint, bp_info: BlueprintInfo) -> None:
+        if bp in self._order:
+            self.remove(bp)
+        self._order[bp] = len(self._order)
+        best, best_rank = None, None
+        for alternatives in bp_info.scheme_matcher.fixed_parts().values():
+            keys = self._field_keys(alternatives)
+            if not keys:
+                continue
+            # Hash lookups are preferred to substring checks, then longer literals
+            rank = (
+                all(kind != 'contains' for kind, _ in keys),
+                min(len(key) for _, key in keys))
+            if best is None or rank > best_rank:
+                best, best_rank = keys, rank
+        if best is None:
+            self._fallback.append(bp)
+            return
+        for kind, key in best:
+            if kind == 'contains':
+                self._contains.setdefault(key, []).append(bp)
+                continue
+            index = self._suffixes if kind == 'suffix' else self._prefixes
+            index.setdefault(len(key), {}).setdefault(key, []).append(bp)
+
+    def remove(self, bp: DataBlueprint) -> None:
+        self._order.pop(bp, None)
+        if bp in self._fallback:
+            self._fallback.remove(bp)
+        keys = [self._contains] + list(self._prefixes.values()) + list(self._suffixes.values())
+        for index in keys:
+            for blueprints in index.values():
+                if bp in blueprints:
+                    blueprints.remove(bp)
+
+    def candidates(self, name: str) -> list[DataBlueprint]:
+        '''Blueprints which can match the name in order of their registration'''
+        found = set(self._fallback)
+        # Lookup per distinct literal length, not per blueprint
+        for length, keys in self._suffixes.items():
+            found.update(keys.get(name[-length:], ()))
+        for length, keys in self._prefixes.items():
+            found.update(keys.get(name[:length], ()))
+        for literal, blueprints in self._contains.items():
+            if literal in name:
+                found.update(blueprints)
+        return sorted(found, key=self._order.__getitem__)
+
+
+def register_lazy_fields(db_manager: DatabaseManager, blueprint: DataBlueprint) -> None:
+    '''Registers resolvers of lazy ParserFields of the blueprint in DatabaseManager'''
+    if db_manager is None:
+        return
+    plan = blueprint.field_plan()
+    for field_plan in plan.values():
+        if not field_plan.is_parser or not field_plan.default.lazy:
+            continue
+        dependents = [plan[f] for f in field_plan.dependents]
+
+        def resolve(entry, parser=field_plan.default.parser, dependents=dependents):
+            return call_parser(parser, tuple(f.from_db(entry.get(f.name)) for f in dependents))
+
+        db_manager.register_lazy_field(blueprint.name, field_plan.name, resolve)
+
+
+def match_blueprints(
+        blueprints: Dict[DataBlueprint, BlueprintInfo], files, index: BlueprintIndex = None):
+    '''
+    Matches required fields of each blueprint on the whole batch of files.
+    Yields (blueprint, file, required fields match) for files matched all required fields
+    in the order of files for each blueprint.
+    With index, blueprints are matched only on files they can match.
+    '''
+    files = [pathlib.Path(file) for file in files]
+    if not files:
+        return
+    names = [file.name for file in files]
+    selected = {bp: range(len(files)) for bp in blueprints}
+    if index is not None:
+        selected = {bp: [] for bp in blueprints}
+        for i, name in enumerate(names):
+            for bp in index.candidates(name):
+                selected[bp].append(i)
+    for bp, bp_info in blueprints.items():
+        indices = selected[bp]
+        if not indices:
+            continue
+        # Required fields must be of type str
+        columns = bp_info.scheme_matcher.match_many([names[i] for i in indices])
+        keys = list(columns)
+        rows = zip(*columns.values()) if keys else [()] * len(indices)
+        for i, values in zip(indices, rows):
+            if all(values):  # All required fields found
+                yield bp, files[i], dict(zip(keys, values))
 
 
 @dataclass
@@ -86,22 +263,121 @@ class StructureInfo:
             self.scheme_matcher = SchemeMatcher(self.structure.match_scheme)
 
 
+class StructureCache:
+    '''
+    LRU of StructureInfo of [capacity] recently built structures, so structures
+    changed by consecutive builds aren't fetched from DB and created again.
+    It's invalidated by DatabaseManager writes, except builder's own ones.
+    '''
+    def __init__(self, capacity: int = 1000):
+        self.capacity = capacity
+        self._structures = OrderedDict()
+        # Structures being built and ones written by others meanwhile
+        self._taken = set()
+        self._stale = set()
+        self._writer = None
+        self._lock = threading.Lock()
+        self.counters = {'hits': 0, 'misses': 0, 'evictions': 0, 'invalidations': 0}
+
+    def __len__(self):
+        return len(self._structures)
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.counters['hits'] + self.counters['misses']
+        return self.counters['hits'] / lookups if lookups else 0.0
+
+    def take(self, name: str, id: str) -> StructureInfo | None:
+        '''Returns cached structure info, it's removed from cache until it's put back'''
+        key = (name, id)
+        with self._lock:
+            structure_info = self._structures.pop(key, None)
+            self._taken.add(key)
+            self._stale.discard(key)
+        self.counters['hits' if structure_info else 'misses'] += 1
+        return structure_info
+
+    def put(self, name: str, id: str, structure_info: StructureInfo) -> None:
+        key = (name, id)
+        with self._lock:
+            self._taken.discard(key)
+            if key in self._stale:
+                # DB entry was changed while structure was built
+                self._stale.discard(key)
+                return
+            if not self.capacity:
+                return
+            self._structures[key] = structure_info
+            self._structures.move_to_end(key)
+            while len(self._structures) > self.capacity:
+                self._structures.popitem(last=False)
+                self.counters['evictions'] += 1
+
+    def invalidate(self, name: str, id: str) -> None:
+        '''DatabaseManager write hook'''
+        if self._writer == threading.get_ident():
+            return
+        key = (name, id)
+        with self._lock:
+            if key in self._taken:
+                self._stale.add(key)
+            if self._structures.pop(key, None):
+                self.counters['invalidations'] += 1
+
+    @contextmanager
+    def own_writes(self):
+        '''Writes of the current thread inside of the block don't invalidate cache'''
+        self._writer = threading.get_ident()
+        try:
+            yield
+        finally:
+            self._writer = None
+
+    def clear(self) -> None:
+        with self._lock:
+            self._structures.clear()
+
+
 class BlueprintBuilder:
     _StructureIdInfo = namedtuple('StructureIdInfo', 'structure_info updates')
+    # Required fields match and (file, mode) changes of a single structure
+    _StructurePlan = namedtuple('StructurePlan', 'match changes')
 
     def __init__(
             self,
             db_manager: DatabaseManager,
             db_updater: BlueprintsDBUpdater,
             kraken: Kraken = None,
-            blueprints: list[DataBlueprint] | None = None):
+            blueprints: list[DataBlueprint] | None = None,
+            sources: list[str] | None = None,
+            path_prefixes: list[str | pathlib.Path] | None = None,
+            parser_runner: ParserRunner = None,
+            bulk: bool | None = None,
+            bulk_chunk: int = 10_000,
+            structure_cache: StructureCache = None):
         self.db_manager = db_manager
         self.db_updater = db_updater
         self.kraken = kraken
         self.blueprints = {bp: BlueprintInfo(bp) for bp in blueprints} if blueprints else {}
+        self.blueprint_index = BlueprintIndex(self.blueprints)
         self.structures = {bp: {} for bp in self.blueprints}
+        for bp in self.blueprints:
+            register_lazy_fields(db_manager, bp)
+        # Parsers of matched ParserFields are collected during build and run together
+        self.parser_runner = parser_runner if parser_runner else ParserRunner()
+        self._parser_jobs = []
+        # Bulk mode is used when DB is empty (None), for the first build (True) or never (False)
+        self.bulk = bulk
+        self.bulk_chunk = bulk_chunk
+        # Built structures are kept between builds
+        self.structure_cache = structure_cache if structure_cache is not None else StructureCache()
+        if db_manager is not None:
+            db_manager.write_hooks.append(self.structure_cache.invalidate)
+        # Builder receives only changes reported by these monitors and inside these paths
+        self.sources = sources
+        self.path_prefixes = path_prefixes
         if self.kraken:
-            self.kraken.events.append(self.listen)
+            self._subscribe()
 
     # All methods hardcoded for dict_collection ChangesFactory format
 
@@ -113,103 +389,289 @@ class BlueprintBuilder:
     def set_kraken(self, kraken: Kraken):
         '''Allows to set Kraken when object is already instantiated'''
         self.kraken = kraken
-        self.kraken.events.append(self.listen)
+        self._subscribe()
+
+    def _subscribe(self):
+        self.kraken.subscribe(
+            self.listen, info_types=FileChangesInfo,
+            sources=self.sources, path_prefixes=self.path_prefixes)
 
     def register_blueprint(self, blueprint: DataBlueprint):
         self.blueprints[blueprint] = BlueprintInfo(blueprint)
+        self.blueprint_index.add(blueprint, self.blueprints[blueprint])
         self.structures[blueprint] = {}
+        register_lazy_fields(self.db_manager, blueprint)
 
     def build(self, data: NamedTuple):
-        for file in data.created:
-            self._process_file(file, 'created')
-        for file in data.deleted:
-            self._process_file(file, 'deleted')
+        plan = self.plan(data)
+        if self._use_bulk():
+            self.bulk_build(plan)
+            return
+        db_entries = self.prefetch(plan)
+        for (bp, structure_id), structure_plan in plan.items():
+            self._build_structure(bp, structure_id, structure_plan, db_entries)
+        self._finish_build()
+
+    def _use_bulk(self) -> bool:
+        if self.bulk:
+            self.bulk = None
+            return True
+        if self.bulk is None:
+            if self.db_manager.is_empty():
+                return True
+            # DB isn't checked anymore once it has entries
+            self.bulk = False
+        return False
+
+    def bulk_build(self, plan: Dict[tuple, NamedTuple]):
+        '''
+        Initial ingest of an archive which isn't in DB yet. Structures aren't looked up
+        in DB and are built by chunks of [bulk_chunk] structures, each chunk
+        is written with one bulk insert and dropped from memory.
+        '''
+        keys = list(plan)
+        start = time.perf_counter()
+        files = 0
+        for i in range(0, len(keys), self.bulk_chunk):
+            for bp, structure_id in keys[i:i + self.bulk_chunk]:
+                structure_plan = plan[(bp, structure_id)]
+                self._build_structure(bp, structure_id, structure_plan, {})
+                files += len(structure_plan.changes)
+            self._finish_build()
+            structures = min(i + self.bulk_chunk, len(keys))
+            elapsed = max(time.perf_counter() - start, 1e-9)
+            print(
+                f'Bulk ingest: {structures}/{len(keys)} structures, {files} files, '
+                f'{files / elapsed:.1f} files/s, {structures / elapsed:.1f} structures/s')
+
+    def _finish_build(self):
+        '''Parses matched files, writes built structures to DB and moves them to cache'''
+        self.run_matched_parsers()
 
         self.update_parser_fields()
-        self.db_updater.update(self.structures)
+        # Files mapped for parsers are shared only inside of a build
+        self.parser_runner.release_files()
+        with self.structure_cache.own_writes():
+            self.db_updater.update(self.structures)
+        self.cache_structures()
+        self.report_updates()
         # Delete all builded structures
         self.clear_structures()
 
-    # It will be good to write matched blueprints iterator
-    def _process_file(self, file: pathlib.Path, mode: str) -> None:
-        print(f'BlueprintBuilder processing file {file}')
-        file = pathlib.Path(file)
-        for bp, bp_info in self.blueprints.items():
-            structures = self.structures[bp]
-            # At this step scheme_matcher matches only required fields as set in BlueprintInfo
-            # Required fields must be of type str
-            match = bp_info.scheme_matcher.match(file.name)
-
-            # if match:
-            #     print(f'Matched fields: {match}')
-            # else:
-            #     print('No matched fields')
-
-            if len(match) == len(bp.required_fields):  # All required fields found
+    def report_updates(self):
+        '''Tells kraken subscribers which structures have been written to DB'''
+        if not self.kraken:
+            return
+        for bp, structures in self.structures.items():
+            ids = [
+                id for id, info in structures.items()
+                if info.structure_info.is_new or info.updates]
+            if ids:
+                self.kraken.release_threadsafe(BlueprintsUpdatedInfo(bp.name, ids))
+
+    def plan(self, data: NamedTuple) -> Dict[tuple, NamedTuple]:
+        '''
+        Groups changed files by structures: {(blueprint, structure_id): StructurePlan}.
+        Deleted files go first, so a replaced file ends with the value of the new one.
+        '''
+        plan = {}
+        for mode in ('deleted', 'created', 'modified'):
+            files = getattr(data, mode, ())
+            for bp, file, match in match_blueprints(self.blueprints, files, self.blueprint_index):
+                print(f'BlueprintBuilder processing file {file}')
                 structure_id = '__'.join(match.values())  # Required fields combination
-                id_info = structures.get(structure_id)
-                structure_info = id_info.structure_info if id_info else None
-                if not structure_info:
-                    # Check if there is a structure with the same ID in DB
-                    db_entry = self.db_manager.get_blueprint(bp.name, structure_id)
-                    if db_entry:
-                        structure_info = StructureInfo(bp.create(**db_entry), is_new=False)
-                        # print('Structure from DB', structure_info)
-                    else:
-                        # Here we initialize an instance of bp with required args
-                        # and further name it a structure. It's not necessary to format
-                        # required fields after match because they can only be of str type
-                        # and matcher always returns str
-                        structure_info = StructureInfo(bp.create(**match))
-                        # print('New structure', structure_info)
-                structures[structure_id] = self._StructureIdInfo(structure_info, {})
-                # We need to check also optional fields on current file
-                # But there could be blueprint without optional fields
-                if structure_info.scheme_matcher:
-                    optional_match = structure_info.scheme_matcher.match(file.name)
-                    if optional_match:
-                        # After match formatting
-                        formatted_fields = self.format_fields(
-                            structure_info.structure,
-                            file,
-                            optional_match)
-                        # Compare current field values with new ones
-                        updates = self.get_updates(
-                            structure_info.structure, formatted_fields, mode)
-                        if not structure_info.is_new:
-                            # Set updates for current structure_id
-                            self.set_updates(bp, structure_id, updates)
-                        # Set updated field values for current structure
-                        self.set_fields(structure_info.structure, updates)
+                structure_plan = plan.get((bp, structure_id))
+                if structure_plan is None:
+                    structure_plan = plan[(bp, structure_id)] = self._StructurePlan(match, [])
+                structure_plan.changes.append((file, mode))
+        return plan
+
+    def prefetch(self, plan: Dict[tuple, NamedTuple]) -> Dict[tuple, dict | StructureInfo]:
+        '''
+        Takes planned structures from cache and fetches DB entries
+        of the rest with one query for each blueprint
+        '''
+        entries = {}
+        ids = {}
+        for bp, structure_id in plan:
+            if structure_id in self.structures[bp]:
+                continue
+            structure_info = self.structure_cache.take(bp.name, structure_id)
+            if structure_info:
+                entries[(bp, structure_id)] = structure_info
+            else:
+                ids.setdefault(bp, []).append(structure_id)
+        for bp, bp_ids in ids.items():
+            found = self.db_manager.get_many(bp.name, bp_ids, resolve=False)
+            for structure_id, entry in found.items():
+                entries[(bp, structure_id)] = entry
+        return entries
+
+    def cache_structures(self):
+        '''Puts structures written to DB into cache'''
+        for bp, structures in self.structures.items():
+            for structure_id, info in structures.items():
+                self.structure_cache.put(bp.name, structure_id, info.structure_info)
+
+    def _get_structure(
+            self, bp: DataBlueprint, structure_id: str, match: Dict[str, str],
+            db_entries: Dict[tuple, dict]):
+        '''Returns StructureInfo of already built structure, structure from DB or a new one'''
+        id_info = self.structures[bp].get(structure_id)
+        if id_info:
+            return id_info.structure_info
+        # Check if there is a structure with the same ID in cache or DB
+        db_entry = db_entries.get((bp, structure_id))
+        if isinstance(db_entry, StructureInfo):
+            structure_info = db_entry
+            structure_info.is_new = False
+        elif db_entry:
+            structure_info = StructureInfo(bp.create(**db_entry), is_new=False)
+        else:
+            # Here we initialize an instance of bp with required args
+            # and further name it a structure. It's not necessary to format
+            # required fields after match because they can only be of str type
+            # and matcher always returns str
+            structure_info = StructureInfo(bp.create(**match))
+        self.structures[bp][structure_id] = self._StructureIdInfo(structure_info, {})
+        return structure_info
+
+    def _build_structure(
+            self, bp: DataBlueprint, structure_id: str, plan: NamedTuple,
+            db_entries: Dict[tuple, dict]) -> None:
+        '''Applies all changes of the structure at once'''
+        structure_info = self._get_structure(bp, structure_id, plan.match, db_entries)
+        structure = structure_info.structure
+        bp_info = self.blueprints[bp]
+        field_plan = bp_info.field_plan
+        # We need to check also optional fields on each file
+        # But there could be blueprint without optional fields
+        field_changes = {}
+        for file, mode in plan.changes:
+            if mode == 'modified':
+                if not structure_info.is_new:
+                    self._add_incremental_jobs(bp, structure_id, structure_info, file)
+                    continue
+                # Structure isn't in DB yet, so the file is new for it
+                mode = 'created'
+            optional_match = self.match_optional(bp_info, structure_info, file)
+            if not optional_match:
+                continue
+            for field in list(optional_match):
+                if field_plan[field].is_parser:
+                    # Parsers are run later for all structures at once.
+                    # Values of deleted files are never updated, so they aren't parsed
+                    del optional_match[field]
+                    if mode == 'created':
+                        self._add_parser_job(bp, structure_id, structure, field, (file,), mode)
+            # After match formatting
+            formatted_fields = self.format_fields(structure, file, optional_match)
+            for field, value in formatted_fields.items():
+                field_changes.setdefault(field, []).append((value, mode))
+        self._apply_field_changes(bp, structure_id, field_changes)
+
+    def _add_parser_job(
+            self, bp: DataBlueprint, structure_id: str, structure: DataBlueprint,
+            field: str, args: tuple, mode: str) -> None:
+        parser = getattr(structure, field).parser
+        if getattr(parser, 'incremental', False):
+            # Incremental values replace old ones without update rules of ParserField
+            self._parser_jobs.append(ParserJob(
+                (bp, structure_id, field, 'modified'), parser, args,
+                (bp.name, structure_id, field)))
+        else:
+            self._parser_jobs.append(ParserJob((bp, structure_id, field, mode), parser, args))
+
+    def _add_incremental_jobs(
+            self, bp: DataBlueprint, structure_id: str, structure_info: StructureInfo,
+            file: pathlib.Path) -> None:
+        '''Parses appended part of the grown file by incremental parsers of the structure'''
+        bp_info = self.blueprints[bp]
+        if not bp_info.incremental_parsers:
+            return
+        structure = structure_info.structure
+        path = file.absolute()
+        optional_match = self.match_optional(bp_info, structure_info, file)
+        for field_plan in bp_info.incremental_parsers:
+            if field_plan.dependents:
+                args = tuple(getattr(structure, f) for f in field_plan.dependents)
+                if path in args:
+                    self._add_parser_job(
+                        bp, structure_id, structure, field_plan.name, args, 'modified')
+            elif optional_match and field_plan.name in optional_match:
+                self._add_parser_job(
+                    bp, structure_id, structure, field_plan.name, (file,), 'modified')
+
+    def _apply_field_changes(
+            self, bp: DataBlueprint, structure_id: str, field_changes: Dict[str, list]) -> None:
+        structure_info = self.structures[bp][structure_id].structure_info
+        # Compare current field values with new ones
+        updates = self.get_field_updates(structure_info.structure, field_changes)
+        if not structure_info.is_new:
+            # Set updates for current structure_id
+            self.set_updates(bp, structure_id, updates)
+        # Set updated field values for current structure
+        self.set_fields(structure_info.structure, updates)
+
+    def run_matched_parsers(self) -> None:
+        '''Runs parsers of ParserFields matched by files and applies their values'''
+        jobs, self._parser_jobs = self._parser_jobs, []
+        changes = {}
+        for result in self.parser_runner.run(jobs):
+            if result.error is not None:
+                continue  # Failed file doesn't stop the batch
+            bp, structure_id, field, mode = result.key
+            if mode == 'modified':
+                self._set_parsed_value(bp, structure_id, field, result.value)
+                continue
+            structure_changes = changes.setdefault((bp, structure_id), {})
+            structure_changes.setdefault(field, []).append((result.value, mode))
+        for (bp, structure_id), field_changes in changes.items():
+            self._apply_field_changes(bp, structure_id, field_changes)
+
+    @staticmethod
+    def get_field_updates(structure: DataBlueprint, field_changes: Dict[str, list]) -> dict:
+        '''
+        Merges all (value, mode) changes of each field into a single update.
+        Each change is compared with the value updated by the previous ones.
+        '''
+        plan = structure.field_plan()
+        updates = {}
+        for field, changes in field_changes.items():
+            update = plan[field].update_many(getattr(structure, field), changes)
+            if update is not NoUpdate:
+                updates[field] = update
+        return updates
+
+    @staticmethod
+    def match_optional(
+            bp_info: BlueprintInfo, structure_info: StructureInfo,
+            file: pathlib.Path) -> Dict[str, str]:
+        '''Matches optional fields of the structure by its match_scheme or blueprint template'''
+        if structure_info.scheme_matcher:
+            return structure_info.scheme_matcher.match(file.name)
+        if bp_info.template_matcher:
+            structure = structure_info.structure
+            values = {
+                name: str(getattr(structure, name))
+                for name in bp_info.template_matcher.placeholders}
+            return bp_info.template_matcher.match(file.name, values)
+        return {}
 
     @staticmethod
     def format_fields(structure: DataBlueprint, file: pathlib.Path, match: Dict[str, str],) -> None:
         '''
         Formats structure field values based on matched values and type annotations
-        using FieldsTransformer
+        using field plan of the blueprint
         '''
-        field_types = {f: structure.get_field_type(f) for f in match}
+        plan = structure.field_plan()
         formatted_fields = {}
         for field, matched_value in match.items():
-            f_type = field_types[field]
             field_default = getattr(structure, field)
-            # ParserField parsers now run in any mode, and it's bad
-            formatted_fields[field] = FieldsTransformer.after_match(f_type, file,
-                                                                    matched_value,
-                                                                    field_default=field_default)
+            formatted_fields[field] = plan[field].after_match(
+                file, matched_value, field_default=field_default)
         return formatted_fields
 
-    @staticmethod
-    def get_updates(structure: DataBlueprint, matched_fields, mode):
-        updates = {}
-        for field, new_value in matched_fields.items():
-            f_type = structure.get_field_type(field)
-            old_value = getattr(structure, field)
-            update = FieldsTransformer.update(f_type, old_value, new_value, mode)
-            if not update == NoUpdate:
-                updates[field] = update
-        return updates
-
     def set_updates(self, bp: DataBlueprint, id: str, updates: dict):
         self.structures[bp][id].updates.update(updates)
 
@@ -219,35 +681,254 @@ class BlueprintBuilder:
             setattr(structure, field, new_value)
 
     def update_parser_fields(self) -> None:
-        '''Updates ParserFields with dependent fields in all structures'''
-        for bp, structures in self.structures.items():
-            for structure_id, info in structures.items():
-                structure = info.structure_info.structure
-                updates = {}
-                parser_fields = [
-                    getattr(structure, field.name)
-                    for field in fields(structure)
-                    if structure.get_field_type(field.name).__name__ == 'ParserField']
-                # Select only pf with dependent_fields and without value set
-                parser_fields = [
-                    pf for pf in parser_fields
-                    if pf.dependent_fields and not pf.value]
-                for pf in parser_fields:
-                    if structure.fields_are_set(*pf.dependent_fields):
-                        args = [getattr(structure, f) for f in pf.dependent_fields]
-                        # Parsed values are auto set to pf value attr
-                        pf.parse_value(*args)
-                        updates[pf.name] = pf.value
-                #  This pf processing is the worst place of the module
-                self.set_updates(bp, structure_id, updates)
+        '''
+        Updates ParserFields with dependent fields in all structures level by level
+        of their dependency graph. Field is parsed when it has no value yet or when
+        any of its dependencies has changed in this build. Fields of a level
+        are independent, so they're run together
+        '''
+        # Changed fields of each structure, changed parsed values are added here too
+        changed = {
+            (bp, structure_id): set(info.updates)
+            for bp, structures in self.structures.items()
+            for structure_id, info in structures.items()}
+        depth = max(
+            (len(self.blueprints[bp].parser_levels) for bp in self.structures), default=0)
+        for level in range(depth):
+            jobs = []
+            for bp, structures in self.structures.items():
+                bp_info = self.blueprints[bp]
+                if level >= len(bp_info.parser_levels):
+                    continue
+                for structure_id, info in structures.items():
+                    structure = info.structure_info.structure
+                    structure_changed = changed[(bp, structure_id)]
+                    for field_plan in bp_info.parser_levels[level]:
+                        job = self._parser_field_job(
+                            bp, structure_id, structure, field_plan, structure_changed)
+                        if job:
+                            jobs.append(job)
+            # All parsers of the level are run together
+            for result in self.parser_runner.run(jobs):
+                if result.error is not None:
+                    continue
+                bp, structure_id, name = result.key
+                structure = self.structures[bp][structure_id].structure_info.structure
+                if getattr(structure, name).value != result.value:
+                    self._set_parsed_value(bp, structure_id, name, result.value)
+                    changed[(bp, structure_id)].add(name)
+
+    def _parser_field_job(
+            self, bp: DataBlueprint, structure_id: str, structure: DataBlueprint,
+            field_plan: NamedTuple, changed: set) -> ParserJob | None:
+        '''Returns job for ParserField which must be parsed or None'''
+        pf = getattr(structure, field_plan.name)
+        if not structure.fields_are_set(*field_plan.dependents):
+            return None
+        if pf.value and changed.isdisjoint(field_plan.dependents):
+            return None
+        if pf.lazy:
+            # Lazy fields are parsed on read, DB knows only they are pending
+            if pf.value != LAZY_PENDING:
+                self._set_parsed_value(bp, structure_id, field_plan.name, LAZY_PENDING)
+                changed.add(field_plan.name)
+            return None
+        plan = self.blueprints[bp].field_plan
+        # ParserFields are passed to parsers by their values
+        args = tuple(
+            getattr(structure, f).value if f in plan and plan[f].is_parser
+            else getattr(structure, f)
+            for f in field_plan.dependents)
+        state_key = (bp.name, structure_id, field_plan.name) \
+            if getattr(pf.parser, 'incremental', False) else None
+        return ParserJob((bp, structure_id, field_plan.name), pf.parser, args, state_key)
+
+    def _set_parsed_value(self, bp: DataBlueprint, structure_id: str, name: str, value) -> None:
+        pf = getattr(self.structures[bp][structure_id].structure_info.structure, name)
+        pf.value = value
+        #  This pf processing is the worst place of the module
+        self.set_updates(bp, structure_id, {name: pf.value})
+
+    def close(self):
+        self.parser_runner.close()
 
     def clear_structures(self):
         self.structures = {bp: {} for bp in self.blueprints}
 
 
+class _BufferedDatabaseManager(DatabaseManager):
+    '''
+    DatabaseManager of worker processes. Reads are served from entries
+    prefetched by the main process and writes are recorded to be applied there.
+    '''
+    def __init__(self, entries: dict):
+        super().__init__(None)
+        self.entries = entries
+        self.writes = []
+
+    def add_blueprint(self, entry):
+        self.writes.append(('add_blueprint', (entry,)))
+
+    def add_many(self, entries):
+        self.writes.append(('add_many', (entries,)))
+
+    def get_blueprint(self, name, id):
+        return self.entries.get((name, id))
+
+    def get_many(self, name, ids, resolve: bool = True):
+        return {id: self.entries[(name, id)] for id in ids if (name, id) in self.entries}
+
+    def update_blueprint(self, name, id, updates):
+        self.writes.append(('update_blueprint', (name, id, updates)))
+
+
+_Batch = namedtuple('_Batch', 'created deleted')
+_worker_builders = {}
+
+
+def _init_worker(blueprints):
+    # Builder for each blueprint, so a file is processed only for
+    # blueprints whose structures are assigned to this worker
+    for bp in blueprints:
+        _worker_builders[bp.name] = BlueprintBuilder(
+            None, None, blueprints=[bp], bulk=False, structure_cache=StructureCache(0))
+
+
+def _build_partition(partition: dict, entries: dict):
+    db_manager = _BufferedDatabaseManager(entries)
+    db_updater = BlueprintsDBUpdater(db_manager)
+    for bp_name, (created, deleted) in partition.items():
+        builder = _worker_builders[bp_name]
+        builder.db_manager = db_manager
+        builder.db_updater = db_updater
+        builder.build(_Batch(created, deleted))
+    return db_manager.writes
+
+
+class PartitionedBuilderPool:
+    '''
+    Kraken listener which builds blueprints in [workers] processes.
+    Changes are partitioned by structure: files with the same required fields
+    match always go to the same worker, which runs its own BlueprintBuilder.
+    Existing DB entries are fetched before dispatch and all writes returned
+    by workers are applied here, so DB has a single writer.
+    Blueprints and parsers must be importable by worker processes.
+    '''
+    def __init__(
+            self,
+            db_manager: DatabaseManager,
+            kraken: Kraken = None,
+            blueprints: list[DataBlueprint] | None = None,
+            workers: int | None = None,
+            sources: list[str] | None = None,
+            path_prefixes: list[str | pathlib.Path] | None = None):
+        self.db_manager = db_manager
+        self.workers = workers or os.cpu_count()
+        self.blueprints = {bp: BlueprintInfo(bp) for bp in blueprints} if blueprints else {}
+        self.blueprint_index = BlueprintIndex(self.blueprints)
+        for bp in self.blueprints:
+            register_lazy_fields(db_manager, bp)
+        self._executors = []
+        self.sources = sources
+        self.path_prefixes = path_prefixes
+        self.kraken = kraken
+        if self.kraken:
+            self._subscribe()
+
+    def listen(self, info):
+        if isinstance(info, FileChangesInfo):
+            self.build(info.changes)
+
+    def set_kraken(self, kraken: Kraken):
+        self.kraken = kraken
+        self._subscribe()
+
+    def _subscribe(self):
+        self.kraken.subscribe(
+            self.listen, info_types=FileChangesInfo,
+            sources=self.sources, path_prefixes=self.path_prefixes)
+
+    def register_blueprint(self, blueprint: DataBlueprint):
+        self.blueprints[blueprint] = BlueprintInfo(blueprint)
+        self.blueprint_index.add(blueprint, self.blueprints[blueprint])
+        register_lazy_fields(self.db_manager, blueprint)
+        # Workers are initialized with blueprints, so they must be restarted
+        self.close()
+
+    def _start_workers(self):
+        blueprints = list(self.blueprints)
+        self._executors = [
+            ProcessPoolExecutor(1, initializer=_init_worker, initargs=(blueprints,))
+            for _ in range(self.workers)]
+
+    def _worker_index(self, bp: DataBlueprint, structure_id: str) -> int:
+        # crc32 is stable between processes and runs unlike hash()
+        return zlib.crc32(f'{bp.name}__{structure_id}'.encode()) % self.workers
+
+    def partition(self, data: NamedTuple):
+        '''Returns worker partitions of changes and structure keys for each of them'''
+        partitions = [{} for _ in range(self.workers)]
+        keys = [set() for _ in range(self.workers)]
+        for mode in ('created', 'deleted'):
+            files = getattr(data, mode)
+            for bp, file, match in match_blueprints(self.blueprints, files, self.blueprint_index):
+                structure_id = '__'.join(match.values())
+                index = self._worker_index(bp, structure_id)
+                batch = partitions[index].setdefault(bp.name, _Batch([], []))
+                getattr(batch, mode).append(file)
+                keys[index].add((bp.name, structure_id))
+        return partitions, keys
+
+    def build(self, data: NamedTuple):
+        if not self._executors:
+            self._start_workers()
+        partitions, keys = self.partition(data)
+        futures = []
+        # Existing entries of all partitions are fetched with one query for each blueprint
+        ids = {}
+        for name, structure_id in set().union(*keys):
+            ids.setdefault(name, []).append(structure_id)
+        entries = {}
+        for name, name_ids in ids.items():
+            found = self.db_manager.get_many(name, name_ids, resolve=False)
+            for structure_id, entry in found.items():
+                entries[(name, structure_id)] = entry
+        for executor, partition, partition_keys in zip(self._executors, partitions, keys):
+            if not partition:
+                continue
+            partition_entries = {key: entries[key] for key in partition_keys if key in entries}
+            futures.append(executor.submit(_build_partition, partition, partition_entries))
+        # Workers own different structures, so order of writes between them doesn't matter
+        updated = {}
+        for future in futures:
+            for method, args in future.result():
+                getattr(self.db_manager, method)(*args)
+                if method == 'add_many':
+                    written = [(entry['blueprint'], entry['id']) for entry in args[0]]
+                elif method == 'add_blueprint':
+                    written = [(args[0]['blueprint'], args[0]['id'])]
+                else:
+                    written = [args[:2]]
+                for entry_name, entry_id in written:
+                    updated.setdefault(entry_name, []).append(entry_id)
+        if self.kraken:
+            for name, ids in updated.items():
+                self.kraken.release_threadsafe(BlueprintsUpdatedInfo(name, ids))
+
+    def close(self):
+        for executor in self._executors:
+            executor.shutdown()
+        self._executors = []
+
+
 __all__ = [
     'BlueprintsDBUpdater',
     'BlueprintInfo',
     'StructureInfo',
-    'BlueprintBuilder'
+    'StructureCache',
+    'BlueprintIndex',
+    'register_lazy_fields',
+    'match_blueprints',
+    'BlueprintBuilder',
+    'PartitionedBuilderPool'
 ]
@@ -1,9 +1,14 @@
+import asyncio
+import threading
 from abc import ABC, abstractmethod
 from tinydb import TinyDB, Query, where
 from tinydb.storages import JSONStorage
 from tinydb_serialization import SerializationMiddleware
 from tinydb_serialization.serializers import DateTimeSerializer
 
+# FilesKraken modules
+from fields import LAZY_PENDING
+
 # I think this serialization shoould be moved in separate file
 serialization = SerializationMiddleware(JSONStorage)
 serialization.register_serializer(DateTimeSerializer(), 'TinyDate')
@@ -22,6 +27,93 @@ class Database(ABC):
     def update_blueprint(self, name, id, updates):
         pass
 
+    def get_many(self, name, ids):
+        '''
+        Returns entries of blueprint with any of ids.
+        Backends should override it with a single query, e.g. IN (...) for SQL
+        '''
+        return [entry for id in set(ids) for entry in self.get_blueprint(name, id)]
+
+    def add_many(self, entries):
+        '''
+        Adds many entries at once.
+        Backends should override it with a single bulk insert
+        '''
+        for entry in entries:
+            self.add_blueprint(entry)
+
+    def is_empty(self) -> bool:
+        '''
+        Tells builder that it can ingest files in bulk mode.
+        By default it's unknown, so DB is considered not empty
+        '''
+        return False
+
+
+class AsyncDatabase(ABC):
+    '''Database interface for asyncio drivers'''
+    @abstractmethod
+    async def add_blueprint(self, blueprint):
+        pass
+
+    @abstractmethod
+    async def get_blueprint(self, name, id):
+        pass
+
+    @abstractmethod
+    async def update_blueprint(self, name, id, updates):
+        pass
+
+    async def get_many(self, name, ids):
+        return [entry for id in set(ids) for entry in await self.get_blueprint(name, id)]
+
+    async def add_many(self, entries):
+        for entry in entries:
+            await self.add_blueprint(entry)
+
+    async def is_empty(self) -> bool:
+        return False
+
+
+class BlockingDatabase(Database):
+    '''
+    Allows blocking components (BlueprintBuilder) to use AsyncDatabase.
+    Calls are scheduled on the event loop, so they must be made
+    from other threads, e.g. from listeners run by AsyncKraken.
+    '''
+    def __init__(self, db: AsyncDatabase, loop: asyncio.AbstractEventLoop = None):
+        self.db = db
+        self.loop = loop
+
+    def _run(self, coroutine):
+        if self.loop is None:
+            raise RuntimeError('Event loop is not set for BlockingDatabase')
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    def add_blueprint(self, blueprint):
+        return self._run(self.db.add_blueprint(blueprint))
+
+    def get_blueprint(self, name, id):
+        return self._run(self.db.get_blueprint(name, id))
+
+    def update_blueprint(self, name, id, updates):
+        return self._run(self.db.update_blueprint(name, id, updates))
+
+    def get_many(self, name, ids):
+        return self._run(self.db.get_many(name, ids))
+
+    def add_many(self, entries):
+        return self._run(self.db.add_many(entries))
+
+    def is_empty(self) -> bool:
+        return self._run(self.db.is_empty())
+
+    def remove_blueprint(self, name, id):
+        return self._run(self.db.remove_blueprint(name, id))
+
+    def all(self):
+        return self._run(self.db.all())
+
 
 class JsonDatabse(Database, TinyDB):
     def __init__(self, file, *args, **kwargs):
@@ -31,47 +123,273 @@ class JsonDatabse(Database, TinyDB):
     def add_blueprint(self, blueprint):
         self.blueprints.insert(blueprint)
 
+    def add_many(self, entries):
+        # One insert means one rewrite of the json file
+        self.blueprints.insert_multiple(entries)
+
     def get_blueprint(self, name, id):
         query = Query()
         return self.blueprints.search(
-            (query.blueprint == name) and (query.id == id))
+            (query.blueprint == name) & (query.id == id))
+
+    def get_many(self, name, ids):
+        # Single table scan with set lookup of ids
+        query = Query()
+        return self.blueprints.search(
+            (query.blueprint == name) & query.id.one_of(set(ids)))
 
     def update_blueprint(self, name, id, updates):
         self.blueprints.update(updates, ((where('blueprint') == name) & (where('id') == id)))
 
     def remove_blueprint(self, name, id):
         query = Query()
-        self.blueprints.remove((query.blueprint == name) and (query.id == id))
+        self.blueprints.remove((query.blueprint == name) & (query.id == id))
 
     def all(self):
         return self.blueprints.all()
 
+    def is_empty(self) -> bool:
+        return len(self.blueprints) == 0
+
+
+class LazyFieldsResolver:
+    '''
+    Computes lazy ParserFields of DB entries for DatabaseManager and AsyncDatabaseManager.
+    Resolvers are registered by data_organizer.register_lazy_fields
+    '''
+    def register_lazy_field(self, name, field, resolve):
+        self.lazy_fields.setdefault(name, {})[field] = resolve
+
+    def _is_pending(self, entry) -> bool:
+        lazy_fields = self.lazy_fields.get(entry.get('blueprint'), ())
+        return any(entry.get(field) == LAZY_PENDING for field in lazy_fields)
 
-class DatabaseManager:
+    def _lazy_updates(self, entry) -> dict:
+        '''Returns computed values of pending lazy fields of the entry'''
+        name, id = entry['blueprint'], entry['id']
+        updates = {}
+        for field, resolve in self.lazy_fields[name].items():
+            if entry.get(field) != LAZY_PENDING:
+                continue
+            try:
+                updates[field] = resolve(entry)
+            except Exception as e:
+                print(f'WARNING: lazy field {field} of {name} {id} failed: {e!r}')
+        return updates
+
+
+class DatabaseManager(LazyFieldsResolver):
     def __init__(self, db: Database):
         self.db = db
+        # Resolvers of lazy ParserFields: {blueprint name: {field: resolve(entry)}}
+        self.lazy_fields = {}
+        # Entries with pending lazy fields, None until DB is scanned for them
+        self._pending = None
+        # Builder and LazyFieldsFiller may use manager from different threads
+        self.lock = threading.RLock()
+        # Called with (name, id) of each written entry, e.g. to invalidate caches
+        self.write_hooks = []
+
+    def _written(self, name, id):
+        for hook in self.write_hooks:
+            hook(name, id)
+
+    def _track_pending(self, name, id, values):
+        if self._pending is not None and name in self.lazy_fields and \
+                LAZY_PENDING in values.values():
+            self._pending[(name, id)] = None
+
+    def _resolve_lazy(self, entry):
+        '''Computes pending lazy fields of the entry and writes them to DB'''
+        if not entry or not self._is_pending(entry):
+            return entry
+        name, id = entry['blueprint'], entry['id']
+        # Parsers are run without lock, so builder isn't blocked by them
+        updates = self._lazy_updates(entry)
+        if updates:
+            with self.lock:
+                self.db.update_blueprint(name, id, updates)
+                self._written(name, id)
+            entry.update(updates)
+        if self._pending is not None:
+            self._pending.pop((name, id), None)
+        return entry
+
+    def fill_lazy(self, limit: int = None) -> int:
+        '''Computes lazy fields of up to [limit] pending entries, returns their number'''
+        with self.lock:
+            if self._pending is None:
+                self._pending = {
+                    (entry['blueprint'], entry['id']): None
+                    for entry in self.db.all() if self._is_pending(entry)}
+            keys = list(self._pending)[:limit]
+        for name, id in keys:
+            self._resolve_lazy(self.get_raw(name, id))
+            # Entry could be removed
+            self._pending.pop((name, id), None)
+        return len(keys)
 
     def add_blueprint(self, entry):
-        self.db.add_blueprint(entry)
+        with self.lock:
+            self.db.add_blueprint(entry)
+            self._track_pending(entry['blueprint'], entry['id'], entry)
+            self._written(entry['blueprint'], entry['id'])
 
-    def get_blueprint(self, name, id):
-        query = self.db.get_blueprint(name, id)
+    def add_many(self, entries):
+        with self.lock:
+            self.db.add_many(entries)
+            for entry in entries:
+                self._track_pending(entry['blueprint'], entry['id'], entry)
+                self._written(entry['blueprint'], entry['id'])
+
+    def is_empty(self) -> bool:
+        with self.lock:
+            return self.db.is_empty()
+
+    def get_raw(self, name, id):
+        '''Returns entry without computing its lazy fields'''
+        with self.lock:
+            query = self.db.get_blueprint(name, id)
         if query:
             return query[0]
 
+    def get_blueprint(self, name, id):
+        return self._resolve_lazy(self.get_raw(name, id))
+
     def update_blueprint(self, name, id, updates):
-        self.db.update_blueprint(name, id, updates)
+        with self.lock:
+            self.db.update_blueprint(name, id, updates)
+            self._track_pending(name, id, updates)
+            self._written(name, id)
+
+    def get_many(self, name, ids, resolve: bool = True) -> dict:
+        '''
+        Returns {id: entry} for ids found in DB.
+        With resolve=False lazy fields aren't computed, it's used by builders.
+        '''
+        entries = {}
+        with self.lock:
+            found = self.db.get_many(name, ids)
+        for entry in found:
+            entries.setdefault(entry['id'], entry)
+        if resolve:
+            for entry in entries.values():
+                self._resolve_lazy(entry)
+        return entries
 
     def remove_blueprint(self, name, id):
-        self.db.remove_blueprint(name, id)
+        with self.lock:
+            self.db.remove_blueprint(name, id)
+            self._written(name, id)
 
     def get_all(self):
-        return self.db.all()
+        with self.lock:
+            entries = self.db.all()
+        return [self._resolve_lazy(entry) for entry in entries]
+
+
+class LazyFieldsFiller:
+    '''
+    Computes pending lazy fields in a background thread, so they are ready
+    before they are read. Each [interval] seconds up to [batch] entries are filled.
+    '''
+    def __init__(self, db_manager: DatabaseManager, batch: int = 10, interval: float = 1):
+        self.db_manager = db_manager
+        self.batch = batch
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.db_manager.fill_lazy(self.batch)
+            except Exception as e:
+                print(f'WARNING: LazyFieldsFiller failed: {e!r}')
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='LazyFieldsFiller', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+
+class AsyncDatabaseManager(LazyFieldsResolver):
+    '''
+    DatabaseManager API for asyncio applications.
+    Blocking Database calls are run in threads one by one,
+    because most of drivers (like TinyDB) are not thread safe.
+    Lazy fields are computed on read like in DatabaseManager, parsers are run in threads.
+    '''
+    def __init__(self, db: AsyncDatabase | Database):
+        self.db = db
+        self.lazy_fields = {}
+        self._is_async = isinstance(db, AsyncDatabase)
+        self._lock = threading.Lock()
+
+    def _locked(self, method, *args):
+        with self._lock:
+            return method(*args)
+
+    async def _call(self, method_name, *args):
+        method = getattr(self.db, method_name)
+        if self._is_async:
+            return await method(*args)
+        return await asyncio.to_thread(self._locked, method, *args)
+
+    async def _resolve_lazy(self, entry):
+        '''Computes pending lazy fields of the entry and writes them to DB'''
+        if not entry or not self._is_pending(entry):
+            return entry
+        updates = await asyncio.to_thread(self._lazy_updates, entry)
+        if updates:
+            await self._call('update_blueprint', entry['blueprint'], entry['id'], updates)
+            entry.update(updates)
+        return entry
+
+    async def add_blueprint(self, entry):
+        await self._call('add_blueprint', entry)
+
+    async def add_many(self, entries):
+        await self._call('add_many', entries)
+
+    async def get_blueprint(self, name, id):
+        query = await self._call('get_blueprint', name, id)
+        if query:
+            return await self._resolve_lazy(query[0])
+
+    async def update_blueprint(self, name, id, updates):
+        await self._call('update_blueprint', name, id, updates)
+
+    async def get_many(self, name, ids, resolve: bool = True) -> dict:
+        entries = {}
+        for entry in await self._call('get_many', name, ids):
+            entries.setdefault(entry['id'], entry)
+        if resolve:
+            for entry in entries.values():
+                await self._resolve_lazy(entry)
+        return entries
+
+    async def remove_blueprint(self, name, id):
+        await self._call('remove_blueprint', name, id)
+
+    async def get_all(self):
+        return [await self._resolve_lazy(entry) for entry in await self._call('all')]
 
 
 __all__ = [
     'serialization',
     'Database',
+    'AsyncDatabase',
+    'BlockingDatabase',
     'JsonDatabse',
-    'DatabaseManager'
+    'LazyFieldsResolver',
+    'DatabaseManager',
+    'LazyFieldsFiller',
+    'AsyncDatabaseManager'
 ]
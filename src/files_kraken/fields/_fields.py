@@ -1,21 +1,474 @@
+import json
+import mmap
+import os
 import pathlib
-from dataclasses import dataclass
-from typing import List, Any, Optional, Pattern, Union
+import sqlite3
+import time
+from collections import namedtuple
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass, fields
+from typing import List, Any, Optional, Pattern, Union, ClassVar
 
 # FilesKraken modules
 from functions import get_all_subclasses
 
 
 class DataParser:
+    # 'cpu' parsers are run in processes by ParserRunner, 'io' ones in threads
+    bound: ClassVar[str] = 'io'
+    # Bump it when parser output changes to invalidate ParserCache entries
+    version: ClassVar[int | str] = 0
+    # Mapped parsers get MappedFile instead of each pathlib.Path argument
+    mapped: ClassVar[bool] = False
+
     @staticmethod
     def parse(*args, **kwargs):
         pass
 
 
+class IncrementalParser(DataParser):
+    '''
+    Parser of files which only grow, like logs. With ParserStates of ParserRunner
+    it keeps the offset of parsed bytes and the state for each structure field,
+    so only appended bytes are parsed. The file is the first pathlib.Path argument.
+    State must be serializable to json to be saved between runs.
+    '''
+    incremental: ClassVar[bool] = True
+
+    @staticmethod
+    def initial_state() -> Any:
+        return None
+
+    @staticmethod
+    def parse_appended(state: Any, data: memoryview) -> tuple[Any, int]:
+        '''
+        Returns new state and the number of consumed bytes of [data].
+        Incomplete last line can be left for the next call.
+        '''
+        raise NotImplementedError
+
+    @staticmethod
+    def value(state: Any) -> Any:
+        return state
+
+    @classmethod
+    def parse(cls, file, *args):
+        with open(file, 'rb') as f:
+            state, _ = cls.parse_appended(cls.initial_state(), memoryview(f.read()))
+        return cls.value(state)
+
+
+class ParserStates:
+    '''
+    States of incremental parsers stored in sqlite file [path]: offset of parsed bytes,
+    inode of the parsed file and parser state for each (blueprint, structure id, field).
+    The database is opened at the first use.
+    '''
+    def __init__(self, path: str | pathlib.Path):
+        self.path = path
+        self._connection = None
+
+    @property
+    def connection(self):
+        if self._connection is None:
+            self._connection = sqlite3.connect(str(self.path), check_same_thread=False)
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS states ('
+                'key TEXT PRIMARY KEY, offset INTEGER, inode INTEGER, state TEXT)')
+        return self._connection
+
+    def get(self, key: tuple) -> Optional[tuple]:
+        '''Returns (offset, inode, state) or None'''
+        row = self.connection.execute(
+            'SELECT offset, inode, state FROM states WHERE key = ?', (json.dumps(key),)).fetchone()
+        if row is None:
+            return None
+        return row[0], row[1], json.loads(row[2])
+
+    def put(self, key: tuple, record: tuple) -> None:
+        offset, inode, state = record
+        self.connection.execute(
+            'INSERT OR REPLACE INTO states VALUES (?, ?, ?, ?)',
+            (json.dumps(key), offset, inode, json.dumps(state)))
+
+    def remove(self, key: tuple) -> None:
+        self.connection.execute('DELETE FROM states WHERE key = ?', (json.dumps(key),))
+
+    def commit(self) -> None:
+        if self._connection is not None:
+            self._connection.commit()
+
+    def close(self) -> None:
+        if self._connection is not None:
+            self._connection.commit()
+            self._connection.close()
+            self._connection = None
+
+
+class MappedFile:
+    '''
+    Read-only memory map of a file for mapped parsers. Data isn't read until it's
+    accessed and slices of [data] memoryview and lines don't copy it.
+    It can be used as a path too, e.g. open(mapped_file).
+    '''
+    def __init__(self, path: str | pathlib.Path):
+        self.path = pathlib.Path(path)
+        with open(self.path, 'rb') as f:
+            try:
+                self._buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:  # Empty file can't be mapped
+                self._buffer = b''
+        self.data = memoryview(self._buffer)
+
+    def __len__(self):
+        return len(self.data)
+
+    def __fspath__(self):
+        return str(self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def lines(self, start: int = 0):
+        '''Yields memoryviews of lines without line breaks from [start] offset'''
+        find, size = self._buffer.find, len(self.data)
+        while start < size:
+            end = find(b'\n', start)
+            if end == -1:
+                end = size
+            yield self.data[start:end]
+            start = end + 1
+
+    def head(self, n: int = 1) -> list[memoryview]:
+        '''Returns the first [n] lines'''
+        lines = []
+        for line in self.lines():
+            if len(lines) == n:
+                break
+            lines.append(line)
+        return lines
+
+    def tail(self, n: int = 1) -> list[memoryview]:
+        '''Returns the last [n] lines, the file isn't read from the start'''
+        rfind = self._buffer.rfind
+        end = len(self.data)
+        if end and self.data[end - 1] == ord('\n'):
+            end -= 1  # Trailing line break doesn't start a new line
+        lines = []
+        while end > 0 and len(lines) < n:
+            start = rfind(b'\n', 0, end) + 1
+            lines.append(self.data[start:end])
+            end = start - 1
+        return lines[::-1]
+
+    def close(self):
+        self.data.release()
+        if isinstance(self._buffer, mmap.mmap):
+            try:
+                self._buffer.close()
+            except BufferError:
+                # Parser kept a slice of data, map is closed when it's collected
+                pass
+
+
+def call_parser(parser: DataParser, args: tuple):
+    '''Calls parser, maps path arguments of mapped parsers for this call'''
+    if not getattr(parser, 'mapped', False):
+        return parser.parse(*args)
+    files = {}
+    try:
+        return parser.parse(*_map_args(args, files))
+    finally:
+        for file in files.values():
+            file.close()
+
+
+def _map_args(args: tuple, files: dict) -> tuple:
+    '''Replaces pathlib.Path arguments by MappedFiles shared through [files]'''
+    mapped_args = []
+    for arg in args:
+        if isinstance(arg, pathlib.PurePath):
+            if arg not in files:
+                files[arg] = MappedFile(arg)
+            arg = files[arg]
+        mapped_args.append(arg)
+    return tuple(mapped_args)
+
+
+# state_key identifies the state of incremental parser, e.g. (blueprint, id, field)
+ParserJob = namedtuple('ParserJob', 'key parser args state_key', defaults=(None,))
+ParserResult = namedtuple('ParserResult', 'key value error time')
+
+
+def _run_parser(parser: DataParser, args: tuple, mapped: bool = False):
+    # Arguments of mapped parsers in processes are mapped by worker
+    start = time.perf_counter()
+    value = parser.parse(*args) if mapped else call_parser(parser, args)
+    return value, time.perf_counter() - start
+
+
+def _run_incremental(parser: IncrementalParser, args: tuple, record: Optional[tuple]):
+    '''Parses bytes appended after the offset of [record], returns value and new record'''
+    start = time.perf_counter()
+    file = next(arg for arg in args if isinstance(arg, pathlib.PurePath))
+    stat = os.stat(file)
+    offset, inode, state = record if record else (0, None, None)
+    # Replaced or truncated file is parsed from the start
+    if record is None or inode != stat.st_ino or stat.st_size < offset:
+        offset, state = 0, parser.initial_state()
+    if stat.st_size > offset:
+        with open(file, 'rb') as f:
+            f.seek(offset)
+            data = f.read(stat.st_size - offset)
+        state, consumed = parser.parse_appended(state, memoryview(data))
+        offset += consumed
+    return (parser.value(state), (offset, stat.st_ino, state)), time.perf_counter() - start
+
+
+class ParserCache:
+    '''
+    Persistent cache of parser results stored in sqlite file [path].
+    Result is keyed by parser name and version and by identity of each pathlib.Path
+    argument: absolute path, size, mtime_ns and inode. So any change of the file
+    or parser version is a miss. Other arguments are a part of the key as is.
+    Jobs with arguments or values not serializable to json aren't cached.
+    When there are more than [max_entries] results, least recently used are evicted.
+    '''
+    def __init__(self, path: str | pathlib.Path, max_entries: int = 100_000):
+        self.path = path
+        self.max_entries = max_entries
+        self.connection = sqlite3.connect(str(path), check_same_thread=False)
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS results ('
+            'key TEXT PRIMARY KEY, parser TEXT, value TEXT, used INTEGER)')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS results_used ON results (used)')
+        self._clock = self.connection.execute(
+            'SELECT COALESCE(MAX(used), 0) FROM results').fetchone()[0]
+        self._used = {}
+        self.counters = {'hits': 0, 'misses': 0, 'stores': 0, 'evictions': 0}
+
+    @staticmethod
+    def _identity(arg):
+        if isinstance(arg, pathlib.PurePath):
+            stat = os.stat(arg)
+            return ['file', os.path.abspath(arg), stat.st_size, stat.st_mtime_ns, stat.st_ino]
+        if isinstance(arg, (list, tuple)):
+            return [ParserCache._identity(item) for item in arg]
+        return arg
+
+    def key(self, parser_name: str, version, args: tuple) -> Optional[str]:
+        '''Returns key of the job or None if it can't be cached'''
+        try:
+            return json.dumps([parser_name, version, [self._identity(arg) for arg in args]])
+        except (OSError, TypeError, ValueError):
+            return None
+
+    def get(self, key: str):
+        '''Returns (True, value) for cached result, otherwise (False, None)'''
+        row = self.connection.execute(
+            'SELECT value FROM results WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            self.counters['misses'] += 1
+            return False, None
+        self.counters['hits'] += 1
+        self._clock += 1
+        self._used[key] = self._clock
+        return True, json.loads(row[0])
+
+    def put(self, key: str, parser_name: str, value) -> None:
+        try:
+            value = json.dumps(value)
+        except (TypeError, ValueError):
+            return
+        self._clock += 1
+        self.connection.execute(
+            'INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)',
+            (key, parser_name, value, self._clock))
+        self.counters['stores'] += 1
+
+    def flush(self) -> None:
+        '''Saves usage of hit results, evicts exceeding ones and commits'''
+        if self._used:
+            self.connection.executemany(
+                'UPDATE results SET used = ? WHERE key = ?',
+                [(used, key) for key, used in self._used.items()])
+            self._used = {}
+        excess = self.connection.execute(
+            'SELECT COUNT(*) FROM results').fetchone()[0] - self.max_entries
+        if excess > 0:
+            self.connection.execute(
+                'DELETE FROM results WHERE key IN '
+                '(SELECT key FROM results ORDER BY used LIMIT ?)', (excess,))
+            self.counters['evictions'] += excess
+        self.connection.commit()
+
+    def invalidate(self, parser_name: str = None) -> None:
+        '''Removes results of the parser or all results'''
+        if parser_name is None:
+            self.connection.execute('DELETE FROM results')
+        else:
+            self.connection.execute('DELETE FROM results WHERE parser = ?', (parser_name,))
+        self._used = {}
+        self.connection.commit()
+
+    def __len__(self):
+        return self.connection.execute('SELECT COUNT(*) FROM results').fetchone()[0]
+
+    def close(self) -> None:
+        self.flush()
+        self.connection.close()
+
+
+class ParserRunner:
+    '''
+    Runs parser jobs collected during a build. Parsers with bound = 'cpu' are run in
+    a process pool of [processes] workers, others in a thread pool of [threads] workers.
+    Without workers of the kind jobs are run one by one. Parsers run in processes
+    must be importable by workers.
+    Failed job doesn't stop the others: its result has an error and no value.
+    With ParserCache results of unchanged files are taken from it without running parsers.
+    Files of mapped parsers run in this process are mapped once and shared
+    until release_files() is called.
+    With ParserStates incremental parsers of jobs with state_key parse only appended bytes.
+    '''
+    def __init__(
+            self, processes: int = 0, threads: int = 0,
+            cache: ParserCache = None, states: ParserStates = None):
+        self.processes = processes
+        self.threads = threads
+        self.cache = cache
+        self.states = states
+        self._process_pool = None
+        self._thread_pool = None
+        self._mapped_files = {}
+        # Parser name: calls, failures and cumulative time of successful calls
+        self.stats = {}
+
+    def _get_pool(self, parser: DataParser):
+        if getattr(parser, 'bound', 'io') == 'cpu':
+            if self.processes and self._process_pool is None:
+                self._process_pool = ProcessPoolExecutor(self.processes)
+            return self._process_pool
+        if self.threads and self._thread_pool is None:
+            self._thread_pool = ThreadPoolExecutor(self.threads)
+        return self._thread_pool
+
+    @staticmethod
+    def parser_name(parser: DataParser) -> str:
+        return f'{parser.__module__}.{parser.__qualname__}'
+
+    def _record(self, name: str, elapsed: float, failed: bool):
+        stats = self.stats.setdefault(name, {'calls': 0, 'failures': 0, 'time': 0.0})
+        stats['calls'] += 1
+        stats['failures'] += failed
+        stats['time'] += elapsed
+
+    def run(self, jobs: list[ParserJob]) -> list[ParserResult]:
+        '''Runs all jobs and returns their results in the same order'''
+        names = [self.parser_name(job.parser) for job in jobs]
+        incremental = [self._is_incremental(job) for job in jobs]
+        keys = [
+            self.cache.key(name, getattr(job.parser, 'version', 0), job.args)
+            if self.cache is not None and not is_incremental else None
+            for job, name, is_incremental in zip(jobs, names, incremental)]
+        # Pool jobs are submitted first, so inline ones run while pools are busy.
+        # Each job gets (kind, payload): cached value, error, inline args or future
+        submitted = []
+        for job, key in zip(jobs, keys):
+            if key is not None:
+                is_cached, value = self.cache.get(key)
+                if is_cached:
+                    submitted.append(('cached', value))
+                    continue
+            pool = self._get_pool(job.parser)
+            if self._is_incremental(job):
+                record = self.states.get(job.state_key)
+                if pool:
+                    submitted.append((
+                        'future', pool.submit(_run_incremental, job.parser, job.args, record)))
+                else:
+                    submitted.append(('incremental', record))
+                continue
+            args, mapped = job.args, False
+            in_process = pool is not None and pool is self._process_pool
+            if getattr(job.parser, 'mapped', False) and not in_process:
+                try:
+                    args, mapped = _map_args(job.args, self._mapped_files), True
+                except OSError as e:
+                    submitted.append(('error', e))
+                    continue
+            if pool:
+                submitted.append(('future', pool.submit(_run_parser, job.parser, args, mapped)))
+            else:
+                submitted.append(('inline', (args, mapped)))
+        results = []
+        for job, name, key, is_incremental, (kind, payload) in zip(
+                jobs, names, keys, incremental, submitted):
+            if kind == 'cached':
+                results.append(ParserResult(job.key, payload, None, 0.0))
+                continue
+            try:
+                if kind == 'error':
+                    raise payload
+                elif kind == 'inline':
+                    value, elapsed = _run_parser(job.parser, *payload)
+                elif kind == 'incremental':
+                    value, elapsed = _run_incremental(job.parser, job.args, payload)
+                else:
+                    value, elapsed = payload.result()
+                if is_incremental:
+                    value, record = value
+                    self.states.put(job.state_key, record)
+            except Exception as e:
+                print(f'WARNING: parser {name} failed with args {job.args}: {e!r}')
+                self._record(name, 0.0, True)
+                results.append(ParserResult(job.key, None, e, None))
+                continue
+            self._record(name, elapsed, False)
+            if key is not None:
+                self.cache.put(key, name, value)
+            results.append(ParserResult(job.key, value, None, elapsed))
+        if self.cache is not None and jobs:
+            self.cache.flush()
+        if self.states is not None and any(incremental):
+            self.states.commit()
+        return results
+
+    def _is_incremental(self, job: ParserJob) -> bool:
+        return self.states is not None and job.state_key is not None and \
+            getattr(job.parser, 'incremental', False)
+
+    def release_files(self):
+        '''Closes files mapped for parsers, builder calls it after each build'''
+        for file in self._mapped_files.values():
+            file.close()
+        self._mapped_files = {}
+
+    def close(self):
+        self.release_files()
+        for pool in (self._process_pool, self._thread_pool):
+            if pool is not None:
+                pool.shutdown()
+        self._process_pool = self._thread_pool = None
+        if self.cache is not None:
+            self.cache.close()
+            self.cache = None
+        if self.states is not None:
+            self.states.close()
+
+
 class NoUpdate:
     pass
 
 
+# Value of lazy ParserField stored in DB until it's computed on read
+LAZY_PENDING = '<lazy pending>'
+
+
 @dataclass
 class ParserField:
     name: str
@@ -23,6 +476,8 @@ class ParserField:
     value: Any = None   # Any, but it must be serializable for chosen DB
     pattern: Pattern = None
     dependent_fields: list = None
+    # Lazy field is parsed on first read through DatabaseManager, not when building
+    lazy: bool = False
 
     def __post_init__(self):
         if self.pattern and self.dependent_fields:
@@ -32,6 +487,8 @@ class ParserField:
             raise ValueError(
                 'One of [pattern] or [dependent_fields] must be specified.'
             )
+        elif self.lazy and not self.dependent_fields:
+            raise ValueError('Lazy ParserField must have [dependent_fields].')
 
     def __bool__(self):
         return self.value is not None
@@ -54,6 +511,21 @@ class FieldBehavior:
     def update(old_value: Any, new_value: Any, mode):
         raise NotImplementedError
 
+    @classmethod
+    def update_many(cls, old_value: Any, changes: list):
+        '''
+        Applies (new_value, mode) changes one by one, each change is compared
+        with the value updated by the previous ones. Returns NoUpdate if nothing changed
+        '''
+        value = old_value
+        updated = False
+        for new_value, mode in changes:
+            update = cls.update(value, new_value, mode)
+            if update is not NoUpdate:
+                value = update
+                updated = True
+        return value if updated else NoUpdate
+
     @staticmethod
     def to_db(value: Any):
         raise NotImplementedError
@@ -134,15 +606,58 @@ class StrListFieldBehavior(FieldBehavior):
             elif new_value == old_value:
                 return NoUpdate
             elif new_value != old_value:
-                updated_list = [val for val in old_value.copy()]
-                updated_list.extend(val for val in new_value if val not in updated_list)
-                return updated_list
+                # Dict is an ordered set with O(1) membership
+                return list(dict.fromkeys([*old_value, *new_value]))
 
         elif mode == 'deleted':
             if new_value == old_value:
                 return None
             else:
-                return [el for el in old_value if el not in new_value]
+                deleted = set(new_value)
+                return [el for el in old_value if el not in deleted]
+
+    @classmethod
+    def update_many(cls, old_value: Optional[list], changes: list):
+        '''
+        Same as update of each change, but all changes are applied to a single
+        ordered set, so it takes O(n) for a list of n values instead of O(n) per change
+        '''
+        current = dict.fromkeys(old_value) if old_value else None
+        updated = False
+        added = []  # Values appended to the old value if nothing was deleted
+        deleted = False
+        for new_value, mode in changes:
+            if mode == 'created':
+                if not new_value:
+                    continue
+                if not current:
+                    current = dict.fromkeys(new_value)
+                    added, deleted, updated = list(current), bool(old_value), True
+                    continue
+                for value in new_value:
+                    if value not in current:
+                        current[value] = None
+                        added.append(value)
+                        updated = True
+            elif mode == 'deleted':
+                if current is None:
+                    continue
+                if len(current) == len(new_value) and list(current) == list(new_value):
+                    current, added, deleted, updated = None, [], True, True
+                    continue
+                for value in new_value:
+                    if value in current:
+                        del current[value]
+                        deleted = updated = True
+        if not updated:
+            return NoUpdate
+        if current is None:
+            return None
+        return cls._updated_list(old_value, current, None if deleted else added)
+
+    @staticmethod
+    def _updated_list(old_value, current: dict, added: Optional[list]) -> list:
+        return list(current)
 
     @staticmethod
     def to_db(value: Optional[List[str]]) -> Optional[List[str]]:
@@ -160,13 +675,35 @@ class PathlibListFieldBehavior(StrListFieldBehavior):
     def after_match(file: pathlib.Path, match_value: str, **kwargs):
         return [file]
 
+    @staticmethod
+    def _updated_list(old_value, current: dict, added: Optional[list]) -> list:
+        # Only appended paths need conversion if DB value of the old ones is known
+        db_value = getattr(old_value, 'db_value', None)
+        if added is None or db_value is None:
+            return list(current)
+        return _PathList(current, db_value + [str(file.absolute()) for file in added])
+
     @staticmethod
     def to_db(value: List[pathlib.Path]) -> Optional[List[str]]:
-        return [str(file.absolute()) for file in value] if value else None
+        if not value:
+            return None
+        if isinstance(value, _PathList):
+            return value.db_value
+        return [str(file.absolute()) for file in value]
 
     @staticmethod
     def from_db(value: Optional[List[str]]) -> Optional[List[pathlib.Path]]:
-        return [pathlib.Path(file) for file in value] if value else None
+        return _PathList(map(pathlib.Path, value), list(value)) if value else None
+
+
+class _PathList(list):
+    '''
+    List of paths which knows its DB value, so paths are converted
+    to strings once. Builder never changes field values in place, so it's valid
+    '''
+    def __init__(self, paths, db_value: List[str]):
+        super().__init__(paths)
+        self.db_value = db_value
 
 
 class ParserFieldBehavior(FieldBehavior):
@@ -221,44 +758,82 @@ class FieldsTransformer:
         else:
             type_behavior_mapping[cls.field_type] = cls
 
+    @staticmethod
+    def behavior(field_type) -> FieldBehavior:
+        try:
+            return FieldsTransformer.type_behavior_mapping[field_type]
+        except KeyError:
+            return FieldsTransformer.type_behavior_mapping[field_type.__name__]
+
     @staticmethod
     def after_match(field_type,
                     file: pathlib.Path,
                     match_value: str, **kwargs) -> Optional[Union[pathlib.Path, str]]:
-        try:
-            field_behavior = FieldsTransformer.type_behavior_mapping[field_type]
-        except KeyError:
-            field_behavior = FieldsTransformer.type_behavior_mapping[field_type.__name__]
-        return field_behavior.after_match(file, match_value, **kwargs)
+        return FieldsTransformer.behavior(field_type).after_match(file, match_value, **kwargs)
 
     @staticmethod
     def update(field_type, old_value: Any, new_value: Any, mode) -> Any:
-        try:
-            field_behavior = FieldsTransformer.type_behavior_mapping[field_type]
-        except KeyError:
-            field_behavior = FieldsTransformer.type_behavior_mapping[field_type.__name__]
-        return field_behavior.update(old_value, new_value, mode)
+        return FieldsTransformer.behavior(field_type).update(old_value, new_value, mode)
+
+    @staticmethod
+    def update_many(field_type, old_value: Any, changes: list) -> Any:
+        return FieldsTransformer.behavior(field_type).update_many(old_value, changes)
 
     @staticmethod
     def to_db(field_type, value: Any) -> Any:
-        try:
-            field_behavior = FieldsTransformer.type_behavior_mapping[field_type]
-        except KeyError:
-            field_behavior = FieldsTransformer.type_behavior_mapping[field_type.__name__]
-        return field_behavior.to_db(value)
+        return FieldsTransformer.behavior(field_type).to_db(value)
 
     @staticmethod
     def from_db(field_type, value: Any) -> Any:
+        return FieldsTransformer.behavior(field_type).from_db(value)
+
+
+# Field of a blueprint with everything builder needs to know about it resolved once.
+# dependents and default are set only for ParserFields
+FieldPlan = namedtuple(
+    'FieldPlan',
+    'name type is_parser dependents default after_match update update_many to_db from_db')
+
+
+def compile_field_plan(blueprint) -> dict[str, FieldPlan]:
+    '''Compiles {field: FieldPlan} of the blueprint in the order of its fields'''
+    plan = {}
+    for field in fields(blueprint):
+        f_type = field.type
+        # isinstance doesn't work here because of imports problem, see DataBlueprint
+        is_parser = getattr(f_type, '__name__', None) == 'ParserField'
+        default = field.default if is_parser else None
+        dependents = tuple(default.dependent_fields or ()) if is_parser else ()
         try:
-            field_behavior = FieldsTransformer.type_behavior_mapping[field_type]
-        except KeyError:
-            field_behavior = FieldsTransformer.type_behavior_mapping[field_type.__name__]
-        return field_behavior.from_db(value)
+            behavior = FieldsTransformer.behavior(f_type)
+        except (KeyError, AttributeError):
+            # Unsupported type fails only when the field is used, as before
+            plan[field.name] = FieldPlan(
+                field.name, f_type, is_parser, dependents, default,
+                *(partial(method, f_type) for method in (
+                    FieldsTransformer.after_match, FieldsTransformer.update,
+                    FieldsTransformer.update_many, FieldsTransformer.to_db,
+                    FieldsTransformer.from_db)))
+            continue
+        plan[field.name] = FieldPlan(
+            field.name, f_type, is_parser, dependents, default,
+            behavior.after_match, behavior.update, behavior.update_many,
+            behavior.to_db, behavior.from_db)
+    return plan
 
 
 __all__ = [
     'DataParser',
+    'IncrementalParser',
+    'ParserStates',
+    'MappedFile',
+    'call_parser',
+    'ParserJob',
+    'ParserResult',
+    'ParserCache',
+    'ParserRunner',
     'NoUpdate',
+    'LAZY_PENDING',
     'ParserField',
     'FieldBehavior',
     'StrFieldBehavior',
@@ -266,5 +841,7 @@ __all__ = [
     'StrListFieldBehavior',
     'PathlibListFieldBehavior',
     'ParserFieldBehavior',
-    'FieldsTransformer'
+    'FieldsTransformer',
+    'FieldPlan',
+    'compile_field_plan'
     ]
@@ -1,16 +1,78 @@
+import os
 from dataclasses import dataclass
 from typing import NamedTuple
 
 # FilesKraken modules
 
 
+def is_info(obj, info_class) -> bool:
+    '''
+    isinstance() analogue for infos. Info modules can be imported twice:
+    as top-level modules inside the package and as files_kraken.info by users,
+    so classes are compared by names.
+    '''
+    return any(cls.__name__ == info_class.__name__ for cls in type(obj).__mro__)
+
+
+def path_filter(path_prefixes: tuple):
+    '''
+    Returns predicate telling if a file is one of [path_prefixes] or inside of them.
+    Whole path components are compared, so /volume_1 doesn't match /volume_10/file
+    '''
+    paths = set()
+    dirs = []
+    for prefix in path_prefixes:
+        prefix = os.fspath(prefix).rstrip(os.sep)
+        paths.add(prefix)
+        dirs.append(prefix + os.sep)
+    dirs = tuple(dirs)
+
+    def in_paths(file) -> bool:
+        file = os.fspath(file)
+        return file.startswith(dirs) or file in paths
+    return in_paths
+
+
 @dataclass
 class KrakenInfo:
-    pass
+    def merge(self, other):
+        '''
+        Returns new info combining self and other or None if
+        infos can't be combined. Used by QueuedKraken to coalesce queued infos.
+        '''
+        return None
+
+    def select(self, path_prefixes: tuple):
+        '''
+        Returns info with data related only to paths inside of one of
+        [path_prefixes] or None if there is nothing left. Used by Kraken routing.
+        '''
+        return self
+
 
 @dataclass
 class FileChangesInfo(KrakenInfo):
     changes: NamedTuple
+    source: str = None  # Name of the monitor reported changes
+
+    def merge(self, other):
+        if not is_info(other, FileChangesInfo):
+            return None
+        source = self.source if self.source == other.source else None
+        return FileChangesInfo(self.changes.merge(other.changes), source)
+
+    def select(self, path_prefixes: tuple):
+        changes = self.changes.filter(path_filter(path_prefixes))
+        if not changes:
+            return None
+        return FileChangesInfo(changes, self.source)
+
+
+@dataclass
+class BlueprintsUpdatedInfo(KrakenInfo):
+    '''Released by BlueprintBuilder when structures of a blueprint are written to DB'''
+    blueprint: str
+    ids: list
 
 
 '''
@@ -1,12 +1,17 @@
 from dataclasses import dataclass, field
+from typing import Callable
+import asyncio
 import pathlib
 
 # FilesKraken imports
 from blueprint import DataBlueprint
 from collector import SingleRootCollector
-from database import Database, JsonDatabse, DatabaseManager
-from data_organizer import BlueprintBuilder, BlueprintsDBUpdater
+from database import (
+    Database, AsyncDatabase, BlockingDatabase, JsonDatabse, DatabaseManager, LazyFieldsFiller)
+from data_organizer import (
+    BlueprintBuilder, BlueprintsDBUpdater, PartitionedBuilderPool, StructureCache)
 from exceptions import InitializationError
+from fields import ParserCache, ParserRunner, ParserStates
 from functions import create_dirs
 from krakens_nest import Kraken
 from monitoring import MonitorManager, ChangesWatcher
@@ -24,10 +29,25 @@ class Workflow:
     exit_time: int = None
     db_manager: DatabaseManager = None
     db_updater: BlueprintsDBUpdater = None
-    bp_builder: BlueprintBuilder = None
+    bp_builder: BlueprintBuilder | PartitionedBuilderPool = None
+    build_workers: int = None
+    # Workers of each of process and thread pools for ParserField parsers
+    parser_workers: int = None
+    # Keep parser results of unchanged files in the workflow directory
+    parser_cache: bool = False
+    # Lazy ParserFields are computed in background each lazy_fill_interval seconds
+    lazy_fill_interval: float = None
+    # Growth of files selected by it is reported to incremental parsers
+    growth_filter: Callable[[str], bool] = None
+    # First build skips DB lookups and writes by chunks, by default only if DB is empty
+    bulk_ingest: bool = None
+    # Recently built structures kept between builds instead of reading them from DB, 1000 by default
+    structure_cache_size: int = None
     kraken: Kraken = Kraken()
 
     def __post_init__(self):
+        if self.build_workers and not self.bp_builder:
+            self._check_build_workers()
         self.wf_dir = pathlib.Path(self.wf_dir) / 'workflow_data' / self.name
 
         create_dirs(self.wf_dir)
@@ -43,7 +63,8 @@ class Workflow:
                 )
             else:
                 collector = SingleRootCollector(self.collector_path)
-                monitor = ChangesWatcher(collector, name='DefaultMonitor')
+                monitor = ChangesWatcher(
+                    collector, name='DefaultMonitor', growth_filter=self.growth_filter)
                 monitor_backup_file = str(monitor) + '.json'
                 self.monitor_manager.add_monitor(monitor, backup_file=monitor_backup_file)
 
@@ -57,13 +78,32 @@ class Workflow:
             self.db = JsonDatabse(self.db_path)
 
         if not self.db_manager:
-            self.db_manager = DatabaseManager(self.db)
+            if isinstance(self.db, AsyncDatabase):
+                # Builder is blocking, its calls will be sent to the loop of run_async
+                self.db_manager = DatabaseManager(BlockingDatabase(self.db))
+            else:
+                self.db_manager = DatabaseManager(self.db)
 
         if not self.db_updater:
             self.db_updater = BlueprintsDBUpdater(self.db_manager)
 
         if not self.bp_builder:
-            self.bp_builder = BlueprintBuilder(self.db_manager, self.db_updater)
+            if self.build_workers:
+                self.bp_builder = PartitionedBuilderPool(
+                    self.db_manager, workers=self.build_workers)
+            else:
+                cache = ParserCache(
+                    self.wf_dir / 'parser_cache.sqlite') if self.parser_cache else None
+                # States file is created only if there are incremental parsers
+                states = ParserStates(self.wf_dir / 'parser_states.sqlite')
+                parser_runner = ParserRunner(
+                    self.parser_workers or 0, self.parser_workers or 0,
+                    cache=cache, states=states)
+                self.bp_builder = BlueprintBuilder(
+                    self.db_manager, self.db_updater, parser_runner=parser_runner,
+                    bulk=self.bulk_ingest,
+                    structure_cache=StructureCache(
+                        1000 if self.structure_cache_size is None else self.structure_cache_size))
 
         # All main components are set
         # Bind files monitor and blueprint builder with kraken
@@ -76,15 +116,70 @@ class Workflow:
         # Set exit time if specified
         if self.exit_time:
             self.monitor_manager.exit_time = self.exit_time
-
-    def run(self):
+        self.lazy_filler = LazyFieldsFiller(
+            self.db_manager, interval=self.lazy_fill_interval) if self.lazy_fill_interval else None
+
+    def _check_build_workers(self):
+        '''PartitionedBuilderPool workers build structures with default builders'''
+        options = {
+            'parser_workers': self.parser_workers,
+            'parser_cache': self.parser_cache,
+            'bulk_ingest': self.bulk_ingest,
+            'structure_cache_size': self.structure_cache_size is not None,
+            'growth_filter': self.growth_filter}
+        unsupported = [name for name, value in options.items() if value]
+        if unsupported:
+            raise ValueError(f'Options {unsupported} are not supported with build_workers')
+
+    def _check_components(self):
         # Check that all key components are set
         for monitor in self.monitor_manager.monitors:
             if not monitor.collector:
                 raise InitializationError('No collector provided for monitor {monitor}')
         if not self.bp_builder.blueprints:
             raise InitializationError('No data schemes provided for workflow}')
-        self.monitor_manager.start()
+
+    def run(self):
+        self._check_components()
+        self._start_lazy_filler()
+        try:
+            self.monitor_manager.start()
+        finally:
+            # Queued krakens must deliver everything monitors have reported
+            self.kraken.close()
+            self._close_builder()
+
+    def _start_lazy_filler(self):
+        if self.lazy_filler:
+            self.lazy_filler.start()
+
+    def _close_builder(self):
+        if self.lazy_filler:
+            self.lazy_filler.stop()
+        if isinstance(self.bp_builder, (BlueprintBuilder, PartitionedBuilderPool)):
+            self.bp_builder.close()
+
+    async def run_async(self):
+        '''
+        Runs workflow inside of running event loop. Workflow must be created
+        with AsyncMonitorManager and AsyncKraken. Cancel the task to stop it.
+        '''
+        self._check_components()
+        if not asyncio.iscoroutinefunction(self.monitor_manager.start):
+            raise InitializationError(
+                'run_async requires AsyncMonitorManager, '
+                f'not {type(self.monitor_manager).__name__}')
+        if not asyncio.iscoroutinefunction(self.kraken.close):
+            raise InitializationError(
+                f'run_async requires AsyncKraken, not {type(self.kraken).__name__}')
+        if isinstance(self.db_manager.db, BlockingDatabase):
+            self.db_manager.db.loop = asyncio.get_running_loop()
+        self._start_lazy_filler()
+        try:
+            await self.monitor_manager.start()
+        finally:
+            await self.kraken.close()
+            self._close_builder()
 
 
 __all__ = [
@@ -1,12 +1,427 @@
+import asyncio
+import threading
+import time
+import traceback
+from collections import deque
+
+# FilesKraken modules
+from info import is_info
+
+
 class Event(list):
     def __call__(self, *args, **kwargs):
         for item in self:
             item(*args, **kwargs)
 
 
-class Kraken:
+class Subscription:
+    '''
+    Listener with filters. Empty filter accepts everything, otherwise:
+        info_types - info must be an instance of one of them
+        sources - info.source must be one of these monitor names
+        blueprints - info.blueprint must be one of these blueprint names
+        path_prefixes - listener receives only part of the info related
+                        to paths with these prefixes (see KrakenInfo.select).
+                        Infos without paths are delivered as is
+    '''
+    def __init__(self, listener, info_types=(), sources=(), blueprints=(), path_prefixes=()):
+        self.listener = listener
+        self.info_types = tuple(info_types)
+        self.sources = frozenset(sources)
+        self.blueprints = frozenset(blueprints)
+        self.path_prefixes = tuple(str(prefix) for prefix in path_prefixes)
+
+    def accepts(self, info) -> bool:
+        if self.info_types and not any(is_info(info, t) for t in self.info_types):
+            return False
+        if self.sources and getattr(info, 'source', None) not in self.sources:
+            return False
+        if self.blueprints and getattr(info, 'blueprint', None) not in self.blueprints:
+            return False
+        return True
+
+
+def _as_tuple(value):
+    if value is None:
+        return ()
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return tuple(value)
+    return (value,)
+
+
+class _Router:
+    '''
+    Routes infos to subscriptions. Routes are computed once for each combination
+    of info type, source and blueprint and listeners with the same path prefixes
+    share a single selected info.
+    '''
     def __init__(self):
         self.events = Event()
+        self.subscriptions = []
+        self._table = {}
+        self._events_snapshot = ()
+
+    def subscribe(self, listener, info_types=None, sources=None,
+                  blueprints=None, path_prefixes=None) -> Subscription:
+        subscription = Subscription(
+            listener, _as_tuple(info_types), _as_tuple(sources),
+            _as_tuple(blueprints), _as_tuple(path_prefixes))
+        self.subscriptions.append(subscription)
+        self._table = {}
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        self.subscriptions.remove(subscription)
+        self._table = {}
+
+    def _routes(self, info):
+        # Listeners added directly to events receive everything
+        events = tuple(self.events)
+        if events != self._events_snapshot:
+            self._events_snapshot = events
+            self._table = {}
+        key = (type(info), getattr(info, 'source', None), getattr(info, 'blueprint', None))
+        routes = self._table.get(key)
+        if routes is None:
+            groups = {}
+            for subscription in self.subscriptions:
+                if subscription.accepts(info):
+                    groups.setdefault(subscription.path_prefixes, []).append(
+                        subscription.listener)
+            if events:
+                groups.setdefault((), []).extend(events)
+            routes = self._table[key] = list(groups.items())
+        return routes
+
+    def route(self, info):
+        '''Yields listeners with parts of info they are subscribed to'''
+        for path_prefixes, listeners in self._routes(info):
+            selected = info.select(path_prefixes) if path_prefixes else info
+            if selected is None:
+                continue
+            for listener in listeners:
+                yield listener, selected
+
+
+class Kraken(_Router):
+    '''
+    Delivers infos to listeners. Listeners are added either to events
+    to receive every info or by subscribe() with filters.
+    If [coalescer] is set (see monitoring.ChangesCoalescer), infos pass through it
+    and listeners receive only merged batches.
+    '''
+    def __init__(self, coalescer=None):
+        super().__init__()
+        self.coalescer = coalescer
+
+    def release(self, args):
+        if self.coalescer:
+            for info in self.coalescer.add(args):
+                self._dispatch(info)
+        else:
+            self._dispatch(args)
+
+    def release_threadsafe(self, args):
+        '''Release for listeners which are run by kraken in other threads'''
+        self.release(args)
+
+    def _dispatch(self, info):
+        for listener, selected in self.route(info):
+            self._deliver(listener, selected)
+
+    def _deliver(self, listener, info):
+        listener(info)
+
+    def poll(self):
+        '''Delivers coalesced infos whose window has expired'''
+        if self.coalescer:
+            for info in self.coalescer.poll():
+                self._dispatch(info)
+
+    def flush(self):
+        '''Delivers all coalesced infos regardless of the window'''
+        if self.coalescer:
+            for info in self.coalescer.flush():
+                self._dispatch(info)
+
+    def close(self):
+        self.flush()
+
+
+class _Subscriber:
+    '''
+    Bounded queue of infos for a single listener with its own consumer threads.
+    Each item is stored together with the time it was queued to measure lag.
+    '''
+    def __init__(self, listener, maxsize, workers, policy):
+        self.listener = listener
+        self.maxsize = maxsize
+        self.policy = policy
+        self.queue = deque()
+        self.lock = threading.Condition()
+        self.closed = False
+        self.drain = True
+        self.busy = 0
+        self.released = 0
+        self.delivered = 0
+        self.coalesced = 0
+        self.errors = 0
+        self.peak_depth = 0
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+        self.threads = [
+            threading.Thread(target=self._consume, daemon=True,
+                             name=f'Kraken-{getattr(listener, "__qualname__", listener)}-{i}')
+            for i in range(workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def put(self, info):
+        with self.lock:
+            while len(self.queue) >= self.maxsize and not self.closed:
+                if self.policy == 'coalesce' and self._coalesce(info):
+                    return
+                self.lock.wait()
+            if self.closed:
+                raise RuntimeError('Kraken is closed and does not accept new infos')
+            self.queue.append((info, time.monotonic()))
+            self.released += 1
+            self.peak_depth = max(self.peak_depth, len(self.queue))
+            self.lock.notify_all()
+
+    def _coalesce(self, info) -> bool:
+        '''Merges info into the last queued one. Must be called under lock'''
+        tail, queued_at = self.queue[-1]
+        merged = tail.merge(info)
+        if merged is None:
+            return False
+        # Merged item keeps the time of the oldest info to report honest lag
+        self.queue[-1] = (merged, queued_at)
+        self.released += 1
+        self.coalesced += 1
+        return True
+
+    def _consume(self):
+        while True:
+            with self.lock:
+                while not self.queue and not self.closed:
+                    self.lock.wait()
+                if not self.queue or (self.closed and not self.drain):
+                    return
+                info, queued_at = self.queue.popleft()
+                self.busy += 1
+                self.lock.notify_all()
+            lag = time.monotonic() - queued_at
+            failed = False
+            try:
+                self.listener(info)
+            except Exception:
+                failed = True
+                traceback.print_exc()
+            with self.lock:
+                self.errors += failed
+                self.busy -= 1
+                self.delivered += 1
+                self.last_lag = lag
+                self.max_lag = max(self.max_lag, lag)
+                self.lock.notify_all()
+
+    def join(self, timeout=None):
+        '''Waits until all queued infos are delivered'''
+        with self.lock:
+            return self.lock.wait_for(lambda: not self.queue and not self.busy, timeout)
+
+    def close(self, drain=True, timeout=None):
+        with self.lock:
+            self.closed = True
+            self.drain = drain
+            if not drain:
+                self.queue.clear()
+            self.lock.notify_all()
+        for thread in self.threads:
+            thread.join(timeout)
+
+    def metrics(self):
+        with self.lock:
+            oldest_wait = time.monotonic() - self.queue[0][1] if self.queue else 0.0
+            return {
+                'depth': len(self.queue),
+                'peak_depth': self.peak_depth,
+                'in_progress': self.busy,
+                'released': self.released,
+                'delivered': self.delivered,
+                'coalesced': self.coalesced,
+                'errors': self.errors,
+                'oldest_wait': oldest_wait,
+                'last_lag': self.last_lag,
+                'max_lag': self.max_lag
+            }
+
+
+class QueuedKraken(Kraken):
+    '''
+    Kraken that doesn't call listeners in the thread of releaser.
+    Every listener gets its own bounded queue served by [workers] threads, so
+    monitoring can keep polling while listeners (e.g. BlueprintBuilder) are busy.
+
+    When the queue of a listener is full, [policy] defines what to do:
+        'block' - releaser waits until there is a free place in the queue
+        'coalesce' - info is merged into the last queued one if it's possible
+                     (see KrakenInfo.merge), otherwise releaser waits.
+
+    Listeners are called concurrently only if workers > 1, so keep it 1
+    for listeners which are not thread safe, like BlueprintBuilder.
+    '''
+    policies = ('block', 'coalesce')
+
+    def __init__(
+            self, maxsize: int = 100, workers: int = 1,
+            policy: str = 'block', coalescer=None):
+        super().__init__(coalescer=coalescer)
+        if policy not in self.policies:
+            raise ValueError(f'Unknown queue policy {policy}. Choose one of {self.policies}')
+        if maxsize < 1 or workers < 1:
+            raise ValueError('Both maxsize and workers must be positive')
+        self.maxsize = maxsize
+        self.workers = workers
+        self.policy = policy
+        self._subscribers = {}
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def _subscriber(self, listener) -> _Subscriber:
+        # Listeners are still added by events.append, so subscribers
+        # are created on the first release for each of them
+        with self._lock:
+            subscriber = self._subscribers.get(listener)
+            if subscriber is None:
+                subscriber = _Subscriber(listener, self.maxsize, self.workers, self.policy)
+                self._subscribers[listener] = subscriber
+            return subscriber
 
     def release(self, args):
-        self.events(args)
+        if self._closed:
+            raise RuntimeError('Kraken is closed and does not accept new infos')
+        super().release(args)
+
+    def _deliver(self, listener, info):
+        self._subscriber(listener).put(info)
+
+    def join(self, timeout=None) -> bool:
+        '''Blocks until every released info is processed by all listeners'''
+        return all(s.join(timeout) for s in list(self._subscribers.values()))
+
+    def close(self, drain=True, timeout=None):
+        '''
+        Stops accepting new infos and waits for consumer threads.
+        With drain=True all queued infos are delivered before threads exit,
+        otherwise they are discarded.
+        '''
+        if drain and not self._closed:
+            # Listeners may release new infos while queues are drained
+            self.flush()
+            self.join(timeout)
+        self._closed = True
+        for subscriber in list(self._subscribers.values()):
+            subscriber.close(drain=drain, timeout=timeout)
+
+    def metrics(self):
+        '''Queue depth, throughput and lag (seconds) for each listener'''
+        metrics = {}
+        for listener, subscriber in list(self._subscribers.items()):
+            name = getattr(listener, '__qualname__', str(listener))
+            if name in metrics:
+                name = f'{name}#{len(metrics)}'
+            metrics[name] = subscriber.metrics()
+        return metrics
+
+
+class AsyncKraken(_Router):
+    '''
+    Kraken for asyncio applications, released by AsyncMonitorManager.
+    Every listener gets its own asyncio.Queue served by a task. Coroutine
+    listeners are awaited, blocking ones (e.g. BlueprintBuilder.listen)
+    are run in a thread by asyncio.to_thread. A full queue suspends the releaser.
+    '''
+    def __init__(self, maxsize: int = 100, coalescer=None):
+        super().__init__()
+        self.coalescer = coalescer
+        self.maxsize = maxsize
+        self._consumers = {}
+        self._delivered = {}
+        self._closed = False
+        self._loop = None
+
+    def _queue(self, listener) -> asyncio.Queue:
+        consumer = self._consumers.get(listener)
+        if consumer is None:
+            queue = asyncio.Queue(self.maxsize)
+            task = asyncio.create_task(self._consume(listener, queue))
+            consumer = self._consumers[listener] = (queue, task)
+            self._delivered[listener] = 0
+        return consumer[0]
+
+    async def _consume(self, listener, queue: asyncio.Queue):
+        is_coroutine = asyncio.iscoroutinefunction(listener)
+        while True:
+            info = await queue.get()
+            try:
+                if is_coroutine:
+                    await listener(info)
+                else:
+                    await asyncio.to_thread(listener, info)
+            except Exception:
+                traceback.print_exc()
+            finally:
+                self._delivered[listener] += 1
+                queue.task_done()
+
+    def release_threadsafe(self, args):
+        '''
+        Release for blocking listeners run by asyncio.to_thread.
+        Must not be called from the event loop thread.
+        '''
+        asyncio.run_coroutine_threadsafe(self.release(args), self._loop).result()
+
+    async def release(self, args):
+        self._loop = asyncio.get_running_loop()
+        if self._closed:
+            raise RuntimeError('Kraken is closed and does not accept new infos')
+        infos = self.coalescer.add(args) if self.coalescer else [args]
+        for info in infos:
+            await self._dispatch(info)
+
+    async def _dispatch(self, info):
+        for listener, selected in self.route(info):
+            await self._queue(listener).put(selected)
+
+    async def poll(self):
+        if self.coalescer:
+            for info in self.coalescer.poll():
+                await self._dispatch(info)
+
+    async def flush(self):
+        if self.coalescer:
+            for info in self.coalescer.flush():
+                await self._dispatch(info)
+
+    async def join(self):
+        '''Waits until every released info is processed by all listeners'''
+        await asyncio.gather(*(queue.join() for queue, _ in list(self._consumers.values())))
+
+    async def close(self, drain=True):
+        if drain and not self._closed:
+            await self.flush()
+            await self.join()
+        self._closed = True
+        tasks = [task for _, task in self._consumers.values()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def metrics(self):
+        return {
+            getattr(listener, '__qualname__', str(listener)): {
+                'depth': queue.qsize(),
+                'delivered': self._delivered[listener]}
+            for listener, (queue, _) in list(self._consumers.items())}
@@ -1,7 +1,9 @@
+import asyncio
 import time
 import json
 import pathlib
 import os
+import threading
 
 from dataclasses import dataclass, field
 from datetime import datetime
@@ -12,7 +14,7 @@ from typing import (
     Optional, List)
 # FilesKraken modules
 from collector import FilesCollector
-from info import FileChangesInfo
+from info import KrakenInfo, FileChangesInfo, is_info
 from krakens_nest import Kraken
 from functions import create_dirs
 
@@ -23,17 +25,70 @@ class Event(list):
             item(*args, **kwargs)
 
 
+def net_change(state: tuple | None, mode: str) -> tuple:
+    '''
+    Combines pending change of a file with the next one.
+    State is (mode, existed) where existed tells if the file had existed
+    before its first pending change, None means there is no change.
+    Returns new state and what has happened: None, 'duplicates', 'cancelled' or 'replaced'
+    '''
+    if state is None:
+        return (mode, mode != 'created'), None
+    pending_mode, existed = state
+    if pending_mode == 'modified' and mode != 'modified':
+        return (mode, existed), 'duplicates'
+    if pending_mode == mode or mode == 'modified':
+        return state, 'duplicates'
+    if mode == 'deleted':
+        # File which had existed before is deleted after replacement
+        return (('deleted', True) if existed else None), 'cancelled'
+    return ('created', existed), 'replaced'
+
+
 @dataclass
 class Changes:
     created: list = field(default_factory=list)
     deleted: list = field(default_factory=list)
+    # Existing files which have grown, see ChangesWatcher growth_filter
+    modified: list = field(default_factory=list)
 
     def extend(self, other):
         self.created.extend(other.created)
         self.deleted.extend(other.deleted)
+        self.modified.extend(other.modified)
+
+    def filter(self, predicate):
+        return Changes(
+            [f for f in self.created if predicate(f)],
+            [f for f in self.deleted if predicate(f)],
+            [f for f in self.modified if predicate(f)])
+
+    def merge(self, other):
+        '''
+        Returns net changes of self followed by other. Files created and deleted
+        are dropped, replaced files are both deleted and created.
+        '''
+        states = {}
+        files = {}
+        for changes in (self, other):
+            # Builder applies changes in this order
+            for mode in ('deleted', 'created', 'modified'):
+                for file in getattr(changes, mode):
+                    key = os.fspath(file)
+                    states[key] = net_change(states.get(key), mode)[0]
+                    files[key] = file
+        merged = Changes()
+        for key, state in states.items():
+            if state is None:
+                continue
+            mode, existed = state
+            if mode == 'created' and existed:
+                merged.deleted.append(files[key])
+            getattr(merged, mode).append(files[key])
+        return merged
 
     def __len__(self):
-        return len(self.created) + len(self.deleted)
+        return len(self.created) + len(self.deleted) + len(self.modified)
 
 
 class ChangesFactory:
@@ -50,7 +105,119 @@ class ChangesFactory:
             return Changes(created, deleted)
 
 
+class ChangesCoalescer:
+    '''
+    Merges FileChangesInfo infos released to Kraken during a window into one batch
+    for each monitor.
+    Window is closed when [window] seconds have passed since the first pending info
+    or when [max_size] unique paths are pending. With [max_size] only, window
+    is default_window seconds, so the rest of changes isn't kept until shutdown.
+    Without both limits nothing is delayed and only duplicates inside a single
+    info are removed.
+
+    Inside the window the net change is kept for each path:
+        created -> deleted: both changes are cancelled
+        deleted -> created: file was replaced, it's reported both deleted and created
+                            (like by Changes.merge), so its ParserFields are parsed again
+        deleted -> created -> deleted: file stays deleted
+        created or deleted -> modified: modification is dropped as a duplicate
+        modified -> created or deleted: the last change is kept
+        repeated changes: duplicates are dropped
+    Other infos, e.g. BlueprintsUpdatedInfo of builders, are passed through at once
+    and don't close the window.
+    '''
+    default_window = 1.0
+
+    def __init__(self, window: float = None, max_size: int = None):
+        if window is None and max_size is not None:
+            window = self.default_window
+        self.window = window
+        self.max_size = max_size
+        self._pending = {}  # path key -> (path, (mode, existed), source)
+        self._opened_at = None
+        self._lock = threading.Lock()
+        self.counters = dict.fromkeys(
+            ['infos_in', 'batches_out', 'files_in', 'files_out',
+             'cancelled', 'replaced', 'duplicates'], 0)
+
+    def add(self, info: KrakenInfo) -> List[KrakenInfo]:
+        with self._lock:
+            if not is_info(info, FileChangesInfo):
+                return [info]
+            self.counters['infos_in'] += 1
+            if self._opened_at is None:
+                self._opened_at = time.monotonic()
+            for file in info.changes.deleted:
+                self._add_file(file, 'deleted', info.source)
+            for file in info.changes.created:
+                self._add_file(file, 'created', info.source)
+            for file in info.changes.modified:
+                self._add_file(file, 'modified', info.source)
+            if self._window_closed():
+                return self._flush()
+            return []
+
+    def _add_file(self, file, mode, source):
+        self.counters['files_in'] += 1
+        key = os.fspath(file)
+        pending = self._pending.get(key)
+        pending_state = pending[1] if pending else None
+        state, event = net_change(pending_state, mode)
+        if event:
+            self.counters[event] += 2 if event == 'cancelled' else 1
+        if state is None:
+            # Created and deleted during the window, nobody needs to know about it
+            del self._pending[key]
+        elif state != pending_state:
+            self._pending[key] = (file, state, source)
+
+    def _window_closed(self):
+        if self.max_size is not None and len(self._pending) >= self.max_size:
+            return True
+        if self.window is not None:
+            return time.monotonic() - self._opened_at >= self.window
+        return True
+
+    def poll(self) -> List[KrakenInfo]:
+        with self._lock:
+            if self._opened_at is not None and self._window_closed():
+                return self._flush()
+            return []
+
+    def flush(self) -> List[KrakenInfo]:
+        with self._lock:
+            return self._flush()
+
+    def _flush(self) -> List[KrakenInfo]:
+        self._opened_at = None
+        if not self._pending:
+            return []
+        # Batch is split by monitors which have reported the last change of a file
+        batches = {}
+        for file, (mode, existed), source in self._pending.values():
+            changes = batches.setdefault(source, Changes())
+            if mode == 'created' and existed:
+                changes.deleted.append(file)
+            getattr(changes, mode).append(file)
+        self._pending = {}
+        self.counters['batches_out'] += len(batches)
+        self.counters['files_out'] += sum(len(changes) for changes in batches.values())
+        return [FileChangesInfo(changes, source) for source, changes in batches.items()]
+
+    @property
+    def eliminated(self) -> int:
+        '''Number of file changes that have never reached listeners'''
+        with self._lock:
+            return self.counters['files_in'] - self.counters['files_out'] - len(self._pending)
+
+
 class ChangesWatcher:
+    '''
+    Reports files created and deleted since the previous run.
+    Sizes of files selected by [growth_filter] are checked on each run too,
+    and grown files are reported as modified. After restart all of them
+    are reported once, as they could grow while nobody watched them.
+    '''
     _ids = count(0)
 
     def __init__(
@@ -59,6 +226,7 @@ class ChangesWatcher:
         changes_formatter: Callable = ChangesFactory.dict_collection,
         prev_state=None,
         name=None,
+        growth_filter: Callable[[str], bool] = None,
         **formatter_args
     ):
         self.collector = collector
@@ -67,14 +235,40 @@ class ChangesWatcher:
         self.changes_formatter = changes_formatter
         self._formatter_args = formatter_args
         self._name = name
+        self.growth_filter = growth_filter
+        self._sizes = {}
 
     def get_changes(self):
         cur_state = self.collector.collect()
         changes = self.changes_formatter(self.prev_state, cur_state, **self._formatter_args)
         if changes:
             self.set_state(cur_state)  # I'm not sure it's good to set state here
+        if self.growth_filter:
+            modified = self._grown_files(cur_state, changes.created if changes else ())
+            if modified:
+                changes = changes if changes else Changes()
+                changes.modified.extend(modified)
         return changes
 
+    def _grown_files(self, state, created) -> list:
+        created = set(created)
+        sizes = {}
+        modified = []
+        for file in state.to_list(**self._formatter_args):
+            if not self.growth_filter(file):
+                continue
+            try:
+                sizes[file] = os.stat(file).st_size
+            except OSError:
+                continue
+            old_size = self._sizes.get(file)
+            if old_size is None and file not in created or \
+                    old_size is not None and sizes[file] > old_size:
+                modified.append(file)
+        # Sizes of deleted files are forgotten
+        self._sizes = sizes
+        return modified
+
     @property
     def collection(self):
         return self.collector.output_format
@@ -225,6 +419,10 @@ class MonitorManager:
             print(
                 f'[{now}] {monitor}: \n\tCreated ',
                 '\n\tCreated '.join(f for f in changes.created))
+        if changes.modified:
+            print(
+                f'[{now}] {monitor}: \n\tModified ',
+                '\n\tModified '.join(f for f in changes.modified))
 
     def _run_coworkers(self, coworkers, changes):
         # It's running only on existing files
@@ -263,9 +461,35 @@ class MonitorManager:
                 coworker.reset_state()
         return coworkers_changes
 
-    def report_changes(self, changes):
+    def report_changes(self, changes, source=None):
         if self.kraken:
-            self.kraken.release(FileChangesInfo(changes))
+            self.kraken.release(FileChangesInfo(changes, source))
+
+    def _check_monitor(self, monitor, info) -> List[Changes]:
+        '''Runs monitor and its coworkers if it's time and returns changes to report'''
+        to_report = []
+        if self._time_to_rerun(info):
+            changes = monitor.get_changes()
+            if changes:
+                self._print_changes(monitor, changes)
+                self.backup_manager.save(monitor, monitor.prev_state)
+                if info.coworkers and changes.created:
+                    coworkers_changes = self._run_coworkers(info.coworkers, changes.created)
+                    changes.extend(coworkers_changes)
+                to_report.append(changes)
+            else:
+                now = datetime.now().isoformat(' ', 'seconds')
+                print(f'[{now}] {monitor}: No changes')
+            info.last_run = time.time()
+        if info.reindex_timeout:
+            if self._time_to_reindex(info) and info.coworkers:
+                print("Reindexing")
+                changes = self._run_coworkers(
+                    info.coworkers, monitor.prev_state.to_list(**monitor._formatter_args))
+                if changes:
+                    to_report.append(changes)
+                info.last_reindex = time.time()
+        return to_report
 
     def start(self):
         # It turned out that it is better to add monitors to backup manager
@@ -278,37 +502,67 @@ class MonitorManager:
             self._start_time = time.time()
         while not self._time_to_exit():
             time.sleep(1)  # It helps not to load full core
+            if self.kraken:
+                self.kraken.poll()  # Release coalesced changes with expired window
             for monitor, info in self.monitors.items():
-                if self._time_to_rerun(info):
-                    changes = monitor.get_changes()
-                    if changes:
-                        self._print_changes(monitor, changes)
-                        self.backup_manager.save(monitor, monitor.prev_state)
-                        if info.coworkers and changes.created:
-                            coworkers_changes = self._run_coworkers(info.coworkers, changes.created)
-                            changes.extend(coworkers_changes)
-                        self.report_changes(changes)
-                    else:
-                        now = datetime.now().isoformat(' ', 'seconds')
-                        print(f'[{now}] {monitor}: No changes')
-                    info.last_run = time.time()
-                if info.reindex_timeout:
-                    if self._time_to_reindex(info) and info.coworkers:
-                        print("Reindexing")
-                        changes = self._run_coworkers(
-                            info.coworkers, monitor.prev_state.to_list(**monitor._formatter_args))
-                        if changes:
-                            self.report_changes(changes)
-                        info.last_reindex = time.time()
+                for changes in self._check_monitor(monitor, info):
+                    self.report_changes(changes, source=monitor.name)
+        if self.kraken:
+            self.kraken.flush()
         now = datetime.now().isoformat(' ', 'seconds')
         print(f'[{now}] Finishing monitoring')
 
 
+class AsyncMonitorManager(MonitorManager):
+    '''
+    MonitorManager for asyncio applications. Kraken must be AsyncKraken.
+    Each monitor is watched by its own task, and blocking collection
+    runs in threads, so start() can be cancelled like any other coroutine.
+    '''
+    poll_interval = 1
+
+    async def report_changes(self, changes, source=None):
+        if self.kraken:
+            await self.kraken.release(FileChangesInfo(changes, source))
+
+    async def _watch(self, monitor, info):
+        while True:
+            for changes in await asyncio.to_thread(self._check_monitor, monitor, info):
+                await self.report_changes(changes, source=monitor.name)
+            await asyncio.sleep(self.poll_interval)
+
+    async def start(self):
+        await asyncio.to_thread(self._backup_monotors)
+        if self.exit_time:
+            self._start_time = time.time()
+        tasks = [
+            asyncio.create_task(self._watch(monitor, info), name=f'Monitor {monitor}')
+            for monitor, info in self.monitors.items()]
+        try:
+            while not self._time_to_exit():
+                await asyncio.sleep(self.poll_interval)
+                if self.kraken:
+                    await self.kraken.poll()
+                for task in tasks:
+                    if task.done():
+                        task.result()  # Reraise monitor errors
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            if self.kraken:
+                await self.kraken.flush()
+            now = datetime.now().isoformat(' ', 'seconds')
+            print(f'[{now}] Finishing monitoring')
+
+
 __all__ = [
     'Event',
     'Changes',
     'ChangesFactory',
+    'ChangesCoalescer',
     'ChangesWatcher',
     'BackupManager',
-    'MonitorManager'
+    'MonitorManager',
+    'AsyncMonitorManager'
     ]
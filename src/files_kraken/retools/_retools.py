@@ -1,7 +1,321 @@
+import heapq
+import json
 import re
+import string
+import threading
+import time
 from abc import ABC, abstractmethod
+from collections import OrderedDict, namedtuple
+from functools import lru_cache
+from operator import itemgetter
 from typing import Dict, Pattern
 
+try:  # Python 3.11+
+    from re import _parser as sre_parse, _constants as sre_constants
+except ImportError:
+    import sre_parse
+    import sre_constants
+
+
+class PatternCache:
+    '''
+    Bounded LRU cache of compiled patterns. re module keeps only 512 patterns,
+    which is not enough when every structure has its own match_scheme.
+    '''
+    def __init__(self, maxsize: int = 4096):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._patterns = OrderedDict()
+        self._lock = threading.Lock()
+
+    def compile(self, pattern) -> Pattern:
+        if isinstance(pattern, re.Pattern):
+            return pattern
+        with self._lock:
+            compiled = self._patterns.get(pattern)
+            if compiled is not None:
+                self._patterns.move_to_end(pattern)
+                self.hits += 1
+                return compiled
+            self.misses += 1
+        compiled = re.compile(pattern)
+        with self._lock:
+            self._patterns[pattern] = compiled
+            if len(self._patterns) > self.maxsize:
+                self._patterns.popitem(last=False)
+        return compiled
+
+    def compile_entry(self, entry):
+        '''
+        Compiles patterns of matcher entry keeping its format:
+        pattern, (pattern, group) or tuple of them
+        '''
+        match entry:
+            case tuple() if isinstance(entry[1], int):
+                return (self.compile(entry[0]), entry[1])
+            case tuple():
+                return tuple(self.compile_entry(sub_entry) for sub_entry in entry)
+            case _:
+                return self.compile(entry)
+
+    def clear(self):
+        with self._lock:
+            self._patterns.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def __len__(self):
+        return len(self._patterns)
+
+
+pattern_cache = PatternCache()
+
+
+def _has_nested_repeat(items, in_repeat=False) -> bool:
+    '''Checks parsed pattern for a repeat inside a repeat like (a+)+ or (\\w*_)*'''
+    for op, av in items:
+        if op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT):
+            repeated = av[1] > 1
+            if in_repeat and repeated:
+                return True
+            if _has_nested_repeat(av[2], in_repeat or repeated):
+                return True
+        elif op is sre_constants.SUBPATTERN:
+            if _has_nested_repeat(av[3], in_repeat):
+                return True
+        elif op is sre_constants.BRANCH:
+            if any(_has_nested_repeat(branch, in_repeat) for branch in av[1]):
+                return True
+    return False
+
+
+class PatternProfiler:
+    '''
+    Opt-in statistics of pattern calls: count, hits and time.
+    When disabled matchers only check the enabled flag once per call.
+    Patterns with nested repeats or calls slower than slow_call seconds are flagged,
+    they are likely to backtrack catastrophically on some filenames.
+    '''
+    def __init__(self, slow_call: float = 0.001):
+        self.enabled = False
+        self.slow_call = slow_call
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def reset(self):
+        with self._lock:
+            self._stats.clear()
+
+    def record(self, pattern: Pattern, elapsed: float, hit: bool):
+        with self._lock:
+            stats = self._stats.get(pattern)
+            if stats is None:
+                stats = self._stats[pattern] = {
+                    'calls': 0, 'hits': 0, 'time': 0.0, 'max_time': 0.0, 'slow_calls': 0}
+            stats['calls'] += 1
+            stats['hits'] += hit
+            stats['time'] += elapsed
+            if elapsed > stats['max_time']:
+                stats['max_time'] = elapsed
+            if elapsed > self.slow_call:
+                stats['slow_calls'] += 1
+
+    def call(self, pattern: Pattern, method, text: str):
+        '''Calls method of compiled pattern on text and records it'''
+        start = time.perf_counter()
+        result = method(text)
+        self.record(pattern, time.perf_counter() - start, result is not None)
+        return result
+
+    def run(self, matcher, text: str):
+        '''Calls PatternMatcher on text and records it'''
+        start = time.perf_counter()
+        result = matcher(text)
+        self.record(matcher.pattern, time.perf_counter() - start, bool(result))
+        return result
+
+    @staticmethod
+    def flags(pattern: Pattern, stats: dict) -> list[str]:
+        flags = []
+        if _has_nested_repeat(sre_parse.parse(pattern.pattern, pattern.flags)):
+            flags.append('nested repeat')
+        if stats['slow_calls']:
+            flags.append('slow calls')
+        return flags
+
+    def report(self, sort: str = 'time', limit: int = None) -> list[dict]:
+        '''Patterns statistics ranked by sort key: time, calls, hits, max_time or hit_rate'''
+        with self._lock:
+            stats = [(pattern, dict(values)) for pattern, values in self._stats.items()]
+        report = []
+        for pattern, values in stats:
+            values['pattern'] = pattern.pattern
+            values['hit_rate'] = values['hits'] / values['calls']
+            values['flags'] = self.flags(pattern, values)
+            report.append(values)
+        report.sort(key=lambda values: values[sort], reverse=True)
+        return report[:limit]
+
+    def dump_json(self, path, sort: str = 'time', limit: int = None):
+        with open(path, 'w') as f:
+            json.dump(self.report(sort, limit), f, indent=4)
+
+
+pattern_profiler = PatternProfiler()
+
+
+PatternLiterals = namedtuple('PatternLiterals', 'prefix suffix required')
+
+
+def _literal_tokens(items, tokens):
+    '''
+    Flattens parsed pattern into a list of characters every match must contain in
+    this order. None separates characters which are not adjacent in a match.
+    '''
+    for op, av in items:
+        if op is sre_constants.LITERAL:
+            tokens.append(chr(av))
+        elif op is sre_constants.AT:
+            continue  # Anchors and word boundaries don't consume text
+        elif op is sre_constants.SUBPATTERN and not av[1] and not av[2]:
+            _literal_tokens(av[3], tokens)  # Group without flags is contiguous with the rest
+        elif op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT) and av[0] >= 1:
+            if av[0] == av[1] == 1:
+                _literal_tokens(av[2], tokens)
+            else:  # Repeated body is required, but it isn't adjacent to the rest
+                tokens.append(None)
+                _literal_tokens(av[2], tokens)
+                tokens.append(None)
+        else:
+            tokens.append(None)
+    return tokens
+
+
+@lru_cache(maxsize=4096)
+def extract_literals(pattern) -> PatternLiterals:
+    '''
+    Finds fixed parts of the pattern: prefix and suffix of every fullmatch
+    and the longest literal every match contains. Unknown parts are empty strings.
+    Results are cached, as parsing costs about as much as compiling the pattern.
+    '''
+    pattern = pattern_cache.compile(pattern)
+    if pattern.flags & re.IGNORECASE:
+        return PatternLiterals('', '', '')
+    try:
+        parsed = sre_parse.parse(pattern.pattern, pattern.flags)
+        tokens = _literal_tokens(parsed, [])
+    except Exception:  # Unknown parser internals mustn't break matching
+        return PatternLiterals('', '', '')
+    runs = ''.join(token if token is not None else '\0' for token in tokens).split('\0')
+    if None in tokens:
+        prefix, suffix = runs[0], runs[-1]
+    else:
+        prefix = suffix = runs[0]
+    return PatternLiterals(prefix, suffix, max(runs, key=len))
+
+
+class PatternMatcher:
+    '''
+    Compiled pattern with cheap literal checks made before regex evaluation.
+    Returns the same values as ReExecutor.fullmatch/search.
+    '''
+    def __init__(self, pattern, group=0, is_search=False, prefilter=True):
+        self.pattern = pattern_cache.compile(pattern)
+        self.group = group
+        self.is_search = is_search
+        self._method = self.pattern.search if is_search else self.pattern.fullmatch
+        prefix, suffix, required = extract_literals(self.pattern) if prefilter else ('', '', '')
+        self.literal = required
+        anchored = self.pattern.pattern.startswith(('^', '\\A'))
+        # Search can match anywhere, so only the required literal can be checked
+        self.prefix = prefix if not is_search or anchored else ''
+        self.suffix = suffix if not is_search else ''
+        if self.literal in (self.prefix, self.suffix):
+            self._required = ''
+        else:
+            self._required = self.literal
+
+    def may_match(self, text: str) -> bool:
+        return (text.startswith(self.prefix) and text.endswith(self.suffix)
+                and self._required in text)
+
+    def __call__(self, text: str) -> str | None:
+        if not (text.startswith(self.prefix) and text.endswith(self.suffix)
+                and self._required in text):
+            return None
+        result = self._method(text)
+        if result:
+            return result.group(self.group)
+
+    def match_many(self, texts: list[str], indices=None) -> Dict[int, str]:
+        '''
+        Matches texts at indices (all texts by default).
+        Returns {index: matched value} for matched texts only
+        '''
+        if indices is None:
+            indices = range(len(texts))
+        if pattern_profiler.enabled:
+            matches = ((i, pattern_profiler.run(self, texts[i])) for i in indices)
+            return {i: value for i, value in matches if value}
+        prefix, suffix, required = self.prefix, self.suffix, self._required
+        # Literal checks of the whole batch go first, regex runs on survivors only
+        if prefix or suffix or required:
+            indices = [
+                i for i in indices
+                if texts[i].startswith(prefix) and texts[i].endswith(suffix)
+                and required in texts[i]]
+        method, group = self._method, self.group
+        matches = {}
+        for i in indices:
+            result = method(texts[i])
+            if result:
+                value = result.group(group)
+                if value:
+                    matches[i] = value
+        return matches
+
+    def find(self, text: str) -> re.Match | None:
+        '''Like __call__, but returns match object'''
+        if not (text.startswith(self.prefix) and text.endswith(self.suffix)
+                and self._required in text):
+            return None
+        return self._method(text)
+
+    @classmethod
+    def from_entry(cls, entry, prefilter=True):
+        '''
+        Converts matcher entry: pattern, (pattern, group) or tuple of them
+        into PatternMatcher or list of PatternMatcher
+        '''
+        match entry:
+            case tuple() if isinstance(entry[1], int):
+                return cls(entry[0], entry[1], True, prefilter)
+            case tuple():
+                return [cls.from_entry(sub_entry, prefilter) for sub_entry in entry]
+            case _:
+                return cls(entry, prefilter=prefilter)
+
+
+def literal_scanner(matchers) -> Pattern | None:
+    '''
+    Compiles required literals of all matchers into one regex, so a text matching
+    none of the matchers is rejected with a single scan.
+    Returns None if some matcher has no required literal.
+    '''
+    literals = {m.literal for m in matchers}
+    if not matchers or '' in literals:
+        return None
+    # Longer literals first, otherwise a shorter prefix could shadow them
+    return pattern_cache.compile('|'.join(
+        re.escape(literal) for literal in sorted(literals, key=len, reverse=True)))
+
 
 class ReExecutor:
     @staticmethod
@@ -11,15 +325,23 @@ class ReExecutor:
 
     @staticmethod
     def fullmatch(pattern, text, group=0) -> str | None:
-        return ReExecutor._return_group(re.fullmatch(pattern, text), group)
+        pattern = pattern_cache.compile(pattern)
+        if pattern_profiler.enabled:
+            return ReExecutor._return_group(
+                pattern_profiler.call(pattern, pattern.fullmatch, text), group)
+        return ReExecutor._return_group(pattern.fullmatch(text), group)
 
     @staticmethod
     def search(pattern, text, group=0) -> str | None:
-        return ReExecutor._return_group(re.search(pattern, text), group)
+        pattern = pattern_cache.compile(pattern)
+        if pattern_profiler.enabled:
+            return ReExecutor._return_group(
+                pattern_profiler.call(pattern, pattern.search, text), group)
+        return ReExecutor._return_group(pattern.search(text), group)
 
     @staticmethod
     def findall(pattern, text):
-        return re.findall(pattern, text)
+        return pattern_cache.compile(pattern).findall(text)
 
 
 class GroupSearcher:
@@ -36,17 +358,36 @@ class Multimatcher(ABC):
     def match(self, text):
         pass
 
+    def match_many(self, texts):
+        '''Matches a batch of texts, e.g. the whole directory listing'''
+        return [self.match(text) for text in texts]
+
 
 class MultimatchExecutor(Multimatcher):
-    def __init__(self, patterns: list[str | tuple], exclude=None):
+    def __init__(self, patterns: list[str | tuple], exclude=None, prefilter=True):
         self.patterns = patterns
+        self.prefilter = prefilter
+        self._matchers = [PatternMatcher.from_entry(entry, prefilter) for entry in patterns]
+
+    @staticmethod
+    def _run(matchers, text: str):
+        if pattern_profiler.enabled:
+            run = pattern_profiler.run
+            return [
+                run(matcher, text) if isinstance(matcher, PatternMatcher)
+                else [run(sub_matcher, text) for sub_matcher in matcher]
+                for matcher in matchers]
+        return [
+            matcher(text) if isinstance(matcher, PatternMatcher)
+            else [sub_matcher(text) for sub_matcher in matcher]
+            for matcher in matchers]
 
     @staticmethod
     def multimatch(patterns: list[str | tuple], text: str):
         matches = []
         for entry in patterns:
             match entry:
-                case str():  # Use re.match on entry
+                case str() | re.Pattern():  # Use re.match on entry
                     pattern = entry
                     matches.append(ReExecutor.fullmatch(pattern, text))
                 case tuple():  # Two cases
@@ -64,29 +405,44 @@ class MultimatchExecutor(Multimatcher):
                                         group = sub_pattern[1]
                                         sub_result.append(
                                             ReExecutor.search(pattern, text, group=group))
-                                    case str():
+                                    case str() | re.Pattern():
                                         sub_result.append(ReExecutor.fullmatch(sub_pattern, text))
                             matches.append(sub_result)
         return matches
 
     def match(self, text):
-        return self.multimatch(self.patterns, text)
+        return self._run(self._matchers, text)
 
 
 class BoolOutputMultimatcher(MultimatchExecutor):  # I have big problems with naming...
-    def __init__(self, patterns: list[str | tuple], mode='any', exclude=None):
-        super().__init__(patterns)
+    def __init__(self, patterns: list[str | tuple], mode='any', exclude=None, prefilter=True):
+        super().__init__(patterns, prefilter=prefilter)
         self.mode = mode
         self.exclude = exclude
+        self._exclude_matchers = [
+            PatternMatcher.from_entry(entry, prefilter) for entry in exclude] if exclude else None
+        # In 'any' mode text without literals of all patterns can't be matched.
+        # Patterns of a tuple must be matched all, so the first one is enough.
+        self._scanner = None
+        if prefilter and mode == 'any':
+            self._scanner = literal_scanner([
+                m if isinstance(m, PatternMatcher) else m[0] for m in self._matchers])
+
+    def _scan(self, text: str) -> bool:
+        '''Checks that text contains some required literal'''
+        if pattern_profiler.enabled:
+            return pattern_profiler.call(self._scanner, self._scanner.search, text) is not None
+        return self._scanner.search(text) is not None
 
     def any_match(self, text: str) -> bool:
-        matches = self.multimatch(self.patterns, text)
-        if self.exclude:
-            exclude_matches = self.multimatch(self.exclude, text)
+        if self._scanner is not None and not self._scan(text):
+            return False
+        if self._exclude_matchers:
+            exclude_matches = self._run(self._exclude_matchers, text)
             if any(exclude_matches):
                 return False
         bools = []
-        for match in matches:
+        for match in self._run(self._matchers, text):
             if isinstance(match, list):
                 bools.append(all(match))
             else:
@@ -99,68 +455,426 @@ class BoolOutputMultimatcher(MultimatchExecutor):  # I have big problems with na
     def match(self, text: str) -> bool:
         return self.any_match(text)
 
+    @staticmethod
+    def _matched_indices(matcher, texts, indices) -> list[int]:
+        '''Indices of texts matched by PatternMatcher or by all matchers of a tuple'''
+        if isinstance(matcher, PatternMatcher):
+            return list(matcher.match_many(texts, indices))
+        for sub_matcher in matcher:
+            indices = list(sub_matcher.match_many(texts, indices))
+        return indices
+
+    def match_many(self, texts: list[str]) -> list[bool]:
+        '''
+        Returns boolean mask of matched texts. Patterns are applied to the whole
+        batch one by one, and texts already decided are not matched again.
+        '''
+        texts = list(texts)
+        if self.mode not in ('any', 'cons') or self._exclude_matchers and not all(
+                isinstance(m, PatternMatcher) for m in self._exclude_matchers):
+            return [self.any_match(text) for text in texts]
+        indices = range(len(texts))
+        if self._scanner is not None:
+            indices = [i for i in indices if self._scan(texts[i])]
+        if self._exclude_matchers:
+            excluded = set()
+            for matcher in self._exclude_matchers:
+                excluded.update(matcher.match_many(texts, indices))
+            indices = [i for i in indices if i not in excluded]
+        mask = [False] * len(texts)
+        if self.mode == 'any':
+            for matcher in self._matchers:
+                if not indices:
+                    break
+                matched = set(self._matched_indices(matcher, texts, indices))
+                for i in matched:
+                    mask[i] = True
+                indices = [i for i in indices if i not in matched]
+        else:  # cons: each pattern filters texts left by the previous ones
+            for matcher in self._matchers:
+                indices = self._matched_indices(matcher, texts, indices)
+            for i in indices:
+                mask[i] = True
+        return mask
+
 
 class SchemeMatcher(Multimatcher):
-    def __init__(self, matching_scheme: Dict[str, Pattern]):
+    '''
+    Matches texts with all patterns of the scheme.
+    Matchers of single structures see just a few files, so literal prefilters and
+    the combined regex are compiled only after [warmup] texts were matched.
+    Before that each pattern is matched separately. With warmup=0 they are compiled at once.
+    '''
+    def __init__(self, matching_scheme: Dict[str, Pattern], prefilter=True, warmup: int = 8):
         self.matching_scheme = matching_scheme
+        self.prefilter = prefilter
+        self.warmup = warmup
+        # Schemes of structures are built from f-strings, so equal patterns
+        # of different structures share compiled objects from the cache
+        self._fields = [
+            (key, [PatternMatcher(pattern, group, is_search, prefilter=False)
+                   for pattern, group, is_search in self._alternatives(value)])
+            for key, value in matching_scheme.items()]
+        self._combined = self._combined_fields = self._scanner = None
+        self._matched = 0
+        self._compiled = False
+        if warmup <= 0:
+            self._compile()
+
+    def _compile(self):
+        '''Adds literal prefilters, the combined regex and the scanner'''
+        self._compiled = True
+        if self.prefilter:
+            self._fields = [
+                (key, [PatternMatcher(m.pattern, m.group, m.is_search) for m in alternatives])
+                for key, alternatives in self._fields]
+            # Text without any required literal of the scheme can't be matched at all
+            self._scanner = literal_scanner(
+                [m for _, alternatives in self._fields for m in alternatives])
+        self._combined, self._combined_fields = self._combine(self._fields)
+
+    def _count(self, texts: int):
+        if not self._compiled:
+            self._matched += texts
+            if self._matched > self.warmup:
+                self._compile()
+
+    @staticmethod
+    def _alternatives(entry):
+        '''Yields (pattern, group, is_search) for each pattern of scheme entry'''
+        match entry:
+            case tuple() if isinstance(entry[1], int):
+                yield entry[0], entry[1], True
+            case tuple():
+                for sub_entry in entry:
+                    if isinstance(sub_entry, tuple):
+                        yield sub_entry[0], sub_entry[1], True
+                    else:
+                        yield sub_entry, 0, False
+            case _:
+                yield entry, 0, False
+
+    @staticmethod
+    def _combine(fields):
+        '''
+        Compiles the whole scheme into one regex, so a text is matched with a single call.
+        Each pattern becomes an optional lookahead from the start of the text:
+            (?:(?=(pattern)\\Z))? for fullmatch patterns
+            (?:(?=.*?(pattern)))? for search patterns
+        Lookaheads don't consume the text, so all of them are tried independently and
+        capture the same values as separate fullmatch/search calls would. Patterns with
+        flags or backreferences can't be combined, then each field is matched separately.
+        '''
+        parts = []
+        combined_fields = []
+        groups = 0
+        for key, matchers in fields:
+            alternatives = []
+            for matcher in matchers:
+                pattern = matcher.pattern
+                if pattern.flags & ~re.UNICODE or SchemeMatcher._has_backreference(pattern):
+                    return None, None
+                # Literal lookahead is cheaper than backtracking of the pattern itself
+                guard = f'(?=(?s:.*?){re.escape(matcher.literal)})' if matcher.literal else ''
+                if matcher.is_search and not pattern.pattern.startswith(('^', '\\A')):
+                    parts.append(f'(?:{guard}(?=(?s:.*?)((?:{pattern.pattern}))))?')
+                elif matcher.is_search:  # Anchored pattern can be matched only at the start
+                    parts.append(f'(?:(?=((?:{pattern.pattern}))))?')
+                else:
+                    parts.append(f'(?:(?=((?:{pattern.pattern}))\\Z))?')
+                # Group of the pattern in combined regex is shifted by the wrapping group
+                alternatives.append(groups + matcher.group)
+                groups += 1 + pattern.groups
+            combined_fields.append((key, alternatives))
+        try:
+            combined = pattern_cache.compile(''.join(parts))
+        except re.error:  # e.g. same group names in different patterns
+            return None, None
+        if combined.groups != groups:
+            return None, None
+        return combined, combined_fields
+
+    @staticmethod
+    def _has_backreference(pattern: Pattern) -> bool:
+        return bool(re.search(r'\\[1-9]|\(\?P=|\(\?\(', pattern.pattern))
+
+    def _scan(self, text: str) -> bool:
+        '''Checks that text contains some required literal'''
+        if pattern_profiler.enabled:
+            return pattern_profiler.call(self._scanner, self._scanner.search, text) is not None
+        return self._scanner.search(text) is not None
 
-    # I need to rewrite MultimatchExecutor and this to reuse same logic...
     def match_scheme(self, text: str) -> Dict[str, str]:
+        self._count(1)
+        if self._scanner is not None and not self._scan(text):
+            return {}
+        # Profiler needs statistics of each pattern, not of the combined one
+        if self._combined is None or pattern_profiler.enabled:
+            return self._match_each(text)
+        groups = self._combined.match(text).groups()
         result = dict()
-        for key, value in self.matching_scheme.items():
-            match = None
-            match value:
-                case tuple():
-                    match value[1]:
-                        case int():
-                            pattern = value[0]
-                            group = value[1]
-                            match = ReExecutor.search(pattern, text, group=group)
-                        case _:
-                            for sub_pattern in value:
-                                match sub_pattern:
-                                    case tuple():
-                                        pattern = sub_pattern[0]
-                                        group = sub_pattern[1]
-                                        match = ReExecutor.search(pattern, text, group=group)
-                                    case str():
-                                        match = ReExecutor.fullmatch(sub_pattern, text)
-                                if match:
-                                    result[key] = match
-                                    # Now there is no need to have
-                                    # two matches of text for the same field
-                                    break
-                case _:
-                    pattern = value
-                    match = ReExecutor.fullmatch(pattern, text)
-            if match:
-                result[key] = match
+        for key, alternatives in self._combined_fields:
+            for group in alternatives:
+                match = groups[group]
+                if match:
+                    # First matched alternative wins
+                    result[key] = match
+                    break
+        return result
+
+    def match_many(self, texts: list[str]) -> Dict[str, list[str | None]]:
+        '''
+        Matches a batch of texts. Result is columnar: {field: [value or None for each text]}
+        '''
+        texts = list(texts)
+        self._count(len(texts))
+        columns = {key: [None] * len(texts) for key, _ in self._fields}
+        indices = range(len(texts))
+        if self._scanner is not None:
+            indices = [i for i in indices if self._scan(texts[i])]
+        if self._combined is not None and not pattern_profiler.enabled:
+            match = self._combined.match
+            combined_fields = [(columns[key], groups) for key, groups in self._combined_fields]
+            for i in indices:
+                groups = match(texts[i]).groups()
+                for column, alternatives in combined_fields:
+                    for group in alternatives:
+                        if groups[group]:
+                            column[i] = groups[group]
+                            break
+            return columns
+        # Pattern-major loop: the next alternative gets only texts missed by previous ones
+        for key, alternatives in self._fields:
+            column = columns[key]
+            left = indices
+            for matcher in alternatives:
+                matches = matcher.match_many(texts, left)
+                for i, value in matches.items():
+                    column[i] = value
+                left = [i for i in left if i not in matches]
+        return columns
+
+    def fixed_parts(self) -> Dict[str, list[PatternLiterals]]:
+        '''
+        Returns literals of each pattern alternative for each field. Every text matched
+        by the alternative starts with prefix, ends with suffix and contains required
+        '''
+        if not self._compiled:
+            self._compile()
+        return {
+            key: [PatternLiterals(matcher.prefix, matcher.suffix, matcher.literal)
+                  for matcher in alternatives]
+            for key, alternatives in self._fields}
+
+    def _match_each(self, text: str) -> Dict[str, str]:
+        '''Matches each pattern of the scheme separately'''
+        result = dict()
+        run = pattern_profiler.run if pattern_profiler.enabled else None
+        for key, alternatives in self._fields:
+            for matcher in alternatives:
+                match = run(matcher, text) if run else matcher(text)
+                if match:
+                    # Now there is no need to have
+                    # two matches of text for the same field
+                    result[key] = match
+                    break
         return result
 
     def match(self, text: str):
         return self.match_scheme(text)
 
 
+class _TemplatePattern:
+    '''
+    Pattern with {name} placeholders. Each placeholder is replaced with a named group,
+    so the pattern is compiled once and matched values of placeholders are
+    compared with the values they would be formatted with.
+    '''
+    def __init__(self, template: str, group=0, is_search=False, prefilter=True):
+        self.template = template
+        self.group = group
+        self.is_search = is_search
+        self.matcher = None
+        if isinstance(template, re.Pattern):  # Compiled pattern has no placeholders
+            self.placeholders = []
+            self.matcher = PatternMatcher(template, 0, is_search, prefilter)
+            self._group = group
+            return
+        parsed = list(string.Formatter().parse(template))
+        self.placeholders = list(dict.fromkeys(name for _, name, _, _ in parsed if name))
+        parts = []
+        captured = set()
+        for literal, name, format_spec, conversion in parsed:
+            parts.append(literal)
+            if name is None:
+                continue
+            if not name.isidentifier() or format_spec or conversion:
+                return  # Can't be captured, so the pattern is always formatted
+            if name in captured:  # The same value must be repeated
+                parts.append(f'(?P=_t_{name})')
+            else:
+                captured.add(name)
+                parts.append(f'(?P<_t_{name}>(?s:.*?))')
+        try:
+            self.matcher = PatternMatcher(''.join(parts), 0, is_search, prefilter)
+        except re.error:
+            return
+        # Placeholder groups shift numbers of groups in the template
+        pattern = self.matcher.pattern
+        placeholder_groups = {pattern.groupindex[f'_t_{name}'] for name in self.placeholders}
+        user_groups = [i for i in range(1, pattern.groups + 1) if i not in placeholder_groups]
+        self._group = user_groups[group - 1] if group else 0
+
+    def __call__(self, text: str, values: Dict[str, str]) -> str | None:
+        if self.matcher is not None and all(
+                re.escape(values[name]) == values[name] for name in self.placeholders):
+            result = self.matcher.find(text)
+            if result is None:
+                # Literal values can't make formatted pattern match, if any value can't
+                return None
+            if all(result.group(f'_t_{name}') == values[name] for name in self.placeholders):
+                return result.group(self._group)
+        # Values were captured ambiguously or contain regex syntax
+        pattern = pattern_cache.compile(self.template.format_map(values))
+        result = (pattern.search if self.is_search else pattern.fullmatch)(text)
+        return result.group(self.group) if result else None
+
+
+class TemplateMatcher:
+    '''
+    Match scheme with {name} placeholders in patterns, e.g.
+        {'results_file': r'{run}.sample_{sample}.results.txt'}
+    It's compiled once and matches the same as SchemeMatcher
+    of the scheme formatted with values passed to match().
+    Braces of regex must be doubled as in f-strings: \\d{{2}}
+    '''
+    def __init__(self, template: Dict[str, Pattern], prefilter=True):
+        self.template = template
+        self._fields = [
+            (key, [_TemplatePattern(pattern, group, is_search, prefilter)
+                   for pattern, group, is_search in SchemeMatcher._alternatives(value)])
+            for key, value in template.items()]
+        self.placeholders = list(dict.fromkeys(
+            name for _, alternatives in self._fields
+            for alternative in alternatives for name in alternative.placeholders))
+
+    def match(self, text: str, values: Dict[str, str]) -> Dict[str, str]:
+        result = dict()
+        for key, alternatives in self._fields:
+            for alternative in alternatives:
+                match = alternative(text, values)
+                if match:
+                    result[key] = match
+                    break
+        return result
+
+
+_digits = re.compile(r'(\d+)')
+
+
+def natural_key(text: str) -> tuple:
+    '''Key comparing digit runs as numbers: run_2 < run_10'''
+    # Split always starts with text part, so parts of the same position have the same type
+    parts = _digits.split(text)
+    parts[1::2] = map(int, parts[1::2])
+    return tuple(parts)
+
+
 class ReSorter:
-    def __init__(self, searcher, func=None):
+    '''
+    Sorts items by keys searched in them. Keys are extracted once for all items.
+    func is applied to found keys. natural=True compares digit runs of str keys
+    as numbers. missing sets the place of items without key: 'last', 'first',
+    or 'error' to raise ValueError.
+    '''
+    def __init__(self, searcher, func=None, natural=False, missing='last'):
+        if missing not in ('last', 'first', 'error'):
+            raise ValueError(f'Unknown missing keys mode: {missing}')
         self.searcher = searcher
         self.func = func if func else self._return_self
+        self.natural = natural
+        self.missing = missing
+
+    def _search(self, items: list) -> list:
+        '''Searches keys in all items in a single pass'''
+        if isinstance(self.searcher, GroupSearcher) and not pattern_profiler.enabled:
+            search, group = self.searcher.pattern.search, self.searcher.group
+            return [
+                result.group(group) if result else None
+                for result in map(search, items)]
+        return [self.searcher.search(item) for item in items]
 
-    def sort(self, items):
-        return sorted(
-            [i for i in items],
-            key=lambda i: self.func(self.searcher.search(i)))
+    def _values(self, found: list) -> list:
+        '''Sort values of found keys'''
+        values = found if self.func is self._return_self else list(map(self.func, found))
+        if self.natural:
+            values = [natural_key(v) if isinstance(v, str) else v for v in values]
+        return values
+
+    def _split(self, items: list):
+        '''Splits items into found keys with their items and items without keys'''
+        found = self._search(items)
+        if None not in found:
+            return found, items, []
+        missing = [item for item, key in zip(items, found) if key is None]
+        if self.missing == 'error':
+            raise ValueError(f'No sort key found in {missing[0]}')
+        pairs = [(key, item) for key, item in zip(found, items) if key is not None]
+        return [key for key, _ in pairs], [item for _, item in pairs], missing
+
+    def keys(self, items) -> list[tuple]:
+        '''
+        Sort keys of items: (rank, value). Items with keys are ranked before
+        or after missing ones, so keys and missing keys are never compared
+        '''
+        items = list(items)
+        found = self._search(items)
+        if self.missing == 'error' and None in found:
+            raise ValueError(f'No sort key found in {items[found.index(None)]}')
+        rank = 0 if self.missing == 'last' else 1
+        values = iter(self._values([key for key in found if key is not None]))
+        return [(1 - rank,) if key is None else (rank, next(values)) for key in found]
+
+    def sort(self, items) -> list:
+        found, with_keys, missing = self._split(list(items))
+        # Positions are sorted by precomputed values, so items are never compared
+        values = self._values(found)
+        ordered = [with_keys[i] for i in sorted(range(len(values)), key=values.__getitem__)]
+        return ordered + missing if self.missing == 'last' else missing + ordered
+
+    def merge(self, chunks, presorted=True):
+        '''
+        Lazily merges chunks of items, e.g. listings of directories, into one sorted stream.
+        Chunks must be sorted already unless presorted=False, then each chunk is sorted first.
+        Keys are extracted for each chunk at once, items are yielded as soon as they are known
+        to be the smallest ones left.
+        '''
+        chunks = [self.sort(chunk) if not presorted else list(chunk) for chunk in chunks]
+        decorated = [zip(self.keys(chunk), chunk) for chunk in chunks]
+        for _, item in heapq.merge(*decorated, key=itemgetter(0)):
+            yield item
 
     @staticmethod
     def _return_self(value):
         return value
 
+
 __all__ = [
+    'PatternCache',
+    'pattern_cache',
+    'PatternProfiler',
+    'pattern_profiler',
+    'PatternLiterals',
+    'extract_literals',
+    'PatternMatcher',
+    'literal_scanner',
     'ReExecutor',
     'GroupSearcher',
     'Multimatcher',
     'MultimatchExecutor',
     'BoolOutputMultimatcher',
     'SchemeMatcher',
+    'TemplateMatcher',
+    'natural_key',
     'ReSorter'
 ]
@@ -0,0 +1,84 @@
+import asyncio
+import pytest
+
+from src.files_kraken.data_organizer._data_organizer import PartitionedBuilderPool
+from src.files_kraken.database import DatabaseManager, JsonDatabse
+from src.files_kraken.monitoring import Changes
+from src.files_kraken.fields import ParserJob, ParserRunner
+from src.files_kraken.initializer import Workflow
+from test_data_organizer import SampleBlueprint, TestMetricsParser
+from test_fields import HeaderParser
+
+# Worker processes don't play well with pyfakefs,
+# so these tests use real temporary directories
+
+
+class CpuMetricsParser(TestMetricsParser):
+    bound = 'cpu'
+
+
+class CpuHeaderParser(HeaderParser):
+    bound = 'cpu'
+
+
+class TestPartitionedBuilderPool:
+    def test_build(self, tmp_path):
+        db_manager = DatabaseManager(JsonDatabse(tmp_path / 'db.json'))
+        pool = PartitionedBuilderPool(db_manager, blueprints=[SampleBlueprint], workers=2)
+        try:
+            pool.build(Changes([
+                'sample_1.metrics.txt',
+                'sample_2.metrics.txt',
+                '/sample_3.lane_1.R1.fastq.gz']))
+            pool.build(Changes(['/sample_3.lane_1.R2.fastq.gz'], ['sample_2.metrics.txt']))
+        finally:
+            pool.close()
+        assert db_manager.get_blueprint('SampleBlueprint', '1')['metric'] == 50
+        assert db_manager.get_blueprint('SampleBlueprint', '2')['metrics_file'] is None
+        assert db_manager.get_blueprint('SampleBlueprint', '3')['fastqs'] == [
+            '/sample_3.lane_1.R1.fastq.gz', '/sample_3.lane_1.R2.fastq.gz']
+        assert len(db_manager.get_all()) == 3
+
+    def test_workflow_options(self, tmp_path):
+        # Pool workers use default builders, so these options would be ignored
+        with pytest.raises(ValueError, match='parser_cache'):
+            Workflow(
+                'pool_workflow', wf_dir=tmp_path, collector_path=tmp_path,
+                schemes=[SampleBlueprint], build_workers=2, parser_cache=True)
+
+    def test_run_async_requires_async_components(self, tmp_path):
+        workflow = Workflow(
+            'sync_workflow', wf_dir=tmp_path, collector_path=tmp_path, schemes=[SampleBlueprint])
+        with pytest.raises(Exception, match='requires AsyncMonitorManager') as error:
+            asyncio.run(workflow.run_async())
+        # Package modules import exceptions as a top-level module
+        assert type(error.value).__name__ == 'InitializationError'
+
+    def test_partition_is_stable(self):
+        pool = PartitionedBuilderPool(None, blueprints=[SampleBlueprint], workers=4)
+        partitions, keys = pool.partition(Changes(
+            ['sample_1.metrics.txt', '/sample_1.lane_1.R1.fastq.gz'], ['sample_1.metrics.txt']))
+        assert sum(bool(partition) for partition in partitions) == 1
+        assert [k for k in keys if k] == [{('SampleBlueprint', '1')}]
+
+
+class TestParserRunner:
+    def test_cpu_parsers_in_processes(self, tmp_path):
+        file = tmp_path / 'sample_1.metrics.txt'
+        file.write_text('50')
+        runner = ParserRunner(processes=2)
+        try:
+            results = runner.run([ParserJob('metric', CpuMetricsParser, (file,))])
+        finally:
+            runner.close()
+        assert results[0].value == 50
+
+    def test_mapped_parser_in_processes(self, tmp_path):
+        file = tmp_path / 'sample_1.metrics.txt'
+        file.write_bytes(b'header\n')
+        runner = ParserRunner(processes=1)
+        try:
+            results = runner.run([ParserJob('header', CpuHeaderParser, (file,))])
+        finally:
+            runner.close()
+        assert results[0].value == 'header'
@@ -1,15 +1,22 @@
+import asyncio
+import os
 import pytest
 import pathlib
 from dataclasses import dataclass, field
 from typing import ClassVar, List
 
 from src.files_kraken.blueprint._blueprint import DataBlueprint
-from src.files_kraken.data_organizer._data_organizer import BlueprintsDBUpdater, BlueprintBuilder
-from src.files_kraken.database import DatabaseManager
-from src.files_kraken.fields._fields import ParserField, DataParser
+from src.files_kraken.data_organizer._data_organizer import (
+    BlueprintsDBUpdater, BlueprintBuilder, StructureInfo, BlueprintInfo, BlueprintIndex,
+    StructureCache, register_lazy_fields)
+from src.files_kraken.database import DatabaseManager, AsyncDatabaseManager, JsonDatabse
+from src.files_kraken.fields._fields import (
+    ParserField, DataParser, LAZY_PENDING, ParserRunner, ParserStates)
+from src.files_kraken.info import FileChangesInfo, BlueprintsUpdatedInfo
 from src.files_kraken.krakens_nest import Kraken
-from src.files_kraken.monitoring import Changes
+from src.files_kraken.monitoring import Changes, ChangesCoalescer
 from test_database import db
+from test_fields import LineCountParser
 
 
 class TestMetricsParser(DataParser):
@@ -37,6 +44,183 @@ class SampleBlueprint(DataBlueprint):
         super().__post_init__()
 
 
+@dataclass
+class RunBlueprint(DataBlueprint):
+    run: str
+    results: pathlib.Path = None
+    lanes: List[pathlib.Path] = field(default_factory=list)
+    summary: ParserField = ParserField(
+        'summary', parser=TestMetricsParser, pattern=r'run_\d{2}\.summary\.txt')
+
+    required_fields: ClassVar = {'run': (r'run_(\d+)', 1)}
+    match_template: ClassVar = {
+        'results': r'run_{run}\.results\.txt',
+        'lanes': r'run_{run}\.lane_\d{{1}}\.fastq\.gz'
+    }
+
+
+def test_scheme_template():
+    assert RunBlueprint.scheme_template() == {
+        'results': r'run_{run}\.results\.txt',
+        'lanes': r'run_{run}\.lane_\d{{1}}\.fastq\.gz',
+        'summary': r'run_\d{{2}}\.summary\.txt'
+    }
+    assert SampleBlueprint.scheme_template() is None
+    # Structures of templated blueprints don't create matchers
+    structure_info = StructureInfo(RunBlueprint('1'))
+    assert structure_info.scheme_matcher is None
+
+
+class CountingParser(DataParser):
+    calls = 0
+
+    def parse(file):
+        CountingParser.calls += 1
+        return file.name
+
+
+@dataclass
+class ReportBlueprint(DataBlueprint):
+    report: str
+    report_file: pathlib.Path = None
+    title: ParserField = ParserField(
+        'title', parser=CountingParser, dependent_fields=['report_file'], lazy=True)
+
+    required_fields: ClassVar = {'report': (r'report_(\d+)', 1)}
+    match_template: ClassVar = {'report_file': r'report_{report}\.txt'}
+
+
+class ContentParser(DataParser):
+    def parse(file):
+        with open(file) as f:
+            return f.read()
+
+
+@dataclass
+class NoteBlueprint(DataBlueprint):
+    note: str
+    note_file: pathlib.Path = None
+    content: ParserField = ParserField(
+        'content', parser=ContentParser, dependent_fields=['note_file'])
+
+    required_fields: ClassVar = {'note': (r'note_(\d+)', 1)}
+    match_template: ClassVar = {'note_file': r'note_{note}\.txt'}
+
+
+def test_field_plan():
+    plan = SampleBlueprint.field_plan()
+    assert list(plan) == ['sample', 'fastqs', 'metrics_file', 'metric']
+    assert plan['metric'].is_parser and plan['metric'].dependents == ('metrics_file',)
+    assert not plan['fastqs'].is_parser
+    assert plan['fastqs'].to_db([pathlib.Path('/a.fastq.gz')]) == ['/a.fastq.gz']
+    # Plan is compiled once for each blueprint
+    assert SampleBlueprint.field_plan() is plan
+    assert RunBlueprint.field_plan() is not plan
+
+
+@dataclass
+class LogBlueprint(DataBlueprint):
+    run: str
+    log_file: pathlib.Path = None
+    lines: ParserField = ParserField(
+        'lines', parser=LineCountParser, dependent_fields=['log_file'])
+
+    required_fields: ClassVar = {'run': (r'log_(\d+)', 1)}
+    match_template: ClassVar = {'log_file': r'log_{run}\.txt'}
+
+
+class PathLengthParser(DataParser):
+    calls = 0
+
+    def parse(file):
+        PathLengthParser.calls += 1
+        return len(str(file))
+
+
+class LabelParser(DataParser):
+    calls = 0
+
+    def parse(chain, length):
+        LabelParser.calls += 1
+        return f'{chain}:{length}'
+
+
+@dataclass
+class ChainBlueprint(DataBlueprint):
+    chain: str
+    data_file: pathlib.Path = None
+    notes: List[pathlib.Path] = field(default_factory=list)
+    label: ParserField = ParserField(
+        'label', parser=LabelParser, dependent_fields=['chain', 'length'])
+    length: ParserField = ParserField(
+        'length', parser=PathLengthParser, dependent_fields=['data_file'])
+
+    required_fields: ClassVar = {'chain': (r'chain_(\d+)', 1)}
+    match_template: ClassVar = {
+        'data_file': r'chain_{chain}\.data', 'notes': r'chain_{chain}\.note\d'}
+
+
+@dataclass
+class CyclicBlueprint(DataBlueprint):
+    name: str
+    first: ParserField = ParserField('first', parser=LabelParser, dependent_fields=['second'])
+    second: ParserField = ParserField('second', parser=LabelParser, dependent_fields=['first'])
+
+    required_fields: ClassVar = {'name': (r'(\w+)', 1)}
+
+
+def test_parser_levels():
+    assert [[fp.name for fp in level] for level in BlueprintInfo(ChainBlueprint).parser_levels] \
+        == [['length'], ['label']]
+    with pytest.raises(ValueError):
+        BlueprintInfo(CyclicBlueprint)
+
+
+@dataclass
+class BamBlueprint(DataBlueprint):
+    sample: str
+    required_fields: ClassVar = {'sample': ((r'(.+)\.bam', 1), r'.+\.cram')}
+
+
+@dataclass
+class AnyBlueprint(DataBlueprint):
+    name: str
+    required_fields: ClassVar = {'name': (r'(?i)(\w+)', 1)}
+
+
+def test_blueprint_index():
+    blueprints = [SampleBlueprint, RunBlueprint, BamBlueprint, AnyBlueprint]
+    index = BlueprintIndex({bp: BlueprintInfo(bp) for bp in blueprints})
+    assert index.candidates('sample_1.bam') == [SampleBlueprint, BamBlueprint, AnyBlueprint]
+    assert index.candidates('x.cram') == [BamBlueprint, AnyBlueprint]
+    assert index.candidates('run_1.txt') == [RunBlueprint, AnyBlueprint]
+    assert index.candidates('notes.txt') == [AnyBlueprint]
+    index.remove(AnyBlueprint)
+    assert index.candidates('notes.txt') == []
+
+
+def test_structure_cache():
+    cache = StructureCache(capacity=2)
+    infos = [StructureInfo(SampleBlueprint(str(i))) for i in range(3)]
+    for i, info in enumerate(infos):
+        assert cache.take('SampleBlueprint', str(i)) is None
+        cache.put('SampleBlueprint', str(i), info)
+    # The least recently used structure is evicted
+    assert len(cache) == 2 and cache.counters['evictions'] == 1
+    assert cache.take('SampleBlueprint', '1') is infos[1]
+    # Entry written while structure is built isn't cached
+    cache.invalidate('SampleBlueprint', '1')
+    cache.put('SampleBlueprint', '1', infos[1])
+    assert cache.take('SampleBlueprint', '1') is None
+    # Own writes don't invalidate
+    with cache.own_writes():
+        cache.invalidate('SampleBlueprint', '2')
+    cache.invalidate('SampleBlueprint', '0')
+    assert cache.take('SampleBlueprint', '2') is infos[2]
+    assert cache.counters == {'hits': 2, 'misses': 4, 'evictions': 1, 'invalidations': 0}
+    assert cache.hit_rate == 1 / 3
+
+
 @pytest.fixture(scope='module', autouse=True)
 def kraken() -> Kraken:
     return Kraken()
@@ -97,3 +281,190 @@ class TestBlueprintBuilder:
             name='SampleBlueprint',
             id='1')
         assert entry['fastqs'] == ['/sample_1.lane_1.R1.fastq.gz']
+
+    def test_build_grouped_changes(self, builder: BlueprintBuilder):
+        '''All changes of a structure are applied at once, deleted files go first'''
+        plan = builder.plan(Changes(
+            ['/data/sample_1.metrics.txt', '/sample_1.lane_2.R1.fastq.gz', '/sample_2.file'],
+            ['sample_1.metrics.txt']))
+        assert [(bp.name, id, len(p.changes)) for (bp, id), p in plan.items()] == [
+            ('SampleBlueprint', '1', 3), ('SampleBlueprint', '2', 1)]
+        assert plan[(SampleBlueprint, '1')].changes[0] == (
+            pathlib.Path('sample_1.metrics.txt'), 'deleted')
+        builder.build(Changes(
+            ['/data/sample_1.metrics.txt', '/sample_1.lane_2.R1.fastq.gz'],
+            ['sample_1.metrics.txt']))
+        entry = builder.db_manager.get_blueprint(name='SampleBlueprint', id='1')
+        assert entry['metrics_file'] == '/data/sample_1.metrics.txt'
+        assert entry['fastqs'] == ['/sample_1.lane_1.R1.fastq.gz', '/sample_1.lane_2.R1.fastq.gz']
+
+    def test_build_templated_blueprint(self, builder: BlueprintBuilder):
+        builder.register_blueprint(RunBlueprint)
+        builder.build(Changes([
+            '/run_12.results.txt', '/run_12.lane_1.fastq.gz',
+            '/run_123.lane_1.fastq.gz', '/run_12.lane_10.fastq.gz']))
+        entry = builder.db_manager.get_blueprint(name='RunBlueprint', id='12')
+        assert entry['results'] == '/run_12.results.txt'
+        assert entry['lanes'] == ['/run_12.lane_1.fastq.gz']
+        entry = builder.db_manager.get_blueprint(name='RunBlueprint', id='123')
+        assert entry['results'] is None
+        assert entry['lanes'] == ['/run_123.lane_1.fastq.gz']
+
+    def test_build_lazy_parser_field(self, builder: BlueprintBuilder):
+        builder.register_blueprint(ReportBlueprint)
+        builder.build(Changes(['/report_1.txt', '/report_2.txt']))
+        # Nothing is parsed when building
+        assert CountingParser.calls == 0
+        assert builder.db_manager.get_raw('ReportBlueprint', '1')['title'] == LAZY_PENDING
+        # Field is parsed on read and written back
+        assert builder.db_manager.get_blueprint('ReportBlueprint', '1')['title'] == 'report_1.txt'
+        assert builder.db_manager.get_blueprint('ReportBlueprint', '1')['title'] == 'report_1.txt'
+        assert CountingParser.calls == 1
+        # Others are filled in background
+        assert builder.db_manager.fill_lazy() == 1
+        assert builder.db_manager.get_raw('ReportBlueprint', '2')['title'] == 'report_2.txt'
+        assert builder.db_manager.fill_lazy() == 0
+        assert CountingParser.calls == 2
+
+    def test_build_incremental_parser_field(self, builder: BlueprintBuilder):
+        log_builder = BlueprintBuilder(
+            builder.db_manager, builder.db_updater, blueprints=[LogBlueprint],
+            parser_runner=ParserRunner(states=ParserStates(':memory:')))
+        os.makedirs('/logs')
+        with open('/logs/log_1.txt', 'w') as f:
+            f.write('a\nb\n')
+        LineCountParser.parsed = []
+        log_builder.build(Changes(['/logs/log_1.txt']))
+        assert builder.db_manager.get_blueprint('LogBlueprint', '1')['lines'] == 2
+        with open('/logs/log_1.txt', 'a') as f:
+            f.write('c\n')
+        log_builder.build(Changes(modified=['/logs/log_1.txt']))
+        assert builder.db_manager.get_blueprint('LogBlueprint', '1')['lines'] == 3
+        # Only appended line is parsed
+        assert LineCountParser.parsed == [b'a\nb\n', b'c\n']
+        log_builder.close()
+
+    def test_build_parser_fields_graph(self, builder: BlueprintBuilder):
+        builder.register_blueprint(ChainBlueprint)
+        PathLengthParser.calls = LabelParser.calls = 0
+        builder.build(Changes(['/chain_1.data']))
+        entry = builder.db_manager.get_blueprint('ChainBlueprint', '1')
+        assert (entry['length'], entry['label']) == (13, '1:13')
+        # Only fields downstream of changed data_file are parsed again
+        builder.build(Changes(['/chain_1.note1']))
+        builder.build(Changes(['/data/chain_1.data'], ['/chain_1.data']))
+        entry = builder.db_manager.get_blueprint('ChainBlueprint', '1')
+        assert (entry['length'], entry['label']) == (18, '1:18')
+        assert (PathLengthParser.calls, LabelParser.calls) == (2, 2)
+        # The same value doesn't change fields downstream
+        builder.build(Changes(['/home/chain_1.data'], ['/data/chain_1.data']))
+        assert (PathLengthParser.calls, LabelParser.calls) == (3, 2)
+
+    def test_bulk_build(self, builder: BlueprintBuilder):
+        bulk_db = JsonDatabse('/fs/bulk_db.json')
+        inserts = []
+        add_many = bulk_db.add_many
+        bulk_db.add_many = lambda entries: inserts.append(len(entries)) or add_many(entries)
+        db_manager = DatabaseManager(bulk_db)
+        bulk_builder = BlueprintBuilder(
+            db_manager, BlueprintsDBUpdater(db_manager), blueprints=[SampleBlueprint],
+            bulk_chunk=2)
+        files = [f'/sample_{i}.metrics.txt' for i in range(5)] + ['/sample_0.lane_1.R1.fastq.gz']
+        bulk_builder.build(Changes(files))
+        # Structures are written by chunks
+        assert inserts == [2, 2, 1]
+        entry = db_manager.get_blueprint('SampleBlueprint', '0')
+        assert entry['metric'] == 50
+        assert entry['fastqs'] == ['/sample_0.lane_1.R1.fastq.gz']
+        assert len(db_manager.get_all()) == 5
+        # DB isn't empty anymore, so next builds look up structures
+        bulk_builder.build(Changes(['/sample_0.lane_1.R2.fastq.gz']))
+        assert bulk_builder.bulk is False
+        assert len(db_manager.get_all()) == 5
+
+    def test_structure_cache(self, builder: BlueprintBuilder):
+        cache = builder.structure_cache
+        cache.clear()
+        builder.build(Changes(['/sample_7.lane_1.R1.fastq.gz']))
+        hits = cache.counters['hits']
+        builder.build(Changes(['/sample_7.lane_1.R2.fastq.gz']))
+        # Structure of the previous build is reused
+        assert cache.counters['hits'] == hits + 1
+        assert builder.db_manager.get_blueprint('SampleBlueprint', '7')['fastqs'] == [
+            '/sample_7.lane_1.R1.fastq.gz', '/sample_7.lane_1.R2.fastq.gz']
+        # Writes made not by builder invalidate cached structure
+        builder.db_manager.update_blueprint('SampleBlueprint', '7', {'fastqs': []})
+        builder.build(Changes(['/sample_7.lane_2.R1.fastq.gz']))
+        assert cache.counters['hits'] == hits + 1
+        assert builder.db_manager.get_blueprint('SampleBlueprint', '7')['fastqs'] == [
+            '/sample_7.lane_2.R1.fastq.gz']
+
+    def test_build_merged_changes(self, builder: BlueprintBuilder):
+        fastq = '/sample_9.lane_1.R1.fastq.gz'
+        other_fastq = '/sample_9.lane_1.R2.fastq.gz'
+        builder.build(Changes([fastq]))
+        # Infos merged by QueuedKraken while builder was busy
+        info = FileChangesInfo(Changes([other_fastq]))
+        for changes in [Changes([], [other_fastq]), Changes([], [fastq]), Changes([fastq])]:
+            info = info.merge(FileChangesInfo(changes))
+        builder.build(info.changes)
+        assert builder.db_manager.get_blueprint('SampleBlueprint', '9')['fastqs'] == [fastq]
+        # Replaced file which is deleted again
+        info = FileChangesInfo(Changes([], [fastq]))
+        for changes in [Changes([fastq]), Changes([], [fastq])]:
+            info = info.merge(FileChangesInfo(changes))
+        assert info.changes == Changes([], [fastq])
+        builder.build(info.changes)
+        assert not builder.db_manager.get_blueprint('SampleBlueprint', '9')['fastqs']
+
+    def test_build_coalesced_changes(self, builder: BlueprintBuilder):
+        kraken = Kraken(coalescer=ChangesCoalescer(window=60))
+        BlueprintBuilder(
+            builder.db_manager, builder.db_updater, kraken=kraken, blueprints=[SampleBlueprint])
+        updated = []
+        kraken.subscribe(updated.append, info_types=BlueprintsUpdatedInfo)
+        kraken.release(FileChangesInfo(Changes(['/sample_10.lane_1.R1.fastq.gz'])))
+        # Updates reported by builders don't close the window
+        kraken.release(BlueprintsUpdatedInfo('OtherBlueprint', ['1']))
+        kraken.release(FileChangesInfo(Changes(['/sample_11.lane_1.R1.fastq.gz'])))
+        assert [(info.blueprint, info.ids) for info in updated] == [('OtherBlueprint', ['1'])]
+        assert builder.db_manager.get_blueprint('SampleBlueprint', '10') is None
+        kraken.flush()
+        assert [(info.blueprint, info.ids) for info in updated[1:]] == [
+            ('SampleBlueprint', ['10', '11'])]
+
+    def test_async_manager_lazy_fields(self, builder: BlueprintBuilder):
+        builder.register_blueprint(ReportBlueprint)
+        builder.build(Changes(['/report_3.txt', '/report_4.txt']))
+        async_manager = AsyncDatabaseManager(builder.db_manager.db)
+        register_lazy_fields(async_manager, ReportBlueprint)
+
+        async def read():
+            entry = await async_manager.get_blueprint('ReportBlueprint', '3')
+            return entry, await async_manager.get_all()
+
+        entry, entries = asyncio.run(read())
+        assert entry['title'] == 'report_3.txt'
+        titles = {e['id']: e['title'] for e in entries if e['blueprint'] == 'ReportBlueprint'}
+        assert titles['4'] == 'report_4.txt'
+        assert LAZY_PENDING not in titles.values()
+        # Computed values are written to DB
+        assert builder.db_manager.get_raw('ReportBlueprint', '4')['title'] == 'report_4.txt'
+
+    def test_build_replaced_file(self, builder: BlueprintBuilder):
+        kraken = Kraken(coalescer=ChangesCoalescer(window=60))
+        BlueprintBuilder(
+            builder.db_manager, builder.db_updater, kraken=kraken, blueprints=[NoteBlueprint])
+        os.makedirs('/notes')
+        with open('/notes/note_1.txt', 'w') as f:
+            f.write('old')
+        kraken.release(FileChangesInfo(Changes(['/notes/note_1.txt'])))
+        kraken.flush()
+        assert builder.db_manager.get_blueprint('NoteBlueprint', '1')['content'] == 'old'
+        # File is replaced inside of the window
+        kraken.release(FileChangesInfo(Changes([], ['/notes/note_1.txt'])))
+        with open('/notes/note_1.txt', 'w') as f:
+            f.write('new')
+        kraken.release(FileChangesInfo(Changes(['/notes/note_1.txt'])))
+        kraken.flush()
+        assert builder.db_manager.get_blueprint('NoteBlueprint', '1')['content'] == 'new'
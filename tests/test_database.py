@@ -1,7 +1,7 @@
 import pytest
 import pyfakefs
 import os
-from src.files_kraken.database import JsonDatabse
+from src.files_kraken.database import Database, JsonDatabse, DatabaseManager
 
 
 @pytest.fixture(scope='class')
@@ -41,6 +41,16 @@ class TestJsonDatabase:
         all = db.all()
         assert all == [blueprint, second_bp]
 
+    def test_get_many(self, db: JsonDatabse, blueprint: dict):
+        other_bp = {'blueprint': 'OtherBlueprint', 'id': 'second_blueprint'}
+        db.add_blueprint(other_bp)
+        entries = db.get_many('TestBlueprint', ['test_blueprint', 'second_blueprint', 'missing'])
+        assert sorted(entry['id'] for entry in entries) == ['second_blueprint', 'test_blueprint']
+        # Blueprint name is also checked, not only id
+        assert db.get_blueprint('OtherBlueprint', 'test_blueprint') == []
+        assert DatabaseManager(db).get_many('OtherBlueprint', ['second_blueprint']) == {
+            'second_blueprint': other_bp}
+
     def test_update_blueprint(self, db: JsonDatabse, blueprint: dict):
         updates = {'description': 'Blueprint has been updated'}
         db.update_blueprint('TestBlueprint', 'test_blueprint', updates)
@@ -51,3 +61,34 @@ class TestJsonDatabase:
         assert db.get_blueprint(name='TestBlueprint', id='test_blueprint')
         db.remove_blueprint(name='TestBlueprint', id='test_blueprint')
         assert db.get_blueprint(name='TestBlueprint', id='test_blueprint') == []
+
+    def test_add_many(self, db: JsonDatabse):
+        entries = [{'blueprint': 'ManyBlueprint', 'id': str(i)} for i in range(3)]
+        assert not db.is_empty()
+        db.add_many(entries)
+        assert db.get_many('ManyBlueprint', ['0', '1', '2']) == entries
+
+
+class MinimalDatabase(Database):
+    '''Backend with only required methods'''
+    def __init__(self):
+        self.entries = {}
+
+    def add_blueprint(self, blueprint):
+        self.entries[(blueprint['blueprint'], blueprint['id'])] = blueprint
+
+    def get_blueprint(self, name, id):
+        return [self.entries[(name, id)]] if (name, id) in self.entries else []
+
+    def update_blueprint(self, name, id, updates):
+        self.entries[(name, id)].update(updates)
+
+
+def test_minimal_database():
+    db = MinimalDatabase()
+    # It's unknown if DB is empty, so builder doesn't use bulk mode
+    assert not db.is_empty()
+    db_manager = DatabaseManager(db)
+    db_manager.add_many([{'blueprint': 'TestBlueprint', 'id': '1'}])
+    assert db_manager.get_many('TestBlueprint', ['1', '2']) == {
+        '1': {'blueprint': 'TestBlueprint', 'id': '1'}}
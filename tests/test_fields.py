@@ -2,7 +2,9 @@ import pytest
 import pathlib
 from typing import List
 
-from src.files_kraken.fields._fields import FieldsTransformer, NoUpdate
+from src.files_kraken.fields._fields import (
+    FieldsTransformer, NoUpdate, DataParser, ParserJob, ParserRunner, ParserCache, MappedFile,
+    IncrementalParser, ParserStates)
 
 
 @pytest.fixture
@@ -164,3 +166,188 @@ class TestFieldsTransformer:
         assert FieldsTransformer.from_db(
             List[str], strlist_new_1) == strlist_new_1
         assert FieldsTransformer.from_db(List[str], None) is None
+
+
+class LengthParser(DataParser):
+    @staticmethod
+    def parse(text):
+        if not text:
+            raise ValueError('Empty text')
+        return len(text)
+
+
+class TestParserRunner:
+    @pytest.mark.parametrize('threads', [0, 2])
+    def test_run(self, threads):
+        runner = ParserRunner(threads=threads)
+        jobs = [ParserJob(i, LengthParser, (text,)) for i, text in enumerate(['a', '', 'abc'])]
+        results = runner.run(jobs)
+        runner.close()
+        assert [(r.key, r.value) for r in results] == [(0, 1), (1, None), (2, 3)]
+        assert isinstance(results[1].error, ValueError)
+        stats = runner.stats[ParserRunner.parser_name(LengthParser)]
+        assert stats['calls'] == 3
+        assert stats['failures'] == 1
+
+
+class FileLengthParser(DataParser):
+    calls = 0
+
+    @staticmethod
+    def parse(file):
+        FileLengthParser.calls += 1
+        return len(file.read_text())
+
+
+class TestParserCache:
+    def test_cached_results(self, tmp_path):
+        files = [tmp_path / f'{i}.txt' for i in range(3)]
+        for file in files:
+            file.write_text('abc')
+        jobs = [ParserJob(file.name, FileLengthParser, (file,)) for file in files]
+        cache = ParserCache(tmp_path / 'cache.sqlite', max_entries=2)
+        FileLengthParser.calls = 0
+
+        assert [r.value for r in ParserRunner(cache=cache).run(jobs[:2])] == [3, 3]
+        assert [r.value for r in ParserRunner(cache=cache).run(jobs[:2])] == [3, 3]
+        assert FileLengthParser.calls == 2
+        assert cache.counters['hits'] == 2
+
+        # Changed file is parsed again
+        files[0].write_text('abcd')
+        assert ParserRunner(cache=cache).run(jobs[:1])[0].value == 4
+        assert FileLengthParser.calls == 3
+
+        # The least recently used result is evicted
+        ParserRunner(cache=cache).run(jobs[2:])
+        assert len(cache) == 2
+        assert cache.counters['evictions'] == 2
+        cache.close()
+
+        # Results are kept between runs, new parser version invalidates them
+        cache = ParserCache(tmp_path / 'cache.sqlite')
+        ParserRunner(cache=cache).run(jobs[2:])
+        assert FileLengthParser.calls == 4
+        FileLengthParser.version = 1
+        try:
+            ParserRunner(cache=cache).run(jobs[2:])
+        finally:
+            FileLengthParser.version = 0
+        assert FileLengthParser.calls == 5
+        cache.close()
+
+
+class TestListUpdateMany:
+    def test_str_list(self):
+        changes = [
+            (strlist_new_2, 'created'), (strlist_new_3, 'deleted'),
+            ([STRLIST_NEW_VALUE_1], 'created')]
+        expected = strlist_old_1
+        for new_value, mode in changes:
+            update = FieldsTransformer.update(List[str], expected, new_value, mode)
+            expected = expected if update is NoUpdate else update
+        assert FieldsTransformer.update_many(List[str], strlist_old_1, changes) == expected
+        assert FieldsTransformer.update_many(
+            List[str], strlist_new_1, [(strlist_new_1, 'created')]) is NoUpdate
+        assert FieldsTransformer.update_many(
+            List[str], strlist_new_1, [(strlist_new_1, 'deleted')]) is None
+
+    def test_pathlib_list_db_value(self):
+        old_value = FieldsTransformer.from_db(List[pathlib.Path], ['/a', '/b'])
+        new_value = FieldsTransformer.update_many(
+            List[pathlib.Path], old_value,
+            [([pathlib.Path('/c')], 'created'), ([pathlib.Path('/a')], 'created')])
+        assert new_value == [pathlib.Path('/a'), pathlib.Path('/b'), pathlib.Path('/c')]
+        # Only the new path is converted, old ones are taken from DB value
+        assert new_value.db_value == ['/a', '/b', '/c']
+        assert FieldsTransformer.to_db(List[pathlib.Path], new_value) == ['/a', '/b', '/c']
+        new_value = FieldsTransformer.update_many(
+            List[pathlib.Path], new_value, [([pathlib.Path('/b')], 'deleted')])
+        assert FieldsTransformer.to_db(List[pathlib.Path], new_value) == ['/a', '/c']
+
+
+class HeaderParser(DataParser):
+    mapped = True
+    files = []
+
+    @staticmethod
+    def parse(file):
+        HeaderParser.files.append(file)
+        return bytes(file.head()[0]).decode()
+
+
+class TestMappedFile:
+    def test_lines(self, tmp_path):
+        path = tmp_path / 'metrics.txt'
+        path.write_bytes(b'header\nline 1\nline 2\nfooter\n')
+        with MappedFile(path) as file:
+            assert [bytes(line) for line in file.lines()] == [
+                b'header', b'line 1', b'line 2', b'footer']
+            assert [bytes(line) for line in file.head(2)] == [b'header', b'line 1']
+            assert [bytes(line) for line in file.tail(2)] == [b'line 2', b'footer']
+            assert open(file).readline() == 'header\n'
+        empty = tmp_path / 'empty.txt'
+        empty.touch()
+        with MappedFile(empty) as file:
+            assert list(file.lines()) == [] and file.tail() == []
+
+    def test_shared_by_parsers(self, tmp_path):
+        path = tmp_path / 'metrics.txt'
+        path.write_bytes(b'header\n')
+        HeaderParser.files = []
+        runner = ParserRunner()
+        results = runner.run([ParserJob(i, HeaderParser, (path,)) for i in range(2)])
+        assert [r.value for r in results] == ['header', 'header']
+        # File is mapped once for all parsers
+        assert HeaderParser.files[0] is HeaderParser.files[1]
+        runner.release_files()
+        assert runner.run([ParserJob(0, HeaderParser, (tmp_path / 'missing',))])[0].error
+
+
+class LineCountParser(IncrementalParser):
+    parsed = []
+
+    @staticmethod
+    def initial_state():
+        return 0
+
+    @staticmethod
+    def parse_appended(state, data):
+        # Incomplete line is left for the next call
+        consumed = bytes(data).rfind(b'\n') + 1
+        lines = bytes(data[:consumed])
+        LineCountParser.parsed.append(lines)
+        return state + lines.count(b'\n'), consumed
+
+
+class TestIncrementalParser:
+    def run(self, states, path):
+        runner = ParserRunner(states=states)
+        return runner.run([ParserJob('lines', LineCountParser, (path,), ('Log', '1', 'lines'))])[0]
+
+    def test_appended_bytes(self, tmp_path):
+        path = tmp_path / 'run.log'
+        path.write_bytes(b'a\nb\nc')
+        LineCountParser.parsed = []
+        states = ParserStates(tmp_path / 'states.sqlite')
+        assert self.run(states, path).value == 2
+        with open(path, 'ab') as f:
+            f.write(b'\nd\n')
+        assert self.run(states, path).value == 4
+        assert LineCountParser.parsed == [b'a\nb\n', b'c\nd\n']
+        states.close()
+
+        # State is kept between runs
+        with open(path, 'ab') as f:
+            f.write(b'e\n')
+        states = ParserStates(tmp_path / 'states.sqlite')
+        assert self.run(states, path).value == 5
+        assert LineCountParser.parsed[-1] == b'e\n'
+
+        # Replaced file is parsed from the start
+        path.unlink()
+        path.write_bytes(b'x\n')
+        assert self.run(states, path).value == 1
+        states.close()
+        # Without states the whole file is parsed
+        assert ParserRunner().run([ParserJob('lines', LineCountParser, (path,))])[0].value == 1
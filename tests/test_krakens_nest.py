@@ -0,0 +1,189 @@
+import asyncio
+import threading
+
+from src.files_kraken.krakens_nest import Kraken, QueuedKraken, AsyncKraken
+from src.files_kraken.info import FileChangesInfo, BlueprintsUpdatedInfo
+from src.files_kraken.monitoring import Changes, ChangesCoalescer
+
+
+class TestKraken:
+    def test_release(self):
+        received = []
+        kraken = Kraken()
+        kraken.events.append(received.append)
+        kraken.release('info')
+        assert received == ['info']
+
+
+class TestQueuedKraken:
+    def test_release_and_drain(self):
+        received = []
+        kraken = QueuedKraken(maxsize=10)
+        kraken.events.append(received.append)
+        for i in range(5):
+            kraken.release(i)
+        kraken.close()
+        assert received == [0, 1, 2, 3, 4]
+        metrics = kraken.metrics()['list.append']
+        assert metrics['delivered'] == 5
+        assert metrics['depth'] == 0
+
+    def test_coalesce_when_full(self):
+        received = []
+        gate = threading.Event()
+        started = threading.Event()
+
+        def slow_listener(info):
+            started.set()
+            gate.wait()
+            received.append(info)
+
+        kraken = QueuedKraken(maxsize=1, policy='coalesce')
+        kraken.events.append(slow_listener)
+        # First info is taken by consumer thread and blocks on the gate
+        kraken.release(FileChangesInfo(Changes(['a'])))
+        started.wait()
+        kraken.release(FileChangesInfo(Changes(['b'])))
+        kraken.release(FileChangesInfo(Changes(['c'], ['d'])))
+        gate.set()
+        kraken.close()
+        assert [info.changes for info in received] == [
+            Changes(['a']), Changes(['b', 'c'], ['d'])]
+        assert kraken.metrics()['TestQueuedKraken.test_coalesce_when_full.<locals>.slow_listener'][
+            'coalesced'] == 1
+
+    def test_merge_keeps_order(self):
+        merged = FileChangesInfo(Changes(['a'], ['b'])).merge(
+            FileChangesInfo(Changes(['b', 'c'], ['a'])))
+        # a is created and deleted, b is replaced
+        assert merged.changes == Changes(['b', 'c'], ['b'])
+        merged = merged.merge(FileChangesInfo(Changes([], ['b'])))
+        assert merged.changes == Changes(['c'], ['b'])
+
+    def test_listener_errors_are_isolated(self):
+        received = []
+
+        def listener(info):
+            if info == 'bad':
+                raise ValueError(info)
+            received.append(info)
+
+        kraken = QueuedKraken()
+        kraken.events.append(listener)
+        kraken.release('bad')
+        kraken.release('good')
+        kraken.close()
+        assert received == ['good']
+
+
+class TestChangesCoalescer:
+    def test_size_window(self):
+        received = []
+        kraken = Kraken(coalescer=ChangesCoalescer(max_size=3))
+        kraken.events.append(received.append)
+        kraken.release(FileChangesInfo(Changes(['tmp', 'a'])))
+        kraken.release(FileChangesInfo(Changes(['a'], ['tmp'])))
+        assert not received
+        kraken.release(FileChangesInfo(Changes(['b', 'c'], ['d'])))
+        assert [info.changes for info in received] == [Changes(['a', 'b', 'c'], ['d'])]
+        counters = kraken.coalescer.counters
+        assert counters['cancelled'] == 2
+        assert counters['duplicates'] == 1
+        assert kraken.coalescer.eliminated == 3
+
+    def test_replaced_file_deleted_and_created(self):
+        received = []
+        kraken = Kraken(coalescer=ChangesCoalescer(window=60))
+        kraken.events.append(received.append)
+        kraken.release(FileChangesInfo(Changes([], ['a'])))
+        kraken.release(FileChangesInfo(Changes(['a'])))
+        kraken.poll()
+        assert not received
+        kraken.close()
+        # The same as Changes.merge reports it
+        assert [info.changes for info in received] == [Changes(['a'], ['a'])]
+        assert received[0].changes == Changes([], ['a']).merge(Changes(['a']))
+
+    def test_modified_files(self):
+        received = []
+        kraken = Kraken(coalescer=ChangesCoalescer(window=60))
+        kraken.events.append(received.append)
+        kraken.release(FileChangesInfo(Changes(['a'], [], ['b'])))
+        kraken.release(FileChangesInfo(Changes([], ['b'], ['a', 'c'])))
+        kraken.close()
+        assert [info.changes for info in received] == [Changes(['a'], ['b'], ['c'])]
+
+    def test_other_infos_pass_through(self):
+        received = []
+        kraken = Kraken(coalescer=ChangesCoalescer(window=60))
+        kraken.events.append(received.append)
+        kraken.release(FileChangesInfo(Changes(['a'])))
+        kraken.release('info')
+        # Pending changes stay in the window
+        assert received == ['info']
+        kraken.flush()
+        assert received[1].changes == Changes(['a'])
+
+
+class TestAsyncKraken:
+    def test_async_and_blocking_listeners(self):
+        received = []
+
+        async def async_listener(info):
+            received.append(('async', info))
+
+        def blocking_listener(info):
+            received.append(('blocking', info))
+
+        async def main():
+            kraken = AsyncKraken(maxsize=1)
+            kraken.events.append(async_listener)
+            kraken.events.append(blocking_listener)
+            for i in range(3):
+                await kraken.release(i)
+            await kraken.close()
+            return kraken.metrics()
+
+        metrics = asyncio.run(main())
+        assert [info for kind, info in received if kind == 'async'] == [0, 1, 2]
+        assert [info for kind, info in received if kind == 'blocking'] == [0, 1, 2]
+        assert all(m['delivered'] == 3 and m['depth'] == 0 for m in metrics.values())
+
+
+class TestRouting:
+    def test_subscription_filters(self):
+        received = {'all': [], 'changes': [], 'volume': [], 'monitor': [], 'blueprint': []}
+        kraken = Kraken()
+        kraken.events.append(received['all'].append)
+        kraken.subscribe(received['changes'].append, info_types=FileChangesInfo)
+        kraken.subscribe(
+            received['volume'].append, info_types=FileChangesInfo, path_prefixes='/volume_1/')
+        kraken.subscribe(received['monitor'].append, sources='Monitor_2')
+        kraken.subscribe(received['blueprint'].append, blueprints=['SampleBlueprint'])
+
+        info = FileChangesInfo(
+            Changes(['/volume_1/a', '/volume_2/b'], ['/volume_2/c']), 'Monitor_1')
+        kraken.release(info)
+        kraken.release(BlueprintsUpdatedInfo('SampleBlueprint', ['1']))
+
+        assert len(received['all']) == 2
+        assert received['changes'] == [info]
+        assert [i.changes for i in received['volume']] == [Changes(['/volume_1/a'])]
+        assert not received['monitor']
+        assert received['blueprint'] == [BlueprintsUpdatedInfo('SampleBlueprint', ['1'])]
+
+    def test_sibling_path_prefixes(self):
+        received = []
+        kraken = Kraken()
+        kraken.subscribe(received.append, path_prefixes='/volume_1')
+        kraken.release(FileChangesInfo(Changes(['/volume_10/x.txt', '/volume_1/a', '/volume_1'])))
+        assert [info.changes for info in received] == [Changes(['/volume_1/a', '/volume_1'])]
+
+    def test_unsubscribe(self):
+        received = []
+        kraken = Kraken()
+        subscription = kraken.subscribe(received.append)
+        kraken.release('first')
+        kraken.unsubscribe(subscription)
+        kraken.release('second')
+        assert received == ['first']
@@ -1,3 +1,4 @@
+import asyncio
 import pytest
 import pyfakefs
 import pathlib
@@ -15,7 +16,11 @@ from tests_data.collector_collections import (
     FS_MODIFIED_COLLECTION
 )
 from src.files_kraken.collector._collector import DictCollection, SingleRootCollector
-from src.files_kraken.monitoring import ChangesWatcher, ChangesFactory, MonitorManager, BackupManager
+from src.files_kraken.monitoring import (
+    ChangesWatcher, ChangesFactory, MonitorManager, AsyncMonitorManager, BackupManager, Changes,
+    ChangesCoalescer)
+from src.files_kraken.info import FileChangesInfo
+from src.files_kraken.krakens_nest import AsyncKraken
 from copy import deepcopy
 from test_collector import create_SRC, create_BOM, test_matcher
 
@@ -135,6 +140,47 @@ class TestChangesWatcher:
         watcher.set_root('/fs')
         assert collector.root == pathlib.Path('/fs')
 
+    @pytest.mark.parametrize('collector_args', [dict(keep_empty_dirs=False)])
+    @pytest.mark.parametrize('watcher_args', [dict(
+        prev_state=DictCollection(FS_DEFAULT_MATCH_COLLECTION),
+        growth_filter=lambda file: file.endswith('.bam'))])
+    def test_get_grown_files(
+            self, fs, collector: SingleRootCollector, watcher: ChangesWatcher):
+        bam = '/fs/tests_data/collector_path/run_4/bams/run_4.sample_14.bam'
+        fs.create_file(bam)
+        changes = watcher.get_changes()
+        assert changes.created == [bam]
+        # Files known before the start could grow meanwhile, so they are reported once
+        assert len(changes.modified) == 4 and bam not in changes.modified
+        with open(bam, 'a') as f:
+            f.write('reads')
+        changes = watcher.get_changes()
+        assert changes == Changes(modified=[bam])
+        assert not watcher.get_changes()
+
+
+# ChangesCoalescer Tests
+
+
+class TestChangesCoalescer:
+    def test_replaced_file_deleted(self):
+        coalescer = ChangesCoalescer(window=60)
+        for changes in [Changes([], ['a']), Changes(['a']), Changes([], ['a'])]:
+            assert coalescer.add(FileChangesInfo(changes)) == []
+        # File had existed before the window, so its deletion must be reported
+        assert [info.changes for info in coalescer.flush()] == [Changes([], ['a'])]
+        assert coalescer.counters['cancelled'] == 2
+        assert coalescer.counters['replaced'] == 1
+
+    def test_size_without_window(self):
+        coalescer = ChangesCoalescer(max_size=10)
+        assert coalescer.window == ChangesCoalescer.default_window
+        coalescer.add(FileChangesInfo(Changes(['a'])))
+        assert coalescer.poll() == []
+        # Partial batch is released when default window is over
+        coalescer._opened_at -= coalescer.window
+        assert [info.changes for info in coalescer.poll()] == [Changes(['a'])]
+
 
 # BackupManager Tests
 
@@ -250,3 +296,31 @@ class TestMonitorManager:
         # Manager stops when function in parallel thread writes to the specified file
         with open('/fs/backups/Coworker.json') as f:
             assert json.load(f) == FS_MODIFIED_COLLECTION
+
+
+class TestAsyncMonitorManager:
+    def test_start_cancel(self, fs):
+        received = []
+
+        async def listener(info):
+            received.append(info.changes)
+
+        async def main():
+            kraken = AsyncKraken()
+            kraken.events.append(listener)
+            src = create_SRC(root='/fs/tests_data/collector_path/', matcher=test_matcher)
+            manager = AsyncMonitorManager('/fs/backups/', kraken=kraken)
+            manager.poll_interval = 0.01
+            manager.add_monitor(
+                ChangesWatcher(src, name='Async Monitor'), backup_file='async.json', timeout=0)
+            task = asyncio.create_task(manager.start())
+            while not received:
+                await asyncio.sleep(0.01)
+            # Monitoring must be stopped by cancellation without waiting for exit
+            task.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await task
+            await kraken.close()
+
+        asyncio.run(asyncio.wait_for(main(), timeout=10))
+        assert '/fs/tests_data/collector_path/run_1/bams/sample_1.bam' in received[0].created
@@ -1,4 +1,9 @@
-from src.files_kraken.retools import ReExecutor, SchemeMatcher, ReSorter, GroupSearcher
+import pytest
+
+from src.files_kraken.retools import (
+    ReExecutor, SchemeMatcher, ReSorter, GroupSearcher, PatternCache,
+    BoolOutputMultimatcher, extract_literals, TemplateMatcher, PatternProfiler, pattern_profiler,
+    PatternMatcher)
 from test_collector import test_matcher
 
 # ReExecutor.fullmatch
@@ -38,6 +43,47 @@ class TestReExecutor:
         assert ReExecutor.findall(self.rex_pattern, 'run_1_run2_run_3') == ['run_1', 'run_3']
 
 
+# PatternCache
+
+def test_pattern_cache():
+    cache = PatternCache(maxsize=2)
+    first = cache.compile(r'run_\d+')
+    assert cache.compile(r'run_\d+') is first
+    cache.compile(r'sample_\d+')
+    cache.compile(r'lane_\d+')  # run pattern is evicted
+    assert len(cache) == 2
+    cache.compile(r'run_\d+')
+    assert (cache.hits, cache.misses) == (1, 4)
+    assert cache.compile(first) is first
+    assert cache.compile_entry(((r'run_(\d+)', 1), r'sample')) == (
+        (cache.compile(r'run_(\d+)'), 1), cache.compile('sample'))
+
+
+# Literal prefilter
+
+def test_extract_literals():
+    assert extract_literals(r'.+\.bam') == ('', '.bam', '.bam')
+    assert extract_literals(r'run_\d+') == ('run_', '', 'run_')
+    assert extract_literals(r'run_(\d+)\.sample_\d+\.txt') == ('run_', '.txt', '.sample_')
+    # Nothing is required from case insensitive patterns and alternations
+    assert extract_literals(r'(?i)run') == ('', '', '')
+    assert extract_literals(r'run|sample') == ('', '', '')
+
+
+def test_prefilter_does_not_change_matches():
+    patterns = [r'run_\d+', r'.+\.bam', (r'sample_(\d+)\.fastq\.gz', 1), r'(?i)report.*']
+    entries = [
+        'run_1', 'run_', 'x_run_1', 'sample_1.bam', 'sample_1.bamm', 'sample_2.fastq.gz',
+        'sample_2.fastq', 'REPORT.pdf', 'notes.txt']
+    for mode in ('any', 'all'):
+        plain = BoolOutputMultimatcher(patterns, mode=mode, prefilter=False)
+        filtered = BoolOutputMultimatcher(patterns, mode=mode, prefilter=True)
+        assert [plain.match(e) for e in entries] == [filtered.match(e) for e in entries]
+    scheme = {'run': r'run_(\d+)', 'bam': r'.+\.bam'}
+    assert [SchemeMatcher(scheme, prefilter=False).match(e) for e in entries] == [
+        SchemeMatcher(scheme).match(e) for e in entries]
+
+
 # BoolOutputMultimatcher
 
 
@@ -59,6 +105,17 @@ def test_BOM_no_match():
     assert len(matches) == 5
 
 
+def test_BOM_match_many():
+    entries = [
+        'run_1', 'sample_1.bamm', 'sample_1.fastq.gz', 'run1',
+        'run_1.metrics.txt', 'sample_1.results', 'sample_1.results.txt']
+    assert test_matcher.match_many(entries) == [test_matcher.match(e) for e in entries]
+    patterns = [r'run_\d+.*', r'.+\.txt']
+    for mode in ('any', 'cons'):
+        matcher = BoolOutputMultimatcher(patterns, mode=mode, exclude=[r'.+\.metrics\.txt'])
+        assert matcher.match_many(entries) == [matcher.match(e) for e in entries]
+
+
 # ReSorter
 
 def test_ReSorter():
@@ -70,6 +127,26 @@ def test_ReSorter():
     assert sorter.sort(entries) == ['run_1', 'run_2', 'run_3', 'run_4', 'run_5']
 
 
+def test_ReSorter_natural_and_missing():
+    entries = ['run_10.s_2', 'notes', 'run_2.s_10', 'run_2.s_9', 'img']
+    sorter = ReSorter(GroupSearcher(r'run_.+', 0), natural=True)
+    assert sorter.sort(entries) == ['run_2.s_9', 'run_2.s_10', 'run_10.s_2', 'notes', 'img']
+    sorter = ReSorter(GroupSearcher(r'run_(\d+)', 1), func=int, missing='first')
+    assert sorter.sort(entries) == ['notes', 'img', 'run_2.s_10', 'run_2.s_9', 'run_10.s_2']
+    with pytest.raises(ValueError):
+        ReSorter(GroupSearcher(r'run_(\d+)', 1), missing='error').sort(entries)
+
+
+def test_ReSorter_merge():
+    sorter = ReSorter(GroupSearcher(r'run_(\d+)', 1), func=int)
+    chunks = [['run_1', 'run_5', 'run_9'], ['run_2', 'run_3'], ['x', 'run_4']]
+    merged = sorter.merge(chunks[:2])
+    assert next(merged) == 'run_1'  # Merge is lazy
+    assert list(merged) == ['run_2', 'run_3', 'run_5', 'run_9']
+    assert list(sorter.merge(chunks, presorted=False)) == [
+        'run_1', 'run_2', 'run_3', 'run_4', 'run_5', 'run_9', 'x']
+
+
 # SchemeMatcher
 
 class TestSchemeMatcher:
@@ -91,3 +168,103 @@ class TestSchemeMatcher:
             'sample': 'BR616', 'fastq': 'run_111.sample_BR616.fastq.gz'}
         # No match
         assert self.scheme_matcher.match('test.sample-BR616.bai') == {}
+
+    def test_combined_matches_as_separate_patterns(self):
+        scheme = {
+            'run': (r'^(run_[0-9]+)', 1),
+            'sample': ((r'sample_([^\.]+)', 1), (r'(\w+)_metrics.csv', 1), r'ctrl|neg'),
+            'results': r'.+\.results\.txt',
+            'empty': r'x*'
+        }
+        matcher = SchemeMatcher(scheme, warmup=0)
+        assert matcher._combined is not None
+        texts = [
+            'run_100.sample_MYSAMPLE.results.txt', 'MYSAMPLE_metrics.csv',
+            'neg', 'run_1', '', 'x.results.txt', 'run_2.sample_3.sample_4']
+        for text in texts:
+            assert matcher.match(text) == matcher._match_each(text)
+        assert matcher.match('run_100.sample_S1.results.txt') == {
+            'run': 'run_100', 'sample': 'S1', 'results': 'run_100.sample_S1.results.txt'}
+
+    def test_match_many_columns(self):
+        names = ['run_1.sample_2.results.txt', 'sample_3.bam', 'notes.txt']
+        for scheme in (self.scheme, {'run': r'(?i)run_\d+.*', 'bam': r'.+\.bam'}):
+            matcher = SchemeMatcher(scheme)
+            columns = matcher.match_many(names)
+            assert list(columns) == list(scheme)
+            rows = [
+                {key: column[i] for key, column in columns.items() if column[i]}
+                for i in range(len(names))]
+            assert rows == [matcher.match(name) for name in names]
+
+    def test_warmup(self):
+        matcher = SchemeMatcher({'run': (r'^(run_[0-9]+)', 1), 'bam': r'.+\.bam'}, warmup=2)
+        names = ['run_1.bam', 'notes.txt', 'run_2.txt']
+        # Patterns are matched separately until the matcher has been used enough
+        assert [matcher.match(name) for name in names[:2]] == [
+            {'run': 'run_1', 'bam': 'run_1.bam'}, {}]
+        assert matcher._combined is None and matcher._scanner is None
+        assert matcher.match(names[2]) == {'run': 'run_2'}
+        assert matcher._combined is not None and matcher._scanner is not None
+        assert [matcher.match(name) for name in names] == [
+            matcher._match_each(name) for name in names]
+
+    def test_not_combinable_scheme(self):
+        matcher = SchemeMatcher({'double': r'(a)\1', 'case': r'(?i)run'})
+        assert matcher._combined is None
+        assert matcher.match('aa') == {'double': 'aa'}
+        assert matcher.match('RUN') == {'case': 'RUN'}
+
+
+def test_template_matcher():
+    template = {
+        'results': r'{run}\.sample_{sample}\.results\.txt',
+        'lane': (r'{run}_{sample}\.lane_(\d{{1,2}})', 1),
+        'pair': r'{sample}_{sample}\.txt'
+    }
+    matcher = TemplateMatcher(template)
+    assert matcher.placeholders == ['run', 'sample']
+    names = [
+        'run_1.sample_2.results.txt', 'run_1.sample_22.results.txt', 'run_1_2.lane_10',
+        'run_1_2_2.lane_3', '2_2.txt', '2_3.txt', 'run_1.sample_2.results.txtx']
+    for values in ({'run': 'run_1', 'sample': '2'}, {'run': 'run_1', 'sample': '2_2'},
+                   {'run': 'run.1', 'sample': '2'}):
+        formatted = SchemeMatcher({
+            key: tuple(p.format_map(values) if isinstance(p, str) else p for p in value)
+            if isinstance(value, tuple) else value.format_map(values)
+            for key, value in template.items()})
+        assert [matcher.match(name, values) for name in names] == [
+            formatted.match(name) for name in names]
+
+
+# PatternProfiler
+
+def test_pattern_profiler(tmp_path):
+    scheme_matcher = SchemeMatcher(
+        {'bam': r'(\w+_?)+\.bam', 'run': (r'run_(\d+)', 1)}, warmup=0)
+    names = ['run_1.bam', 'run_2.txt', 'sample.bam', 'notes.txt']
+    pattern_profiler.reset()
+    scheme_matcher.match(names[0])
+    assert not pattern_profiler.report()  # Nothing is recorded when disabled
+    pattern_profiler.enable()
+    try:
+        matches = [scheme_matcher.match(name) for name in names]
+        ReExecutor.fullmatch(r'notes\.txt', names[3])
+    finally:
+        pattern_profiler.disable()
+    assert matches == [scheme_matcher.match(name) for name in names]
+    report = {stats['pattern']: stats for stats in pattern_profiler.report(sort='calls')}
+    # notes.txt is rejected by literals before any pattern
+    assert (report[r'(\w+_?)+\.bam']['calls'], report[r'(\w+_?)+\.bam']['hits']) == (3, 2)
+    assert report[r'run_(\d+)']['hit_rate'] == 2 / 3
+    assert report[r'(\w+_?)+\.bam']['flags'] == ['nested repeat']
+    assert report[r'notes\.txt']['flags'] == []
+    pattern_profiler.dump_json(tmp_path / 'profile.json')
+    assert (tmp_path / 'profile.json').exists()
+    pattern_profiler.reset()
+
+
+def test_slow_calls_flagged():
+    profiler = PatternProfiler(slow_call=0)
+    profiler.run(PatternMatcher(r'a+b'), 'aaab')
+    assert profiler.report()[0]['flags'] == ['slow calls']